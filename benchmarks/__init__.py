@@ -0,0 +1 @@
+"""Benchmarks of the data preparation and of the plots on synthetic datasets"""
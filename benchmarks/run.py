@@ -0,0 +1,242 @@
+"""
+Benchmark suite of Isoplot. A synthetic dataset is generated (see benchmarks.synthetic) and the data preparation
+stages, every plot method of the command-line interface and the maps are timed on it. Results are written as json
+so that runs can be compared, and a run can be checked against a baseline:
+
+    python -m benchmarks.run --output baseline.json
+    python -m benchmarks.run --output current.json --compare baseline.json --threshold 1.25
+
+The check exits with status 1 when a benchmark is slower than the baseline by more than the threshold. Nothing is
+downloaded, the suite runs offline.
+"""
+
+import argparse
+import datetime
+import fnmatch
+import gc
+import json
+import logging
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import isoplot
+from isoplot.main.dataprep import IsoplotData
+from isoplot.main.plots import Map
+from isoplot.main.render import RenderTask, Renderer
+from isoplot.main.sinks import MemorySink
+from benchmarks.synthetic import write_dataset
+
+# Plot methods of the command-line interface and the value they plot
+STATIC_METHODS = [("stacked_areaplot", "isotopologue_fraction"), ("barplot", "isotopologue_fraction"),
+                  ("mean_barplot", "isotopologue_fraction"), ("mean_enrichment_plot", "mean_enrichment"),
+                  ("mean_enrichment_meanplot", "mean_enrichment")]
+INTERACTIVE_METHODS = [("stacked_barplot", "isotopologue_fraction"), ("unstacked_barplot", "isotopologue_fraction"),
+                       ("stacked_meanplot", "isotopologue_fraction"), ("unstacked_meanplot", "isotopologue_fraction"),
+                       ("mean_enrichment_plot", "mean_enrichment"), ("mean_enrichment_meanplot", "mean_enrichment"),
+                       ("stacked_areaplot", "isotopologue_fraction")]
+MAP_METHODS = ["build_heatmap", "build_clustermap", "build_interactive_heatmap"]
+
+
+class BenchmarkSuite:
+    """
+    Timings of the benchmarks of a synthetic dataset
+
+    :param params: parameters of the synthetic dataset (see benchmarks.synthetic.generate_dataset)
+    :type params: dict
+    :param repeat: number of times each benchmark is run
+    :type repeat: int
+    :param plot_metabolites: number of metabolites for which each plot is rendered
+    :type plot_metabolites: int
+    :param fmt: format of the static plots
+    :type fmt: str
+    :param only: patterns of the benchmarks to run (fnmatch syntax), all are run if None
+    :type only: list of str
+    """
+
+    def __init__(self, params, repeat=3, plot_metabolites=3, fmt="png", only=None):
+
+        self.params = params
+        self.repeat = repeat
+        self.plot_metabolites = plot_metabolites
+        self.fmt = fmt
+        self.only = only
+        self.results = {}
+
+    def bench(self, name, calls, reset=None):
+        """
+        Time calls and store their statistics in results. Each call is timed repeat times, after reset and a garbage
+        collection which are not timed. An exception stops the benchmark and is stored in place of the timings.
+
+        :param name: name of the benchmark
+        :type name: str
+        :param calls: functions to time, without arguments
+        :type calls: list
+        :param reset: function called before each timed call
+        """
+
+        if self.only is not None and not any(fnmatch.fnmatch(name, pattern) for pattern in self.only):
+            return
+        times = []
+        try:
+            for _ in range(self.repeat):
+                for call in calls:
+                    if reset is not None:
+                        reset()
+                    gc.collect()
+                    start = time.perf_counter()
+                    call()
+                    times.append(time.perf_counter() - start)
+        except Exception as err:
+            self.results[name] = {"error": f"{type(err).__name__}: {err}"}
+            return
+        self.results[name] = {"median": statistics.median(times), "min": min(times), "times": times}
+
+    def run(self, directory):
+        """
+        Generate the dataset in a directory and run the benchmarks
+
+        :param directory: directory of the dataset files
+        :type directory: str or class: 'pathlib.Path'
+        """
+
+        data_path, template_path = write_dataset(directory, **self.params)
+        dataset = IsoplotData(str(data_path))
+
+        # DATA PREPARATION
+        self.bench("load_isocor_data", [lambda: IsoplotData.load_isocor_data(data_path)])
+        self.bench("load_template", [lambda: IsoplotData.load_template(template_path)])
+        dataset.data = IsoplotData.load_isocor_data(data_path)
+        dataset.template = IsoplotData.load_template(template_path)
+        self.bench("merge_data", [dataset.merge_data])
+        self.bench("prepare_data", [lambda: dataset.prepare_data(export=None, build_tensor=True)],
+                   reset=dataset.merge_data)
+        dataset.merge_data()
+        dataset.prepare_data(export=None, build_tensor=True)
+
+        # PLOTS, rendered as by the command-line interface. Each call starts without cached intermediates
+        renderer = Renderer(dataset, "bench", list(dataset.dfmerge["condition"].unique()),
+                            list(dataset.dfmerge["time"].unique()), self.fmt, True, False, MemorySink())
+
+        def reset_renderer():
+            renderer.reset_cache()
+            renderer.sink = MemorySink()
+
+        metabolites = sorted(dataset.dfmerge["metabolite"].unique())[:self.plot_metabolites]
+        for kind, methods in (("static", STATIC_METHODS), ("interactive", INTERACTIVE_METHODS)):
+            for method, value in methods:
+                tasks = [RenderTask(kind, method, method, metabolite, value) for metabolite in metabolites]
+                self.bench(f"{kind}.{method}", [lambda task=task: renderer.render(task) for task in tasks],
+                           reset=reset_renderer)
+
+        # MAPS
+        self.bench("map.construction", [lambda: Map(dataset, "bench", False, self.fmt, sink=MemorySink())])
+        heatmap = Map(dataset, "bench", False, self.fmt, sink=MemorySink())
+        for method in MAP_METHODS:
+            self.bench(f"map.{method}", [getattr(heatmap, method)],
+                       reset=lambda: setattr(heatmap, "sink", MemorySink()))
+
+    def to_json(self):
+        """Get the results and the context of the run as a json serializable dictionary"""
+
+        return {"isoplot_version": isoplot.__version__, "python": platform.python_version(),
+                "platform": platform.platform(), "date": datetime.datetime.now().isoformat(timespec="seconds"),
+                "parameters": self.params, "repeat": self.repeat, "plot_metabolites": self.plot_metabolites,
+                "format": self.fmt, "results": self.results}
+
+
+def compare(current, baseline, threshold=1.25, min_delta=0.005):
+    """
+    Find the benchmarks that are slower than in a baseline run. Medians are compared, and a benchmark is a regression
+    when it is more than threshold times slower and more than min_delta seconds slower, so that the noise on very
+    short benchmarks is ignored.
+
+    :param current: results of the current run (see BenchmarkSuite.to_json)
+    :type current: dict
+    :param baseline: results of the baseline run
+    :type baseline: dict
+    :param threshold: ratio of the medians above which a benchmark is a regression
+    :type threshold: float
+    :param min_delta: difference of the medians in seconds below which a benchmark is never a regression
+    :type min_delta: float
+    :return: ratio of the medians of the benchmarks run in both, and the names of the regressions
+    :rtype: tuple of (dict, list)
+    """
+
+    ratios, regressions = {}, []
+    for name, result in current["results"].items():
+        reference = baseline["results"].get(name)
+        if reference is None or "median" not in result or "median" not in reference:
+            continue
+        ratios[name] = result["median"] / reference["median"] if reference["median"] > 0 else float("inf")
+        if ratios[name] > threshold and result["median"] - reference["median"] > min_delta:
+            regressions.append(name)
+    return ratios, regressions
+
+
+def parse_args(argv=None):
+
+    parser = argparse.ArgumentParser("isoplot-benchmarks", description="Benchmarks of Isoplot on synthetic data")
+    parser.add_argument("--metabolites", type=int, default=20, help="Number of metabolites of the dataset")
+    parser.add_argument("--conditions", type=int, default=4, help="Number of conditions of the dataset")
+    parser.add_argument("--times", type=int, default=3, help="Number of times of the dataset")
+    parser.add_argument("--replicates", type=int, default=3,
+                        help="Number of replicates of each condition and time. The dataset has "
+                             "conditions x times x replicates samples")
+    parser.add_argument("--isotopologues", type=int, default=6,
+                        help="Maximum number of isotopologues of a metabolite")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the dataset generator")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of times each benchmark is run")
+    parser.add_argument("--plot_metabolites", type=int, default=3,
+                        help="Number of metabolites for which each plot is rendered")
+    parser.add_argument("--format", default="png", help="Format of the static plots")
+    parser.add_argument("--only", nargs="+", metavar="PATTERN",
+                        help="Run only the benchmarks matching these patterns, for instance 'static.*'")
+    parser.add_argument("-o", "--output", default="benchmark_results.json", help="File in which results are written")
+    parser.add_argument("--compare", metavar="BASELINE", help="Results of a previous run to compare to")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="Ratio to the baseline above which a benchmark is a regression")
+    parser.add_argument("--min_delta", type=float, default=0.005,
+                        help="Slowdown in seconds below which a benchmark is never a regression")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+
+    args = parse_args(argv)
+    # Log records would be timed with the code that emits them
+    logging.disable(logging.INFO)
+    params = {"metabolites": args.metabolites, "conditions": args.conditions, "times": args.times,
+              "replicates": args.replicates, "isotopologues": args.isotopologues, "seed": args.seed}
+    suite = BenchmarkSuite(params, args.repeat, args.plot_metabolites, args.format, args.only)
+    with tempfile.TemporaryDirectory() as directory:
+        suite.run(directory)
+    current = suite.to_json()
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(current, f, indent=2)
+
+    baseline, ratios, regressions = None, {}, []
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline["parameters"] != current["parameters"]:
+            print(f"Warning: the baseline was run with other parameters ({baseline['parameters']})")
+        ratios, regressions = compare(current, baseline, args.threshold, args.min_delta)
+    for name, result in current["results"].items():
+        if "error" in result:
+            print(f"{name:<40} failed: {result['error']}")
+            continue
+        line = f"{name:<40} {result['median'] * 1000:>10.1f} ms"
+        if name in ratios:
+            line += f"  x{ratios[name]:.2f}" + ("  REGRESSION" if name in regressions else "")
+        print(line)
+    print(f"Results written to {args.output}")
+    if regressions:
+        print(f"{len(regressions)} regression(s) above x{args.threshold}: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
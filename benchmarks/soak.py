@@ -0,0 +1,260 @@
+"""
+Memory soak test of Isoplot. Thousands of plots are rendered in one process, as in a long-lived notebook kernel or
+worker, and the memory is measured around the plots of each type:
+
+    python -m benchmarks.soak --plots 200 --max_growth 20
+
+After a warm-up (font caches, lazy imports...), the resident memory must not grow by more than a bound while the plots
+are rendered, nor the memory traced by tracemalloc during the last plots. Otherwise the test exits with status 1, and
+the largest traced growths are reported to locate the leak.
+"""
+
+import argparse
+import gc
+import json
+import logging
+import os
+import sys
+import tempfile
+import tracemalloc
+
+from isoplot.main.dataprep import IsoplotData
+from isoplot.main.plots import StaticPlot, InteractivePlot, Map
+from isoplot.main.render import RenderTask, Renderer
+from isoplot.main.sinks import MemorySink
+from benchmarks.run import STATIC_METHODS, INTERACTIVE_METHODS, MAP_METHODS
+from benchmarks.synthetic import write_dataset
+
+MB = 1024 ** 2
+
+
+def resident_memory():
+    """Get the resident memory of the process in bytes, or None if it cannot be read (only on Linux)"""
+
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class SoakTest:
+    """
+    Memory growth of the process while plots of each type are rendered
+
+    :param params: parameters of the synthetic dataset (see benchmarks.synthetic.generate_dataset)
+    :type params: dict
+    :param plots: number of plots of each type to render after the warm-up
+    :type plots: int
+    :param warmup: number of plots of each type rendered before the memory is measured
+    :type warmup: int
+    :param fmt: format of the static plots
+    :type fmt: str
+    :param rtrn: should the plots be returned to the caller and dropped (as in the notebook API) instead of being
+                 written as by the command-line interface
+    :type rtrn: bool
+    :param traced: number of the last plots of each type rendered with tracemalloc, which slows the rendering down
+                   several times. A leak grows with each plot, so it shows in any window of plots
+    :type traced: int
+    :param only: names of the plot types to render ('static.barplot', 'map.build_heatmap'...), all if None
+    :type only: list of str
+    """
+
+    def __init__(self, params, plots=200, warmup=20, fmt="png", rtrn=False, traced=20, only=None):
+
+        self.params = params
+        self.plots = plots
+        self.warmup = warmup
+        self.fmt = fmt
+        self.rtrn = rtrn
+        self.traced = traced
+        self.only = only
+        self.results = {}
+
+    def get_cases(self, dataset, data_path):
+        """
+        Get the plot types to render, and the creation of data objects
+
+        :param dataset: prepared data
+        :type dataset: class: 'isoplot.main.dataprep.IsoplotData'
+        :param data_path: path to the data file of the dataset
+        :type data_path: class: 'pathlib.Path'
+        :return: name of each plot type and a function rendering its i-th plot
+        :rtype: list of tuple
+        """
+
+        conditions = list(dataset.dfmerge["condition"].unique())
+        times = list(dataset.dfmerge["time"].unique())
+        metabolites = sorted(dataset.dfmerge["metabolite"].unique())
+        renderer = Renderer(dataset, "soak", conditions, times, self.fmt, True, False, MemorySink())
+        # Notebooks create a data object for each dataset they load
+        cases = [("data.IsoplotData", lambda i: IsoplotData(str(data_path)))]
+
+        for kind, methods in (("static", STATIC_METHODS), ("interactive", INTERACTIVE_METHODS)):
+            for method, value in methods:
+                if self.rtrn:
+                    def render(i, kind=kind, method=method, value=value):
+                        metabolite = metabolites[i % len(metabolites)]
+                        if kind == "static":
+                            plot = StaticPlot(True, value, dataset, "soak", metabolite, conditions, times, self.fmt,
+                                              display=False, rtrn=True)
+                        else:
+                            plot = InteractivePlot(True, value, dataset, "soak", metabolite, conditions, times,
+                                                   display=False, rtrn=True)
+                        getattr(plot, method)()
+                else:
+                    def render(i, kind=kind, method=method, value=value):
+                        # The renderer keeps its plot and intermediates between the tasks of a metabolite
+                        renderer.sink = MemorySink()
+                        renderer.render(RenderTask(kind, method, method, metabolites[i % len(metabolites)], value))
+                cases.append((f"{kind}.{method}", render))
+
+        heatmap = Map(dataset, "soak", False, self.fmt, rtrn=self.rtrn)
+        for method in MAP_METHODS:
+            def render(i, method=method):
+                heatmap.sink = MemorySink()
+                getattr(heatmap, method)()
+            cases.append((f"map.{method}", render))
+        return [(name, render) for name, render in cases if self.only is None or name in self.only]
+
+    def run(self, directory):
+        """
+        Generate the dataset in a directory and render the plots
+
+        :param directory: directory of the dataset files
+        :type directory: str or class: 'pathlib.Path'
+        """
+
+        data_path, template_path = write_dataset(directory, **self.params)
+        dataset = IsoplotData(str(data_path))
+        dataset.get_data()
+        dataset.get_template(str(template_path))
+        dataset.merge_data()
+        dataset.prepare_data(export=None, build_tensor=True)
+
+        for name, render in self.get_cases(dataset, data_path):
+            self.results[name] = self.soak(render)
+            print(f"{name:<40} {self.format_result(self.results[name])}", flush=True)
+
+    def soak(self, render):
+        """
+        Measure the memory growth of the process while plots are rendered. The resident memory is measured after each
+        plot, and its growth between the lowest values of the first and of the last tenth of the plots, as the
+        allocator does not always give memory back to the system: a leak raises this floor.
+
+        :param render: function rendering the i-th plot
+        :return: number of plots, growth of the resident memory over all the plots and of the traced memory over the
+                 traced ones in bytes, and the largest traced growths
+        :rtype: dict
+        """
+
+        traced = min(self.traced, self.plots)
+        result = {"plots": self.plots, "traced_plots": traced, "rss_growth": None, "traced_growth": None, "top": []}
+        rss = []
+        try:
+            for i in range(self.warmup):
+                render(i)
+            gc.collect()
+            for i in range(self.plots):
+                if i == self.plots - traced:
+                    tracemalloc.start()
+                    snapshot = tracemalloc.take_snapshot()
+                render(self.warmup + i)
+                # Figures hold reference cycles, only the collector frees them
+                gc.collect()
+                rss.append(resident_memory())
+            gc.collect()
+            if traced:
+                differences = tracemalloc.take_snapshot().compare_to(snapshot, "lineno")
+                result["traced_growth"] = sum(difference.size_diff for difference in differences)
+                result["top"] = [str(difference) for difference in differences[:5] if difference.size_diff > 0]
+        except Exception as err:
+            return {"error": f"{type(err).__name__}: {err}"}
+        finally:
+            tracemalloc.stop()
+        window = max(self.plots // 10, 1)
+        if None not in rss:
+            result["rss_growth"] = min(rss[-window:]) - min(rss[:window])
+        return result
+
+    @staticmethod
+    def format_result(result):
+
+        if "error" in result:
+            return f"failed: {result['error']}"
+        line = f"{result['plots']} plots"
+        if result["rss_growth"] is not None:
+            line += f", RSS {result['rss_growth'] / MB:+.1f} MB"
+        if result["traced_growth"] is not None:
+            line += f", traced {result['traced_growth'] / MB:+.2f} MB"
+        return line
+
+    def check(self, max_growth, max_traced_growth):
+        """
+        Find the plot types for which the memory grew beyond the bounds
+
+        :param max_growth: maximum growth of the resident memory in MB
+        :type max_growth: float
+        :param max_traced_growth: maximum growth of the traced memory in MB
+        :type max_traced_growth: float
+        :return: names of the failing plot types
+        :rtype: list
+        """
+
+        failures = []
+        for name, result in self.results.items():
+            if "error" in result:
+                continue
+            if (result["rss_growth"] is not None and result["rss_growth"] > max_growth * MB) or \
+                    (result["traced_growth"] is not None and result["traced_growth"] > max_traced_growth * MB):
+                failures.append(name)
+        return failures
+
+
+def parse_args(argv=None):
+
+    parser = argparse.ArgumentParser("isoplot-soak", description="Memory soak test of Isoplot on synthetic data")
+    parser.add_argument("--metabolites", type=int, default=20, help="Number of metabolites of the dataset")
+    parser.add_argument("--conditions", type=int, default=4, help="Number of conditions of the dataset")
+    parser.add_argument("--times", type=int, default=3, help="Number of times of the dataset")
+    parser.add_argument("--replicates", type=int, default=3, help="Number of replicates of each condition and time")
+    parser.add_argument("--isotopologues", type=int, default=6,
+                        help="Maximum number of isotopologues of a metabolite")
+    parser.add_argument("--plots", type=int, default=200, help="Number of plots of each type to render")
+    parser.add_argument("--warmup", type=int, default=20, help="Number of plots of each type rendered first")
+    parser.add_argument("--format", default="png", help="Format of the static plots")
+    parser.add_argument("--rtrn", action="store_true", help="Return the plots instead of writing them")
+    parser.add_argument("--traced", type=int, default=20,
+                        help="Number of the last plots of each type traced with tracemalloc (0 to not trace)")
+    parser.add_argument("--only", nargs="+", metavar="PLOT", help="Plot types to render, for instance static.barplot")
+    parser.add_argument("--max_growth", type=float, default=20,
+                        help="Maximum growth of the resident memory in MB for each plot type")
+    parser.add_argument("--max_traced_growth", type=float, default=2,
+                        help="Maximum growth of the traced memory in MB for each plot type")
+    parser.add_argument("-o", "--output", help="File in which the results are written as json")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+
+    args = parse_args(argv)
+    logging.disable(logging.INFO)
+    params = {"metabolites": args.metabolites, "conditions": args.conditions, "times": args.times,
+              "replicates": args.replicates, "isotopologues": args.isotopologues}
+    test = SoakTest(params, args.plots, args.warmup, args.format, args.rtrn, args.traced, args.only)
+    with tempfile.TemporaryDirectory() as directory:
+        test.run(directory)
+    failures = test.check(args.max_growth, args.max_traced_growth)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"parameters": params, "results": test.results, "failures": failures}, f, indent=2)
+    for name in failures:
+        print(f"Memory grew beyond the bounds while rendering {name}. Largest traced growths:")
+        for line in test.results[name]["top"]:
+            print(f"    {line}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Module generating synthetic Isocor outputs and their templates, of any size"""
+
+import pathlib as pl
+
+import numpy as np
+import pandas as pd
+
+# Columns of an Isocor output file
+ISOCOR_COLUMNS = ["sample", "metabolite", "derivative", "isotopologue", "area", "corrected_area",
+                  "isotopologue_fraction", "residuum", "mean_enrichment"]
+
+
+def generate_dataset(metabolites=20, conditions=4, times=3, replicates=3, isotopologues=6, seed=0):
+    """
+    Generate an Isocor output and the template describing its samples. There is one sample per condition, time and
+    replicate. The number of isotopologues varies between metabolites, from 2 to isotopologues, like carbon chains of
+    different lengths. Fractions sum to 1 for each sample and metabolite and the mean enrichment is consistent with
+    them.
+
+    :param metabolites: number of metabolites
+    :type metabolites: int
+    :param conditions: number of conditions
+    :type conditions: int
+    :param times: number of times
+    :type times: int
+    :param replicates: number of replicates of each condition and time
+    :type replicates: int
+    :param isotopologues: maximum number of isotopologues of a metabolite
+    :type isotopologues: int
+    :param seed: seed of the random generator, the same parameters and seed give the same dataset
+    :type seed: int
+    :return: Isocor data and template
+    :rtype: tuple of class: 'pandas.DataFrame'
+    """
+
+    rng = np.random.default_rng(seed)
+    keys = [(condition, time, replicate) for condition in range(1, conditions + 1) for time in range(times)
+            for replicate in range(1, replicates + 1)]
+    template = pd.DataFrame(
+        [(f"010101_T{time}_C{condition}_{replicate}_{number}", f"C{condition}", condition, time, replicate, 1)
+         for number, (condition, time, replicate) in enumerate(keys, 1)],
+        columns=["sample", "condition", "condition_order", "time", "number_rep", "normalization"])
+
+    sizes = 2 + np.arange(metabolites) % max(isotopologues - 1, 1)
+    # One block of rows per sample, each block has the isotopologues of every metabolite
+    block_metabolites = np.repeat([f"M{i:04d}" for i in range(1, metabolites + 1)], sizes)
+    block_isotopologues = np.concatenate([np.arange(size) for size in sizes])
+    block_groups = np.repeat(np.arange(metabolites), sizes)
+    samples = len(template)
+    rows = samples * len(block_metabolites)
+    groups = np.repeat(np.arange(samples), len(block_metabolites)) * metabolites + np.tile(block_groups, samples)
+
+    # Fractions follow a flat Dirichlet distribution in each sample and metabolite
+    weights = rng.gamma(1.0, size=rows)
+    fractions = weights / np.bincount(groups, weights)[groups]
+    isotopologue = np.tile(block_isotopologues, samples)
+    size = np.tile(np.repeat(sizes, sizes), samples)
+    mean_enrichment = np.bincount(groups, isotopologue * fractions)[groups] / (size - 1)
+    corrected_area = rng.lognormal(14, 1.5, size=samples * metabolites)[groups] * fractions
+
+    data = pd.DataFrame({
+        "sample": np.repeat(template["sample"].to_numpy(), len(block_metabolites)),
+        "metabolite": np.tile(block_metabolites, samples),
+        "derivative": "",
+        "isotopologue": isotopologue,
+        "area": np.round(corrected_area * rng.uniform(0.95, 1.05, size=rows)),
+        "corrected_area": corrected_area,
+        "isotopologue_fraction": fractions,
+        "residuum": rng.normal(0, 1e-3, size=rows),
+        "mean_enrichment": mean_enrichment,
+    }, columns=ISOCOR_COLUMNS)
+    return data, template
+
+
+def write_dataset(directory, **params):
+    """
+    Generate a dataset (see generate_dataset) and write it like Isocor and the template generator do, in ';' separated
+    csv files
+
+    :param directory: directory in which the files are written
+    :type directory: str or class: 'pathlib.Path'
+    :param params: parameters of generate_dataset
+    :return: paths to the data file and to the template file
+    :rtype: tuple of class: 'pathlib.Path'
+    """
+
+    directory = pl.Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    data, template = generate_dataset(**params)
+    data_path, template_path = directory / "synthetic_res.csv", directory / "synthetic_template.csv"
+    data.to_csv(data_path, sep=";", index=False)
+    template.to_csv(template_path, sep=";", index=False)
+    return data_path, template_path
@@ -1,8 +1,110 @@
 """Logger module containing the Isoplot logger initialization"""
 
+import atexit
 import logging
+import logging.handlers
+import os
+import queue
+import threading
+
+FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 
 #Setup base logger
 
 logger = logging.getLogger("isoplot_log")
-logger.setLevel(logging.DEBUG)
\ No newline at end of file
+logger.setLevel(logging.DEBUG)
+
+# Handlers of the isoplot loggers, created once and shared by all of them (see configure_logging)
+_console = None
+_file = None
+_queue_handler = None
+_listener = None
+_lock = threading.Lock()
+
+
+def _attach(handlers):
+    """Attach handlers to the base logger, directly or through the queue"""
+
+    global _queue_handler, _listener
+
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    if _queue_handler is not None:
+        records = queue.Queue()
+        _queue_handler.queue = records
+        _listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+        _listener.start()
+        logger.addHandler(_queue_handler)
+    else:
+        for handler in handlers:
+            logger.addHandler(handler)
+
+
+def configure_logging(verbose=None, log_file=None, use_queue=None):
+    """
+    Configure the handlers of the isoplot loggers (all named isoplot_log.*). It can be called any number of times, by
+    the command-line interface and by each data object: the handlers are created once and updated, so that records are
+    never emitted twice. Arguments left to None keep their current setting.
+
+    With the queue, records are put in a queue by the thread that logs them and written by a listener thread, so that
+    the rendering does not wait for the console or the log file.
+
+    :param verbose: should debug records be emitted
+    :type verbose: bool
+    :param log_file: file to which records are also written, replacing the previous one. False to stop writing them
+    :type log_file: str or class: 'pathlib.Path'
+    :param use_queue: should records be written by a listener thread
+    :type use_queue: bool
+    """
+
+    global _console, _file, _queue_handler
+
+    with _lock:
+        changed, previous_file = False, _file
+        if _console is None:
+            _console = logging.StreamHandler()
+            _console.setFormatter(logging.Formatter(FORMAT))
+            _console.setLevel(logging.INFO)
+            changed = True
+        if log_file is False:
+            _file = None
+        elif log_file is not None and (_file is None or _file.baseFilename != os.path.abspath(log_file)):
+            _file = logging.FileHandler(log_file)
+            _file.setFormatter(logging.Formatter(FORMAT))
+            _file.setLevel(_console.level)
+        if verbose is not None:
+            for handler in [_console, _file]:
+                if handler is not None:
+                    handler.setLevel(logging.DEBUG if verbose else logging.INFO)
+        if use_queue is not None and use_queue != (_queue_handler is not None):
+            _queue_handler = logging.handlers.QueueHandler(queue.Queue()) if use_queue else None
+            changed = True
+        if changed or _file is not previous_file:
+            _attach([handler for handler in [_console, _file] if handler is not None])
+        # The records queued for the previous file are written when the listener stops, in _attach
+        if previous_file is not None and _file is not previous_file:
+            previous_file.close()
+
+
+def stop_logging():
+    """Write the records left in the queue, stop the listener thread and write the next records directly"""
+
+    if _queue_handler is not None:
+        configure_logging(use_queue=False)
+
+
+def _after_fork():
+    # The listener thread is not copied in a forked process, its records are written directly
+    global _listener, _queue_handler
+
+    if _queue_handler is not None:
+        _listener, _queue_handler = None, None
+        _attach([handler for handler in [_console, _file] if handler is not None])
+
+
+atexit.register(stop_logging)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,156 @@
+"""Module containing the cache of prepared data that is reused between command-line runs"""
+
+import hashlib
+import importlib.util
+import json
+import logging
+import os
+import pathlib as pl
+import shutil
+
+import isoplot
+
+
+class DataCache:
+    """
+    Persistent cache of prepared IsoplotData. Entries are keyed by a hash of the content of the data and template files
+    and of the options that change the prepared data. Each entry is a directory of binary columnar files. When the
+    cache grows beyond its maximum size, the least recently used entries are evicted.
+
+    :param cache_dir: directory of the cache. Defaults to $ISOPLOT_CACHE_DIR, or ~/.cache/isoplot
+    :type cache_dir: str or class: 'pathlib.Path'
+    :param max_size: maximum size of the cache in bytes
+    :type max_size: int
+    """
+
+    DEFAULT_MAX_SIZE = 2 * 1024 ** 3
+    CHUNK_SIZE = 1024 ** 2
+
+    def __init__(self, cache_dir=None, max_size=DEFAULT_MAX_SIZE):
+
+        if cache_dir is None:
+            cache_dir = os.environ.get("ISOPLOT_CACHE_DIR", pl.Path.home() / ".cache" / "isoplot")
+        self.cache_dir = pl.Path(cache_dir)
+        self.max_size = max_size
+        self.logger = logging.getLogger("isoplot_log.main.cache.DataCache")
+        # Entries are stored as feather files, which need pyarrow
+        self.enabled = importlib.util.find_spec("pyarrow") is not None
+        if not self.enabled:
+            self.logger.warning("pyarrow is not installed, the data cache is disabled")
+
+    @staticmethod
+    def hash_file(path, hasher):
+        """
+        Feed the content of a file to a hash object, chunk by chunk
+
+        :param path: path to the file
+        :type path: str or class: 'pathlib.Path'
+        :param hasher: hash object from hashlib
+        """
+
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(DataCache.CHUNK_SIZE), b""):
+                hasher.update(chunk)
+
+    def make_key(self, paths, options):
+        """
+        Build the key of an entry from the input files and the options
+
+        :param paths: input files (data and template)
+        :type paths: list
+        :param options: options that change the prepared data
+        :type options: dict
+        :return: hexadecimal key
+        :rtype: str
+        """
+
+        hasher = hashlib.sha256()
+        hasher.update(isoplot.__version__.encode())
+        for path in paths:
+            # The size delimits the content of each file, so that the same bytes split differently between the files
+            # give another key
+            hasher.update(f"{os.path.getsize(path)}:".encode())
+            DataCache.hash_file(path, hasher)
+        hasher.update(json.dumps(options, sort_keys=True).encode())
+        return hasher.hexdigest()
+
+    def load(self, key, data_object):
+        """
+        Load an entry into an IsoplotData object
+
+        :param key: key of the entry
+        :type key: str
+        :param data_object: object in which the prepared data is loaded
+        :type data_object: class: 'isoplot.main.dataprep.IsoplotData'
+        :return: True if the entry was found and loaded
+        :rtype: bool
+        """
+
+        entry = self.cache_dir / key
+        if not self.enabled or not entry.is_dir():
+            return False
+        try:
+            data_object.load_prepared(entry)
+        except Exception:
+            self.logger.warning(f"Cache entry {key} could not be read and is removed", exc_info=True)
+            shutil.rmtree(entry, ignore_errors=True)
+            return False
+        # The modification time of the entry records its last use for the eviction
+        os.utime(entry)
+        self.logger.info(f"Prepared data loaded from cache ({entry})")
+        return True
+
+    def store(self, key, data_object):
+        """
+        Store the prepared data of an IsoplotData object and evict old entries if the cache is too big
+
+        :param key: key of the entry
+        :type key: str
+        :param data_object: object containing the prepared data
+        :type data_object: class: 'isoplot.main.dataprep.IsoplotData'
+        """
+
+        if not self.enabled:
+            return
+        entry = self.cache_dir / key
+        # The entry is written in a temporary directory first so that concurrent runs never see partial entries
+        tmp_entry = self.cache_dir / f"{key}.tmp-{os.getpid()}"
+        try:
+            tmp_entry.mkdir(parents=True, exist_ok=True)
+            data_object.save_prepared(tmp_entry)
+            if entry.exists():
+                shutil.rmtree(entry, ignore_errors=True)
+            tmp_entry.rename(entry)
+        except Exception:
+            self.logger.warning("Prepared data could not be stored in cache", exc_info=True)
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+            return
+        self.logger.info(f"Prepared data stored in cache ({entry})")
+        self.evict(keep=key)
+
+    @staticmethod
+    def entry_size(entry):
+        """Get the size in bytes of the files of an entry"""
+
+        return sum(f.stat().st_size for f in entry.rglob("*") if f.is_file())
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used entries until the cache fits in its maximum size
+
+        :param keep: key of an entry that must not be evicted
+        :type keep: str
+        """
+
+        entries = [entry for entry in self.cache_dir.iterdir() if entry.is_dir() and ".tmp-" not in entry.name]
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        sizes = {entry: DataCache.entry_size(entry) for entry in entries}
+        total = sum(sizes.values())
+        for entry in entries:
+            if total <= self.max_size:
+                break
+            if entry.name == keep:
+                continue
+            self.logger.debug(f"Evicting cache entry {entry.name}")
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= sizes[entry]
@@ -1,15 +1,18 @@
 """Process that runs during Command-Line Interface usage"""
 
+import contextlib
 import datetime
 import os
 import logging
 from pathlib import Path
 import sys
 
+from isoplot.logger import configure_logging
+from isoplot.main.cache import DataCache
 from isoplot.main.dataprep import IsoplotData
-from isoplot.ui.isoplotcli import IsoplotCli
-from isoplot.ui.isoplot_notebook import check_version
-import isoplot.logger
+from isoplot.main.profiling import RunProfile
+from isoplot.ui.isoplotcli import IsoplotCli, parse_convert_args
+from isoplot.main.version import check_version
 
 # noinspection PyBroadException
 def main():
@@ -18,68 +21,95 @@ def main():
     cli = IsoplotCli()
     cli.initialize_cli()
     if not cli.args.galaxy:
-        # Initialize path to root directory (directory containing data file)
-        cli.home = Path(cli.args.input_path).parents[0]
-        os.chdir(cli.home)
-        # Get time and date for the run directory name
-        now = datetime.datetime.now()
-        date_time = now.strftime("%d%m%Y_%Hh%Mmn")
-        # Initialize run name and run directory
-        run_name = cli.args.run_name + "_" + date_time
-        cli.run_home = cli.home / run_name
-        cli.run_home.mkdir()
-    # Prepare logger
+        # Initialize path to root directory (directory containing the first data file)
+        cli.home = Path(cli.args.input_path[0]).parents[0]
+        if cli.args.resume:
+            # An interrupted run continues in its directory
+            cli.run_home = Path(cli.args.resume).resolve()
+        elif not cli.args.dry_run:
+            # Get time and date for the run directory name
+            now = datetime.datetime.now()
+            date_time = now.strftime("%d%m%Y_%Hh%Mmn")
+            # Initialize run name and run directory
+            run_name = cli.args.run_name + "_" + date_time
+            cli.run_home = cli.home / run_name
+            cli.run_home.mkdir()
+    # Prepare logger. Records are written by a listener thread, not by the thread that renders the plots
     logger = logging.getLogger("isoplot_log.main.cli_process")
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-    # If not in galaxy instance, then we create file handler for the logger (Galaxy redirects stderr to file already)
-    if not cli.args.galaxy:
-        fhandle = logging.FileHandler(cli.run_home / "run_info.txt")  # Log run info to txt file
-        fhandle.setFormatter(formatter)
-        logger.addHandler(fhandle)
-        if cli.args.verbose:
-            fhandle.setLevel(logging.DEBUG)
-        else:
-            fhandle.setLevel(logging.INFO)
-    handle = logging.StreamHandler()
-    handle.setFormatter(formatter)
-    logger.addHandler(handle)
-    if cli.args.verbose:
-        handle.setLevel(logging.DEBUG)
-    else:
-        handle.setLevel(logging.INFO)
-    # Start work
+    # If not in galaxy instance, then we log run info to a txt file (Galaxy redirects stderr to file already)
+    configure_logging(verbose=cli.args.verbose,
+                      log_file=cli.run_home / "run_info.txt" if cli.run_home is not None else None, use_queue=True)
+    # Stages and plots are measured with --profile. The profile is written with the outputs of the run (working
+    # directory in Galaxy), except in dry runs which write nothing
+    profile, profile_home = None, None
+    if cli.args.profile:
+        if not cli.args.dry_run:
+            profile_home = cli.run_home if cli.run_home is not None else Path.cwd()
+        stats_dir = profile_home / "profile_stats" if profile_home is not None and cli.args.profile_stats else None
+        profile = RunProfile(stats_dir)
+
+    def stage(name, stats=True):
+        return profile.stage(name, stats) if profile is not None else contextlib.nullcontext()
+
+    # The prepared data is exported to the run directory, or sent to stdout in Galaxy. A dry run does not export it
+    export = None if cli.args.dry_run else not cli.args.galaxy
+    # Start work. The Isocor columns that are not plotted are only read to be exported
     logger.debug("Generate Data Object")
-    try:
-        data = IsoplotData(cli.args.input_path, cli.args.verbose)
-        data.get_data()
-    except Exception as dataload_err:
-        raise RuntimeError(f"Error while loading data. \n Error: {dataload_err}")
+    data = IsoplotData(cli.args.input_path, cli.args.verbose, cli.args.compact, cli.args.float32,
+                       all_columns=export is not None)
+    build_tensor = cli.use_tensor()
+    # Prepared data can be reused from the cache when the same data, template and options were already prepared
+    cache, cache_key, cached = None, None, False
+    if cli.args.cache and cli.args.template_path and not cli.args.generate_template:
+        cache = DataCache(cli.args.cache_dir, cli.args.cache_size * 1024 ** 2)
+        try:
+            cache_key = cache.make_key(cli.args.input_path + [cli.args.template_path],
+                                       {"compact": cli.args.compact, "float32": cli.args.float32,
+                                        "all_columns": data.all_columns,
+                                        "build_tensor": build_tensor})
+            with stage("cache_load"):
+                cached = cache.load(cache_key, data)
+            logger.info("Prepared data loaded from cache" if cached else "Prepared data not found in cache")
+        except Exception:
+            logger.warning("Data cache could not be used", exc_info=True)
+            cache = None
+    if not cached:
+        try:
+            with stage("load_data"):
+                data.get_data()
+        except Exception as dataload_err:
+            raise RuntimeError(f"Error while loading data. \n Error: {dataload_err}")
     if cli.args.generate_template:
         logger.debug("Generating template")
         try:
-            data.generate_template()
+            data.generate_template(cli.home if cli.home is not None else os.getcwd())
         except Exception:
             logger.exception(f"There was an error while generating the template for the run {cli.args.run_name}.")
             sys.exit()
         else:
             logger.info(f"Template has been generated. Check destination folder at {cli.home}")
             sys.exit()
-    if not cli.args.galaxy:
-        os.chdir(cli.run_home)
-    if hasattr(cli.args, 'template_path'):
+    if cached:
+        with stage("export"):
+            data.export_data(export=export, destination=cli.run_home)
+    elif hasattr(cli.args, 'template_path'):
         try:
             logger.debug("Loading template")
-            data.get_template(cli.args.template_path)
+            with stage("load_template"):
+                data.get_template(cli.args.template_path)
             logger.debug("Merging data")
-            data.merge_data()
+            with stage("merge"):
+                data.merge_data()
             logger.debug("Preparing data")
-            if cli.args.galaxy:
-                data.prepare_data(export=False)  # Data export is sent through StringIO to stream
-            else:
-                data.prepare_data(export=True)
+            with stage("prepare"):
+                data.prepare_data(export=None, build_tensor=build_tensor)
+            with stage("export"):
+                data.export_data(export=export, destination=cli.run_home)
         except Exception:
             logger.exception("There was a problem while loading the template")
             sys.exit()
+        if cache is not None:
+            cache.store(cache_key, data)
     # Get lists of parameters for plots
     try:
         cli.metabolites = IsoplotCli.get_cli_input(cli.args.metabolite, "metabolite", data)
@@ -90,28 +120,55 @@ def main():
     logger.info("-------------------------------")
     logger.info("Cli has been initialized. Parameters are as follows")
     logger.info(f"Run name: {cli.args.run_name}")
-    logger.info(f"Input data path: {cli.args.input_path}")
+    logger.info(f"Input data path: {', '.join(cli.args.input_path)}")
     logger.info(f"Template path: {cli.args.template_path}")
     logger.info(f"Chosen format: {cli.args.format}")
     logger.info(f"Data to plot: {cli.args.value}")
     logger.info(f"Chosen metabolites: {cli.metabolites}")
     logger.info(f"Chosen conditions: {cli.conditions}")
     logger.info(f"Chosen times: {cli.times}")
-    if hasattr(cli.args, 'z'):
+    if cli.args.zip:
         logger.info(f"Zip: {cli.args.zip}")
+    logger.info(f"Rendering jobs: {cli.args.jobs}{' (threads)' if cli.args.threads else ''}")
     logger.info("-------------------------------")
+    if cli.args.dry_run:
+        print(cli.build_render_plan(cli.metabolites).summary(cli.args.jobs))
+        if profile is not None:
+            print(profile.summary())
+        return
     logger.info("Creating plots...")
     try:
-        if hasattr(cli.args, 'z'):
-            cli.plot_figs(cli.metabolites, data, build_zip=True)
-        else:
-            cli.plot_figs(cli.metabolites, data)
+        # The plots are profiled one by one, in their workers
+        with stage("render", stats=False):
+            if cli.args.zip:
+                cli.plot_figs(cli.metabolites, data, build_zip=True, profile=profile)
+            else:
+                cli.plot_figs(cli.metabolites, data, profile=profile)
     except Exception:
         logger.exception("There was a problem during the creation of the plots")
     else:
         logger.info("Plots created. Run is terminated")
         if not cli.args.galaxy:
             sys.exit()
+    finally:
+        if profile is not None:
+            profile.write(profile_home)
+            logger.info(f"Profile written to {profile_home / RunProfile.JSON_FILE}:\n{profile.summary()}")
+
+
+def convert():
+    """Convert an Isocor tsv/csv output to Parquet or Feather so that later runs load it faster"""
+
+    args = parse_convert_args().parse_args()
+    logger = logging.getLogger("isoplot_log.main.cli_process")
+    configure_logging()
+    try:
+        IsoplotData.convert_isocor_data(args.input_path, args.output_path)
+    except Exception:
+        logger.exception(f"There was a problem while converting {args.input_path}")
+        sys.exit(1)
+    logger.info(f"Data converted to {args.output_path}")
+
 
 if __name__ == "__main__":
     main()
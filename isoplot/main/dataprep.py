@@ -1,65 +1,304 @@
+from concurrent.futures import ThreadPoolExecutor
+import glob
+import importlib.util
 import io
+import json
 import logging
 import pathlib as pl
+import time
 
+import numpy as np
 import pandas as pd
 from natsort import natsorted
+from pandas.api.types import is_numeric_dtype
+
+from isoplot.logger import configure_logging
+from isoplot.main.version import parse_version
 
 
 class IsoplotData:
     """
     Class to prepare Isoplot Data for plotting
 
-    :param datapath: Path to .csv file containing Isocor output data
-    :type datapath: str
+    :param datapath: Path to .csv file containing Isocor output data. Can also be a glob pattern or a list of paths
+                     and patterns, in which case the files are read concurrently and concatenated
+    :type datapath: str or list
+    :param verbose: Should the logger be in debug mode. If not, the current level of the isoplot loggers is kept
+    :type verbose: bool
+    :param compact: Should the prepared data use the compact memory layout (categorical strings and small integers)
+    :type compact: bool
+    :param float32: Should the values be stored as float32 in compact mode
+    :type float32: bool
+    :param max_workers: Maximum number of threads used to read several data files. Defaults to the executor default
+    :type max_workers: int
+    :param all_columns: Should all the Isocor columns be read, to keep them in the Data_Export file. Otherwise only the
+                        columns used by Isoplot are read
+    :type all_columns: bool
     """
 
-    def __init__(self, datapath, verbose=False):
+    # Isocor columns used by Isoplot and their types. The other columns are only read to be exported.
+    ISOCOR_DTYPES = {'sample': str, 'metabolite': str, 'isotopologue': 'int64', 'area': 'float64',
+                     'corrected_area': 'float64', 'isotopologue_fraction': 'float64', 'mean_enrichment': 'float64'}
+    # Delimiters that Isocor outputs can be written with
+    DELIMITERS = ['\t', ';', ',']
+    # First pandas version with the pyarrow parser engine
+    PYARROW_ENGINE_PANDAS = (1, 4)
+    # Columnar file extensions and their format (these formats need pyarrow)
+    COLUMNAR_FORMATS = {'.parquet': 'parquet', '.pq': 'parquet', '.feather': 'feather', '.arrow': 'feather'}
+    # Values that can be plotted and for which replicate statistics are precomputed
+    PLOT_VALUES = ['corrected_area', 'isotopologue_fraction', 'mean_enrichment']
+    # Keys defining a group of replicates
+    REPLICATE_KEYS = ["condition_order", "condition", "time", "isotopologue"]
+    # Columns converted to categorical and to the smallest integer type in compact mode
+    CATEGORICAL_COLUMNS = ["sample", "metabolite", "condition", "ID"]
+    INTEGER_COLUMNS = ["isotopologue", "condition_order", "time", "number_rep"]
+    # Description of the files of a published dataset (see publish_shared)
+    SHARED_LABELS_FILE = "shared_labels.json"
+
+    def __init__(self, datapath, verbose=False, compact=False, float32=False, max_workers=None, all_columns=True):
 
         self.datapath = datapath
         self.verbose = verbose
+        self.compact = compact
+        self.float32 = float32
+        self.max_workers = max_workers
+        self.all_columns = all_columns
         self.data = None
         self.template = None
         self.dfmerge = None
+        self.partitions = None
+        self.replicate_stats = None
+        self.tensor = None
+        self.mean_enrichment = None
+        self.samples = None
 
-        self.isoplot_logger = logging.getLogger("Isoplot.dataprep.IsoplotData")
-        self.isoplot_logger.setLevel(logging.DEBUG)
-        stream_handle = logging.StreamHandler()
-        formatter = logging.Formatter(
-            '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        stream_handle.setFormatter(formatter)
-        if self.verbose:
-            stream_handle.setLevel(logging.DEBUG)
-        else:
-            stream_handle.setLevel(logging.INFO)
-        self.isoplot_logger.addHandler(stream_handle)
+        self.isoplot_logger = logging.getLogger("isoplot_log.main.dataprep.IsoplotData")
+        # The handlers are shared by the isoplot loggers and only created once (see isoplot.logger). Objects that are
+        # not verbose keep the level set before, such as the -v of the command-line interface
+        configure_logging(verbose=True if self.verbose else None)
 
         self.isoplot_logger.debug('Initializing IsoplotData object')
 
     @staticmethod
-    def load_isocor_data(path):
-        """Function to read incoming data"""
+    def sniff_delimiter(header):
+        """
+        Find the delimiter of a data file from its header line
+
+        :param header: first line of the file
+        :type header: str
+        :return: the delimiter giving the most columns
+        :rtype: str
+        """
+
+        return max(IsoplotData.DELIMITERS, key=header.count)
+
+    @staticmethod
+    def load_isocor_data(path, engine=None, all_columns=False):
+        """
+        Function to read incoming data. The delimiter is sniffed from the header line and the header is validated
+        before the file is parsed. Unless all_columns is set, only the columns used by Isoplot are read.
+
+        :param path: path to the Isocor output file (tsv or csv, or parquet/feather, see load_columnar_data)
+        :type path: str or class: 'pathlib.Path'
+        :param engine: pandas parser engine for text files. Defaults to 'pyarrow' when pyarrow is installed and pandas
+                       has this engine (1.4 or later), 'c' otherwise
+        :type engine: str
+        :param all_columns: Should the columns that Isoplot does not use (derivative, residuum...) also be read
+        :type all_columns: bool
+        :return: Isocor data
+        :rtype: class: 'pandas.DataFrame'
+        """
 
         datapath = pl.Path(path)
         if not datapath.is_file():
             raise ValueError("No data file selected")
+        if datapath.suffix.lower() in IsoplotData.COLUMNAR_FORMATS:
+            return IsoplotData.load_columnar_data(datapath, all_columns)
         try:
             with open(str(datapath), 'r', encoding='utf-8') as dp:
-                data = pd.read_csv(dp, sep='\t')
-                if len(data.columns) == 1:
-                    del data
-                    with open(str(datapath), 'r', encoding='utf-8') as dp:
-                        data = pd.read_csv(dp, sep=";")
+                header = dp.readline().rstrip("\r\n")
         except Exception as err:
             raise ValueError(f"Error during the lecture of the file {path}. Please make sure file is tsv or csv. "
                              f"Traceback: {err}")
-        to_check = ['sample', 'metabolite', 'isotopologue', 'area', 'corrected_area', 'isotopologue_fraction',
-                    'mean_enrichment']
-        for i in to_check:
-            if i not in data.columns:
+        sep = IsoplotData.sniff_delimiter(header)
+        columns = [col.strip('"') for col in header.split(sep)]
+        for i in IsoplotData.ISOCOR_DTYPES:
+            if i not in columns:
+                raise ValueError(f"Column {i} not found in data file {path}")
+        if engine is None:
+            engine = "pyarrow" if importlib.util.find_spec("pyarrow") is not None and \
+                parse_version(pd.__version__) >= IsoplotData.PYARROW_ENGINE_PANDAS else "c"
+        try:
+            data = pd.read_csv(str(datapath), sep=sep, encoding='utf-8', engine=engine,
+                               usecols=None if all_columns else list(IsoplotData.ISOCOR_DTYPES),
+                               dtype=IsoplotData.ISOCOR_DTYPES)
+        except Exception as err:
+            raise ValueError(f"Error during the lecture of the file {path}. Please make sure file is tsv or csv. "
+                             f"Traceback: {err}")
+        return data
+
+    @staticmethod
+    def load_columnar_data(path, all_columns=False):
+        """
+        Read Isocor data stored in a Parquet or Feather file. The file is memory-mapped and, unless all_columns is set,
+        only the columns used by Isoplot are read. The schema is validated before any data is read.
+
+        :param path: path to the .parquet/.pq or .feather/.arrow file
+        :type path: class: 'pathlib.Path'
+        :param all_columns: Should the columns that Isoplot does not use also be read
+        :type all_columns: bool
+        :return: Isocor data
+        :rtype: class: 'pandas.DataFrame'
+        """
+
+        if importlib.util.find_spec("pyarrow") is None:
+            raise ValueError(f"Reading {path.suffix} files requires pyarrow. Please install it and try again")
+        import pyarrow as pa
+        import pyarrow.feather as feather
+        import pyarrow.parquet as pq
+
+        columns = list(IsoplotData.ISOCOR_DTYPES)
+        try:
+            if IsoplotData.COLUMNAR_FORMATS[path.suffix.lower()] == "parquet":
+                schema = pq.read_schema(str(path), memory_map=True)
+            else:
+                with pa.memory_map(str(path)) as source:
+                    schema = pa.ipc.open_file(source).schema
+        except Exception as err:
+            raise ValueError(f"Error during the lecture of the file {path}. Please check file content and format. "
+                             f"Traceback: {err}")
+        for i in columns:
+            if i not in schema.names:
                 raise ValueError(f"Column {i} not found in data file {path}")
+        try:
+            selected = None if all_columns else columns
+            if IsoplotData.COLUMNAR_FORMATS[path.suffix.lower()] == "parquet":
+                table = pq.read_table(str(path), columns=selected, memory_map=True)
+            else:
+                table = feather.read_table(str(path), columns=selected, memory_map=True)
+            data = table.to_pandas().astype(
+                {col: dtype for col, dtype in IsoplotData.ISOCOR_DTYPES.items() if dtype is not str})
+        except Exception as err:
+            raise ValueError(f"Error during the lecture of the file {path}. Please check file content and format. "
+                             f"Traceback: {err}")
         return data
 
+    @staticmethod
+    def convert_isocor_data(path, destination):
+        """
+        Convert an Isocor output file (tsv or csv) to a Parquet or Feather file that loads much faster. All the
+        columns are converted, so that they are still exported
+
+        :param path: path to the Isocor output file
+        :type path: str or class: 'pathlib.Path'
+        :param destination: path of the converted file. Its extension gives the format (.parquet/.pq or
+                            .feather/.arrow)
+        :type destination: str or class: 'pathlib.Path'
+        """
+
+        destination = pl.Path(destination)
+        fmt = IsoplotData.COLUMNAR_FORMATS.get(destination.suffix.lower())
+        if fmt is None:
+            raise ValueError(f"Destination extension must be one of {list(IsoplotData.COLUMNAR_FORMATS)}")
+        if importlib.util.find_spec("pyarrow") is None:
+            raise ValueError(f"Writing {destination.suffix} files requires pyarrow. Please install it and try again")
+        data = IsoplotData.load_isocor_data(path, all_columns=True)
+        if fmt == "parquet":
+            data.to_parquet(destination, index=False)
+        else:
+            data.to_feather(destination)
+
+    @staticmethod
+    def resolve_datapaths(datapath):
+        """
+        Get the data files from a path, a glob pattern or a list of paths and patterns. Patterns are expanded in
+        natural order and the files are returned without duplicates in the order they were given.
+
+        :param datapath: path, pattern or list of paths and patterns
+        :type datapath: str, class: 'pathlib.Path' or list
+        :return: paths to the data files
+        :rtype: list
+        """
+
+        if isinstance(datapath, (str, pl.Path)):
+            datapath = [datapath]
+        paths = []
+        for path in datapath:
+            path = str(path)
+            if any(char in path for char in "*?["):
+                matches = natsorted(glob.glob(path))
+                if not matches:
+                    raise ValueError(f"No data file matches the pattern {path}")
+            else:
+                matches = [path]
+            paths += [match for match in matches if match not in paths]
+        if not paths:
+            raise ValueError("No data file selected")
+        return paths
+
+    @staticmethod
+    def concat_data(frames):
+        """
+        Concatenate data read from several files after checking that they share the same schema. Categorical columns
+        are given the union of the categories so that they stay categorical after concatenation.
+
+        :param frames: Isocor data of each file
+        :type frames: list of class: 'pandas.DataFrame'
+        :return: concatenated Isocor data
+        :rtype: class: 'pandas.DataFrame'
+        """
+
+        columns = list(frames[0].columns)
+        for frame in frames[1:]:
+            if list(frame.columns) != columns:
+                raise ValueError(f"Data files do not have the same columns: {columns} and {list(frame.columns)}")
+        frames = list(frames)
+        for col in columns:
+            if any(isinstance(frame[col].dtype, pd.CategoricalDtype) for frame in frames):
+                categories = pd.api.types.union_categoricals(
+                    [frame[col].astype("category") for frame in frames]).categories
+                frames = [frame.assign(**{col: pd.Categorical(frame[col], categories=categories)})
+                          for frame in frames]
+        return pd.concat(frames, ignore_index=True)
+
+    @staticmethod
+    def load_data_files(paths, max_workers=None, logger=None, all_columns=False):
+        """
+        Read several Isocor data files concurrently and concatenate them. The parsers release the GIL for most of the
+        work, so the files are read by a pool of threads.
+
+        :param paths: paths to the data files
+        :type paths: list
+        :param max_workers: maximum number of threads
+        :type max_workers: int
+        :param logger: logger to which the reading time of each file is reported
+        :type logger: class: 'logging.Logger'
+        :param all_columns: Should the columns that Isoplot does not use also be read
+        :type all_columns: bool
+        :return: concatenated Isocor data
+        :rtype: class: 'pandas.DataFrame'
+        """
+
+        def read(path):
+            start = time.perf_counter()
+            data = IsoplotData.load_isocor_data(path, all_columns=all_columns)
+            return data, time.perf_counter() - start
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(read, paths))
+        frames = [data for data, _ in results]
+        if logger is not None:
+            # The same sample in several files would be merged silently with the template, so it is reported
+            seen = {}
+            for path, (data, duration) in zip(paths, results):
+                logger.info(f"Read {path} ({len(data)} rows) in {duration:.3f}s")
+                for sample in data["sample"].unique():
+                    if sample in seen:
+                        logger.warning(f"Sample {sample} is present in both {seen[sample]} and {path}")
+                    else:
+                        seen[sample] = path
+        return IsoplotData.concat_data(frames)
+
     @staticmethod
     def load_template(template_input, excel_sheet=0):
         """Function to read incoming template data"""
@@ -111,13 +350,25 @@ class IsoplotData:
         self.isoplot_logger.info(f'Reading datafile {self.datapath} \n')
         try:
             self.isoplot_logger.debug(f"Isocor Data path: {self.datapath}")
-            self.data = IsoplotData.load_isocor_data(self.datapath)
+            paths = IsoplotData.resolve_datapaths(self.datapath)
+            if len(paths) == 1:
+                self.data = IsoplotData.load_isocor_data(paths[0], all_columns=self.all_columns)
+            else:
+                start = time.perf_counter()
+                self.data = IsoplotData.load_data_files(paths, self.max_workers, self.isoplot_logger,
+                                                        self.all_columns)
+                self.isoplot_logger.info(f"{len(paths)} data files loaded in {time.perf_counter() - start:.3f}s")
         except Exception:
             self.isoplot_logger.exception("Error while reading isocor data")
         self.isoplot_logger.info("Data is loaded")
 
-    def generate_template(self):
-        """Generate .xlsx template that user must fill"""
+    def generate_template(self, destination="."):
+        """
+        Generate .xlsx template that user must fill
+
+        :param destination: directory in which the template is written
+        :type destination: str or class: 'pathlib.Path'
+        """
 
         self.isoplot_logger.info("Generating template...")
 
@@ -129,10 +380,68 @@ class IsoplotData:
         metadata["time"] = 1
         metadata["number_rep"] = 3
         metadata["normalization"] = 1.0
-        metadata.to_excel(r'ModifyThis.xlsx', index=False)
+        metadata.to_excel(pl.Path(destination) / 'ModifyThis.xlsx', index=False)
 
         self.isoplot_logger.info('Template has been generated')
 
+    @staticmethod
+    def compute_replicate_stats(data, values, keys=None):
+        """
+        Compute the mean, standard deviation and number of replicates of the given values in one groupby pass
+
+        :param data: dataframe containing the values and the grouping columns
+        :type data: class: 'pandas.DataFrame'
+        :param values: columns for which statistics must be computed
+        :type values: list of str
+        :param keys: columns defining a group of replicates. Defaults to IsoplotData.REPLICATE_KEYS
+        :type keys: list of str
+        :return: statistics indexed by keys, with columns (value, statistic) where statistic is 'mean', 'std' or 'n'
+        :rtype: class: 'pandas.DataFrame'
+        """
+
+        if keys is None:
+            keys = IsoplotData.REPLICATE_KEYS
+        stats = data.groupby(keys, observed=True)[values].agg(["mean", "std", "count"])
+        stats = stats.rename(columns={"count": "n"}, level=1)
+        # With categorical keys, observed groups are not always returned sorted
+        stats.sort_index(inplace=True)
+        stats.columns.names = ["value", "statistic"]
+        return stats
+
+    @staticmethod
+    def compute_samples(data):
+        """
+        Get the table describing each sample ID: its condition, time and replicate, and the rank of the ID in natural
+        sort order.
+
+        :param data: prepared dataframe
+        :type data: class: 'pandas.DataFrame'
+        :return: table indexed by ID in template order (condition_order then ID)
+        :rtype: class: 'pandas.DataFrame'
+        """
+
+        samples = data.drop_duplicates(subset="ID")[["ID", "condition_order", "condition", "time", "number_rep"]]
+        samples = samples.sort_values(["condition_order", "ID"]).set_index("ID")
+        samples["id_rank"] = pd.Series(np.arange(len(samples)), index=natsorted(samples.index))
+        return samples
+
+    @staticmethod
+    def compute_mean_enrichment(data):
+        """
+        Get the mean_enrichment of each metabolite in each sample. Isocor repeats the mean_enrichment on every
+        isotopologue row, so only the first row of each (metabolite, ID) pair is kept.
+
+        :param data: prepared dataframe
+        :type data: class: 'pandas.DataFrame'
+        :return: table indexed by metabolite with one row per ID, sorted in template order inside each metabolite
+        :rtype: class: 'pandas.DataFrame'
+        """
+
+        mean_enrichment = data.drop_duplicates(subset=["metabolite", "ID"])[
+            ["metabolite", "ID", "condition_order", "condition", "time", "number_rep", "mean_enrichment"]]
+        mean_enrichment = mean_enrichment.sort_values(["metabolite", "condition_order", "ID"])
+        return mean_enrichment.set_index("metabolite")
+
     def get_template(self, path):
         """Read user-filled template and catch any encoding errors"""
 
@@ -169,8 +478,18 @@ class IsoplotData:
         else:
             self.isoplot_logger.info('Dataframes have been merged')
 
-    def prepare_data(self, export=True):
-        """Final cleaning of data and export"""
+    def prepare_data(self, export=True, build_tensor=False, destination="."):
+        """
+        Final cleaning of data and export
+
+        :param export: Should the prepared data be exported to file (otherwise it is printed to stdout). None skips
+                       the export
+        :type export: bool
+        :param build_tensor: Should the dense metabolite x ID x isotopologue x value tensor be built
+        :type build_tensor: bool
+        :param destination: directory in which the prepared data is exported
+        :type destination: str or class: 'pathlib.Path'
+        """
 
         self.isoplot_logger.debug('Preparing data after merge: normalizing...')
 
@@ -182,22 +501,406 @@ class IsoplotData:
         # Nous créons ici une colonne pour identifier chaque ligne avec condition+temps+numero de répétition
         # (possibilité de rajouter un tag metabolite plus tard si besoin)
         self.dfmerge.condition = self.dfmerge.condition.str.replace("_", "-")
-        self.dfmerge['ID'] = self.dfmerge['condition'].apply(str) + '_T' + self.dfmerge['time'].apply(str) + '_' + \
-                             self.dfmerge['number_rep'].apply(str)
+        self.dfmerge['ID'] = self.dfmerge['condition'].astype(str) + '_T' + self.dfmerge['time'].astype(str) + '_' + \
+                             self.dfmerge['number_rep'].astype(str)
 
         self.isoplot_logger.debug('Applying final transformations...')
 
-        # Vaut mieux ensuite retransformer les colonnes temps et number_rep en entiers pour
-        # éviter des problèmes éventuels de type
-        self.dfmerge['time'].apply(int)
-        self.dfmerge['number_rep'].apply(int)
         self.dfmerge.sort_values(['condition_order', 'condition'], inplace=True)
         self.dfmerge.fillna(0, inplace=True)
+        if self.compact:
+            self.compact_data()
+        self.build_indexes()
+        if build_tensor:
+            self.build_tensor()
+        self.export_data(export, destination)
+
+    def export_data(self, export=True, destination="."):
+        """
+        Export the prepared data to the Data_Export file, or print it to stdout
+
+        :param export: Should the prepared data be exported to file (otherwise it is printed to stdout). None skips
+                       the export
+        :type export: bool
+        :param destination: directory in which the Data_Export file is written
+        :type destination: str or class: 'pathlib.Path'
+        """
+
+        if export is None:
+            return
         if export:
-            self.dfmerge.to_csv(r"./Data_Export", sep=';', index=False)
+            self.dfmerge.to_csv(pl.Path(destination) / "Data_Export", sep=';', index=False)
             self.isoplot_logger.info('Data exported. Check Data_Export.csv')
         else:
             output = io.StringIO()
             self.dfmerge.to_csv(output, sep=';', index=False)
             output.seek(0)
             print(output.read())
+
+    def build_indexes(self):
+        """Build the partition index, the sample table, the replicate statistics and the mean_enrichment table"""
+
+        self.build_partitions()
+        self.build_samples()
+        self.build_replicate_stats()
+        self.build_mean_enrichment()
+
+    def save_prepared(self, directory):
+        """
+        Save the prepared data (and the tensor if it was built) to a directory, in binary columnar files
+
+        :param directory: existing directory where the files are written
+        :type directory: class: 'pathlib.Path'
+        """
+
+        self.dfmerge.reset_index(drop=True).to_feather(directory / "dfmerge.feather")
+        if self.tensor is not None:
+            self.tensor.save(directory)
+
+    def load_prepared(self, directory):
+        """
+        Load prepared data saved with save_prepared and rebuild the derived indexes. The tensor is memory-mapped.
+
+        :param directory: directory containing the saved files
+        :type directory: class: 'pathlib.Path'
+        """
+
+        self.isoplot_logger.debug(f"Loading prepared data from {directory}")
+        self.dfmerge = pd.read_feather(directory / "dfmerge.feather")
+        self.build_indexes()
+        if (directory / IsotopologueTensor.ARRAY_FILE).is_file():
+            self.tensor = IsotopologueTensor.load(directory, self.samples)
+
+    @staticmethod
+    def write_shared_array(values, path):
+        """
+        Write an array-like to a .npy file. Values that are not numeric are stored as categorical codes.
+
+        :param values: values to write
+        :type values: class: 'pandas.Series' or class: 'pandas.Index'
+        :param path: path of the .npy file
+        :type path: class: 'pathlib.Path'
+        :return: description of the values, needed to read them back with read_shared_array
+        :rtype: dict
+        """
+
+        if is_numeric_dtype(values.dtype) and not isinstance(values.dtype, pd.CategoricalDtype):
+            np.save(path, np.asarray(values))
+            return {"categories": None}
+        categorical = pd.Categorical(values)
+        np.save(path, categorical.codes)
+        return {"categories": categorical.categories.tolist(), "ordered": bool(categorical.ordered),
+                "categorical": isinstance(values.dtype, pd.CategoricalDtype)}
+
+    @staticmethod
+    def read_shared_array(path, labels):
+        """Read values written with write_shared_array as a read-only memory map (see write_shared_array)"""
+
+        array = np.load(path, mmap_mode="r")
+        if labels["categories"] is None:
+            return array
+        return pd.Categorical.from_codes(array, dtype=pd.CategoricalDtype(labels["categories"], labels["ordered"]))
+
+    @staticmethod
+    def write_shared_frame(frame, directory, name):
+        """
+        Write a dataframe as one .npy file per column and per index level so that it can be memory-mapped without
+        copy (see write_shared_array).
+
+        :param frame: dataframe to write
+        :type frame: class: 'pandas.DataFrame'
+        :param directory: existing directory where the files are written
+        :type directory: class: 'pathlib.Path'
+        :param name: prefix of the files
+        :type name: str
+        :return: description of the frame, needed to read it back with read_shared_frame
+        :rtype: dict
+        """
+
+        columns = [IsoplotData.write_shared_array(frame.iloc[:, i], directory / f"{name}_{i}.npy")
+                   for i in range(frame.shape[1])]
+        index = [IsoplotData.write_shared_array(frame.index.get_level_values(i), directory / f"{name}_index_{i}.npy")
+                 for i in range(frame.index.nlevels)]
+        return {"columns": columns, "names": frame.columns.tolist(), "column_names": list(frame.columns.names),
+                "index": index, "index_names": list(frame.index.names)}
+
+    @staticmethod
+    def read_shared_frame(directory, name, labels):
+        """
+        Read a dataframe written with write_shared_frame. The columns are read-only memory maps of the files.
+        String columns are categorical, string index levels keep their original type.
+
+        :param directory: directory containing the files
+        :type directory: class: 'pathlib.Path'
+        :param name: prefix of the files
+        :type name: str
+        :param labels: description of the frame returned by write_shared_frame
+        :type labels: dict
+        :rtype: class: 'pandas.DataFrame'
+        """
+
+        frame = pd.DataFrame({i: IsoplotData.read_shared_array(directory / f"{name}_{i}.npy", col)
+                              for i, col in enumerate(labels["columns"])}, copy=False)
+        names = [tuple(col) if isinstance(col, list) else col for col in labels["names"]]
+        if len(labels["column_names"]) > 1:
+            frame.columns = pd.MultiIndex.from_tuples(names, names=labels["column_names"])
+        else:
+            frame.columns = pd.Index(names, name=labels["column_names"][0])
+        levels = []
+        for i, level in enumerate(labels["index"]):
+            values = IsoplotData.read_shared_array(directory / f"{name}_index_{i}.npy", level)
+            if level["categories"] is not None and not level["categorical"]:
+                values = np.asarray(values, dtype=object)
+            levels.append(values)
+        if len(levels) == 1:
+            frame.index = pd.Index(levels[0], name=labels["index_names"][0])
+        else:
+            frame.index = pd.MultiIndex.from_arrays(levels, names=labels["index_names"])
+        return frame
+
+    def publish_shared(self, directory):
+        """
+        Publish the prepared data in a directory so that other processes can attach to it with attach_shared without
+        receiving a copy. The prepared dataframe, the derived tables and the partition index are written as raw
+        arrays that the processes memory-map read-only. Using a directory on a memory filesystem (e.g. /dev/shm)
+        avoids any disk access.
+
+        :param directory: existing directory where the files are written
+        :type directory: str or class: 'pathlib.Path'
+        """
+
+        directory = pl.Path(directory)
+        self.isoplot_logger.debug(f"Publishing prepared data in {directory}")
+        if self.partitions is None:
+            self.build_indexes()
+        labels = {"frames": {}, "partitions": {}}
+        for name in ["dfmerge", "samples", "mean_enrichment", "replicate_stats"]:
+            labels["frames"][name] = IsoplotData.write_shared_frame(getattr(self, name), directory, name)
+        # The positions of all metabolites are stored in one array, each metabolite is a slice of it
+        start = 0
+        for metabolite, positions in self.partitions.items():
+            labels["partitions"][str(metabolite)] = [start, start + len(positions)]
+            start += len(positions)
+        np.save(directory / "partitions.npy",
+                np.concatenate(list(self.partitions.values())) if self.partitions else np.array([], dtype=np.intp))
+        if self.tensor is not None:
+            self.tensor.save(directory)
+        with open(directory / IsoplotData.SHARED_LABELS_FILE, "w", encoding="utf-8") as f:
+            json.dump(labels, f)
+
+    def attach_shared(self, directory):
+        """
+        Attach to prepared data published with publish_shared. Nothing is copied: the data is memory-mapped read-only.
+
+        :param directory: directory containing the published files
+        :type directory: str or class: 'pathlib.Path'
+        """
+
+        directory = pl.Path(directory)
+        self.isoplot_logger.debug(f"Attaching to prepared data in {directory}")
+        with open(directory / IsoplotData.SHARED_LABELS_FILE, "r", encoding="utf-8") as f:
+            labels = json.load(f)
+        for name, frame_labels in labels["frames"].items():
+            setattr(self, name, IsoplotData.read_shared_frame(directory, name, frame_labels))
+        positions = np.load(directory / "partitions.npy", mmap_mode="r")
+        self.partitions = {metabolite: positions[start:stop]
+                           for metabolite, (start, stop) in labels["partitions"].items()}
+        if (directory / IsotopologueTensor.ARRAY_FILE).is_file():
+            self.tensor = IsotopologueTensor.load(directory, self.samples)
+
+    def compact_data(self):
+        """
+        Convert the prepared dataframe to a compact memory layout: string columns become categorical, integer columns
+        are downcast to the smallest integer type and, if the float32 option is set, values are stored as float32.
+        """
+
+        before = self.dfmerge.memory_usage(deep=True).sum()
+        for col in IsoplotData.CATEGORICAL_COLUMNS:
+            if col in self.dfmerge.columns:
+                self.dfmerge[col] = self.dfmerge[col].astype("category")
+        for col in IsoplotData.INTEGER_COLUMNS:
+            if col in self.dfmerge.columns:
+                self.dfmerge[col] = pd.to_numeric(self.dfmerge[col], downcast="integer")
+        if self.float32:
+            for col in self.dfmerge.select_dtypes(include="float64").columns:
+                self.dfmerge[col] = self.dfmerge[col].astype("float32")
+        after = self.dfmerge.memory_usage(deep=True).sum()
+        self.isoplot_logger.info(f"Compact mode: memory usage went from {before / 1e6:.1f} MB "
+                                 f"to {after / 1e6:.1f} MB")
+
+    def build_partitions(self):
+        """
+        Index the row positions of each metabolite in the prepared dataframe. The plots can then get their
+        metabolite's rows directly instead of scanning the whole dataframe each time.
+        """
+
+        self.isoplot_logger.debug("Building metabolite partition index...")
+        self.partitions = self.dfmerge.groupby("metabolite", sort=False, observed=True).indices
+
+    def build_replicate_stats(self):
+        """
+        Compute the replicate statistics cube of the plotted values for all metabolites at once. The cube is indexed by
+        (metabolite, condition_order, condition, time, isotopologue) and has (value, statistic) columns.
+        """
+
+        self.isoplot_logger.debug("Computing replicate statistics...")
+        values = [value for value in IsoplotData.PLOT_VALUES if value in self.dfmerge.columns]
+        self.replicate_stats = IsoplotData.compute_replicate_stats(
+            self.dfmerge, values, ["metabolite"] + IsoplotData.REPLICATE_KEYS)
+
+    def build_samples(self):
+        """Build the table describing each sample ID of the prepared data"""
+
+        self.isoplot_logger.debug("Building sample table...")
+        self.samples = IsoplotData.compute_samples(self.dfmerge)
+
+    def build_mean_enrichment(self):
+        """Build the per-sample mean_enrichment table of all metabolites"""
+
+        self.isoplot_logger.debug("Building mean_enrichment table...")
+        self.mean_enrichment = IsoplotData.compute_mean_enrichment(self.dfmerge)
+
+    def build_tensor(self):
+        """Build the dense tensor of the plotted values for all metabolites, IDs and isotopologues"""
+
+        self.isoplot_logger.debug("Building value tensor...")
+        values = [value for value in IsoplotData.PLOT_VALUES if value in self.dfmerge.columns]
+        self.tensor = IsotopologueTensor.from_dataframe(self.dfmerge, values, self.samples)
+        self.isoplot_logger.debug(f"Value tensor shape: {self.tensor.array.shape}")
+
+    def get_metabolite_data(self, metabolite):
+        """
+        Get the rows of the prepared dataframe that belong to one metabolite
+
+        :param metabolite: metabolite to get the data for
+        :type metabolite: str
+        :return: slice of the prepared dataframe containing only the metabolite's rows
+        :rtype: class: 'pandas.DataFrame'
+        """
+
+        if self.partitions is None:
+            self.build_partitions()
+        try:
+            positions = self.partitions[metabolite]
+        except KeyError:
+            raise KeyError(f"Metabolite {metabolite} not found in prepared data")
+        return self.dfmerge.iloc[positions]
+
+
+class IsotopologueTensor:
+    """
+    Dense array of the plotted values with shape (metabolite, ID, isotopologue, value). The ID axis is in template
+    order (condition_order then ID) and missing combinations are NaN.
+
+    :param array: 4 dimensional array containing the values
+    :type array: class: 'numpy.ndarray'
+    :param metabolites: labels of the metabolite axis
+    :type metabolites: class: 'pandas.Index'
+    :param ids: labels of the ID axis, indexed by ID with at least the condition and time of each ID (see
+                IsoplotData.compute_samples)
+    :type ids: class: 'pandas.DataFrame'
+    :param isotopologues: labels of the isotopologue axis
+    :type isotopologues: class: 'pandas.Index'
+    :param values: labels of the value axis
+    :type values: list of str
+    """
+
+    ARRAY_FILE = "tensor.npy"
+    LABELS_FILE = "tensor_labels.json"
+
+    def __init__(self, array, metabolites, ids, isotopologues, values):
+
+        self.array = array
+        self.metabolites = metabolites
+        self.ids = ids
+        self.isotopologues = isotopologues
+        self.values = values
+
+    @classmethod
+    def from_dataframe(cls, data, values, samples=None):
+        """
+        Build the tensor from the prepared dataframe. Duplicated entries are meaned (same behaviour as pivot_table).
+
+        :param data: prepared dataframe
+        :type data: class: 'pandas.DataFrame'
+        :param values: value columns to put in the tensor
+        :type values: list of str
+        :param samples: sample table of the data used as ID axis. Computed from data if not given
+        :type samples: class: 'pandas.DataFrame'
+        """
+
+        ids = IsoplotData.compute_samples(data) if samples is None else samples
+        metabolites = pd.Index(np.sort(np.asarray(data["metabolite"].unique())), name="metabolite")
+        isotopologues = pd.Index(np.sort(np.asarray(data["isotopologue"].unique())), name="isotopologue")
+
+        grouped = data.groupby(["metabolite", "ID", "isotopologue"], observed=True)[values].mean()
+        array = np.full((len(metabolites), len(ids), len(isotopologues), len(values)), np.nan,
+                        dtype=np.result_type(*grouped.dtypes, np.float32))
+        array[metabolites.get_indexer(grouped.index.get_level_values("metabolite")),
+              ids.index.get_indexer(grouped.index.get_level_values("ID")),
+              isotopologues.get_indexer(grouped.index.get_level_values("isotopologue"))] = grouped.to_numpy()
+        return cls(array, metabolites, ids, isotopologues, values)
+
+    def save(self, directory):
+        """
+        Save the array and its axis labels to a directory
+
+        :param directory: existing directory where the files are written
+        :type directory: class: 'pathlib.Path'
+        """
+
+        np.save(directory / IsotopologueTensor.ARRAY_FILE, self.array)
+        labels = {"metabolites": self.metabolites.tolist(),
+                  "ids": self.ids.index.tolist(),
+                  "isotopologues": self.isotopologues.tolist(),
+                  "values": self.values}
+        with open(directory / IsotopologueTensor.LABELS_FILE, "w", encoding="utf-8") as f:
+            json.dump(labels, f)
+
+    @classmethod
+    def load(cls, directory, samples, mmap_mode="r"):
+        """
+        Load a tensor saved with save. The array is memory-mapped read-only by default.
+
+        :param directory: directory containing the saved files
+        :type directory: class: 'pathlib.Path'
+        :param samples: sample table of the data (see IsoplotData.compute_samples)
+        :type samples: class: 'pandas.DataFrame'
+        :param mmap_mode: numpy memory-map mode, None to read the array in memory
+        :type mmap_mode: str
+        """
+
+        with open(directory / IsotopologueTensor.LABELS_FILE, "r", encoding="utf-8") as f:
+            labels = json.load(f)
+        array = np.load(directory / IsotopologueTensor.ARRAY_FILE, mmap_mode=mmap_mode)
+        return cls(array,
+                   pd.Index(labels["metabolites"], name="metabolite"),
+                   samples.reindex(labels["ids"]),
+                   pd.Index(labels["isotopologues"], name="isotopologue"),
+                   labels["values"])
+
+    def get_matrix(self, metabolite, value, conditions, times):
+        """
+        Get the ID x isotopologue table of one metabolite and value, restricted to the given conditions and times.
+        IDs and isotopologues for which the metabolite has no data are dropped.
+
+        :param metabolite: metabolite to get
+        :type metabolite: str
+        :param value: value to get
+        :type value: str
+        :param conditions: conditions to keep
+        :type conditions: list
+        :param times: times to keep
+        :type times: list
+        :return: table indexed by ID (in template order) with one column per isotopologue
+        :rtype: class: 'pandas.DataFrame'
+        """
+
+        matrix = self.array[self.metabolites.get_loc(metabolite), :, :, self.values.index(value)]
+        keep = (self.ids["condition"].isin(conditions) & self.ids["time"].isin(times)).to_numpy()
+        missing = np.isnan(matrix)
+        keep &= ~missing.all(axis=1)
+        columns = ~missing[keep].all(axis=0)
+        return pd.DataFrame(matrix[np.ix_(keep, columns)],
+                            index=self.ids.index[keep],
+                            columns=self.isotopologues[columns])
@@ -0,0 +1,113 @@
+"""Module containing the manifest of the outputs of a run, used to skip the plots that are already rendered"""
+
+import json
+import logging
+import os
+import pathlib as pl
+import shutil
+
+from isoplot.main.sinks import DirectorySink
+
+
+class RenderManifest:
+    """
+    Record of the files written by the render tasks of a run, in a json lines file of the run directory. Each line
+    gives the key of a task (see Renderer.task_key) and the files it wrote, relative to the run directory. Lines are
+    appended as soon as a task is rendered, so the manifest of a run that was interrupted lists the plots it had
+    finished.
+
+    :param directory: run directory
+    :type directory: str or class: 'pathlib.Path'
+    """
+
+    FILE_NAME = "render_manifest.jsonl"
+
+    def __init__(self, directory):
+
+        self.directory = pl.Path(directory)
+        self.path = self.directory / RenderManifest.FILE_NAME
+        self.logger = logging.getLogger("isoplot_log.main.manifest.RenderManifest")
+        self.entries = self.read_entries()
+
+    def read_entries(self):
+        """
+        Read the entries of the manifest file
+
+        :return: files of each task key
+        :rtype: dict
+        """
+
+        entries = {}
+        # A killed run can leave an incomplete last line, the next entry must not be appended to it
+        self.complete = True
+        if not self.path.is_file():
+            return entries
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                self.complete = line.endswith("\n")
+                try:
+                    entry = json.loads(line)
+                    entries[entry["key"]] = entry["files"]
+                except (ValueError, KeyError):
+                    self.logger.debug(f"Skipping invalid line of {self.path}")
+        return entries
+
+    def lookup(self, key):
+        """
+        Get the files of a task if it is in the manifest and its files still exist
+
+        :param key: key of the task
+        :type key: str
+        :return: names of the files, or None if the task must be rendered
+        :rtype: list
+        """
+
+        files = self.entries.get(key)
+        if not files or not all((self.directory / name).is_file() for name in files):
+            return None
+        return files
+
+    def record(self, key, task, files):
+        """
+        Append a rendered task to the manifest
+
+        :param key: key of the task
+        :type key: str
+        :param task: the task
+        :type task: class: 'isoplot.main.render.RenderTask'
+        :param files: names of the files written by the task, relative to the run directory
+        :type files: list
+        """
+
+        with open(self.path, "a", encoding="utf-8") as f:
+            if not self.complete:
+                f.write("\n")
+                self.complete = True
+            f.write(json.dumps({"key": key, "task": repr(task), "files": files}) + "\n")
+        self.entries[key] = files
+
+    def copy_files(self, files, sink):
+        """
+        Copy files of the run to a sink. Files are hard-linked into directory sinks when possible.
+
+        :param files: names of the files, relative to the run directory
+        :type files: list
+        :param sink: destination of the files
+        :type sink: class: 'isoplot.main.sinks.OutputSink'
+        """
+
+        for name in files:
+            source = self.directory / name
+            if isinstance(sink, DirectorySink):
+                destination = sink.path(name)
+                if destination.resolve() == source.resolve():
+                    continue
+                destination.parent.mkdir(parents=True, exist_ok=True)
+                if destination.exists():
+                    destination.unlink()
+                try:
+                    os.link(source, destination)
+                except OSError:
+                    shutil.copyfile(source, destination)
+            else:
+                sink.write(name, source.read_bytes())
@@ -1,12 +1,21 @@
 """Module containing the plotting classes. The methods correspond to different types of plots to create"""
 
+import contextlib
+import io
+import os
+import threading
+
 try:
     import numpy as np
     import matplotlib.pyplot as plt
+    from matplotlib.artist import setp
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
     import seaborn as sns
     import pandas as pd
-    from natsort import natsorted
-    from bokeh.plotting import figure, output_file, show, save
+    from bokeh.plotting import figure, show
+    from bokeh.embed import file_html
+    from bokeh.resources import CDN
     from bokeh.models import Whisker, BasicTicker, ColorBar, LinearColorMapper, PrintfTickFormatter
     import colorcet as cc
     import bokeh as bk
@@ -20,6 +29,103 @@ else:
     if __name__ == '__main__':
         print("Modules have been loaded")
 
+from isoplot.main.dataprep import IsoplotData
+from isoplot.main.sinks import DirectorySink
+
+# Matplotlib reads its global rcParams when artists are created and when they are drawn, so figures are built and
+# saved one at a time
+STYLE_LOCK = threading.RLock()
+
+
+@contextlib.contextmanager
+def figure_style(context=None, font_scale=None):
+    """
+    Build and save a figure with a seaborn style. The rcParams are restored on exit and other threads wait while the
+    style is applied, so that plots do not depend on each other. Figures must be saved in the block: drawing also reads
+    the rcParams, which another thread could have changed once the block is left.
+
+    :param context: seaborn plotting context ('paper', 'notebook', 'talk' or 'poster')
+    :type context: str
+    :param font_scale: if given, the seaborn theme is set with this font scale
+    :type font_scale: float
+    """
+
+    with STYLE_LOCK, plt.rc_context():
+        if font_scale is not None:
+            sns.set(font_scale=font_scale)
+        if context is not None:
+            sns.set_context(context)
+        yield
+
+
+def new_figure(figsize, pyplot=False):
+    """
+    Create a matplotlib figure. Figures drawn by their own Agg canvas are not registered in pyplot: several threads
+    can draw them at once, and they are freed as soon as they are no longer referenced.
+
+    :param figsize: size of the figure in inches
+    :type figsize: tuple
+    :param pyplot: should the figure be created through pyplot (needed to display it)
+    :type pyplot: bool
+    :rtype: class: 'matplotlib.figure.Figure'
+    """
+
+    if pyplot:
+        return plt.figure(figsize=figsize)
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def save_figure(sink, fig, name, fmt):
+    """
+    Write a matplotlib figure to an output sink
+
+    :param sink: destination of the file
+    :type sink: class: 'isoplot.main.sinks.OutputSink'
+    :param fig: figure to write
+    :type fig: class: 'matplotlib.figure.Figure'
+    :param name: name of the file
+    :type name: str
+    :param fmt: format of the file
+    :type fmt: str
+    """
+
+    buf = io.BytesIO()
+    fig.savefig(buf, bbox_inches='tight', format=fmt)
+    sink.write(name, buf.getvalue())
+
+
+def release_figure(fig):
+    """
+    Free the memory of a figure that was saved and is no longer used. Figures hold reference cycles, so they are only
+    freed by the garbage collector: in long runs, dead figures and their pixel buffers (36 MB for a heatmap) pile up
+    between its collections.
+
+    :param fig: figure to release
+    :type fig: class: 'matplotlib.figure.Figure'
+    """
+
+    fig.clear()
+    # The canvas keeps the renderer of the last draw, and its pixel buffer
+    vars(fig.canvas).pop("renderer", None)
+
+
+def save_html(sink, plot, name, title):
+    """
+    Write a bokeh plot as a standalone html file to an output sink
+
+    :param sink: destination of the file
+    :type sink: class: 'isoplot.main.sinks.OutputSink'
+    :param plot: plot to write
+    :param name: name of the file
+    :type name: str
+    :param title: title of the html document
+    :type title: str
+    """
+
+    sink.write(name, file_html(plot, CDN, title))
+
 
 class Plot:
     """
@@ -29,8 +135,10 @@ class Plot:
     :type stack: Bool
     :param value: Data to be plotted. Can be 'isotopologue_fraction', 'corrected area' or 'mean_enrichment'
     :type value: str
-    :param data: IsoplotData object containing clean data
-    :type data: Pandas Dataframe
+    :param data: IsoplotData object containing clean data, or the clean dataframe itself. When an IsoplotData
+                 object is given, the metabolite's rows are taken from its partition index instead of filtering
+                 the whole dataframe
+    :type data: class: 'isoplot.main.dataprep.IsoplotData' or Pandas Dataframe
     :param name: Name for generated file directory where plots will go
     :type name: str
     :param metabolite: metabolite to be plotted
@@ -43,66 +151,204 @@ class Plot:
     :type display: Bool
     :param rtrn: Should figure object be returned or not
     :type rtrn: Bool
+    :param sink: Destination of the created files. Defaults to the working directory at creation
+    :type sink: class: 'isoplot.main.sinks.OutputSink'
+    :param intermediates: Tables computed from the data (filtered data, pivots, statistics), shared by the plots of
+                          the same data, metabolite, conditions and times so that they are computed once
+    :type intermediates: dict
     """
 
     WIDTH = 1080
     HEIGHT = 640
 
-    def __init__(self, stack, value, data, name, metabolite, condition, time, display, rtrn=False):
+    def __init__(self, stack, value, data, name, metabolite, condition, time, display, rtrn=False, sink=None,
+                 intermediates=None):
 
         self.stack = stack
         self.value = value
-        self.data = data
         self.name = name
         self.metabolite = metabolite
         self.condition = condition
         self.time = time
         self.display = display
         self.rtrn = rtrn
-        self.filtered_data = self.data[
-            (self.data['metabolite'] == self.metabolite) &
-            (self.data['condition'].isin(self.condition)) &
-            (self.data['time'].isin(self.time))]
+        self.sink = sink if sink is not None else DirectorySink(os.getcwd())
+        self.intermediates = intermediates if intermediates is not None else {}
+        if isinstance(data, IsoplotData):
+            self.dataset = data
+            self.data = data.dfmerge
+        else:
+            self.dataset = None
+            self.data = data
+        if "filtered_data" not in self.intermediates:
+            if self.dataset is not None:
+                metabolite_data = self.dataset.get_metabolite_data(self.metabolite)
+            else:
+                metabolite_data = self.data[self.data['metabolite'] == self.metabolite]
+            self.intermediates["filtered_data"] = metabolite_data[
+                (metabolite_data['condition'].isin(self.condition)) &
+                (metabolite_data['time'].isin(self.time))]
+        self.filtered_data = self.intermediates["filtered_data"]
+
+    def shared(self, key, compute):
+        """
+        Get an intermediate table, computed on first use. A shallow copy is returned so that callers can relabel it.
 
-    @staticmethod
-    def split_ids(ids):
+        :param key: key of the table in the intermediates
+        :param compute: function computing the table
+        :rtype: class: 'pandas.DataFrame'
         """
-        Function to split IDs and get back lists of conditions, times and replicates in order
 
-        :param ids: IDs generated by IsoplotData Object
-        :type ids: list
-        :return: lists containing conditions, times and replicates
-        :rtype: lists
+        if key not in self.intermediates:
+            self.intermediates[key] = compute()
+        return self.intermediates[key].copy(deep=False)
+
+    def get_replicate_stats(self, value=None):
+        """
+        Get the replicate statistics of the plotted metabolite for the selected conditions and times. They are read
+        from the statistics cube of the IsoplotData object when available, otherwise computed on the filtered data.
+
+        :param value: value for which the statistics are needed. Defaults to the plotted value
+        :type value: str
+        :return: statistics indexed by (condition_order, condition, time, isotopologue) with columns mean, std and n
+        :rtype: class: 'pandas.DataFrame'
         """
 
-        count = ids[0].count('_')
+        if value is None:
+            value = self.value
+        return self.shared(("replicate_stats", value), lambda: self.compute_replicate_stats(value))
 
-        if count == 2:
+    def compute_replicate_stats(self, value):
+        """Read or compute the replicate statistics of a value (see get_replicate_stats)"""
 
-            conditions, times, replicates = [], [], []
+        cube = self.dataset.replicate_stats if self.dataset is not None else None
+        if cube is None or value not in cube.columns.get_level_values("value"):
+            return IsoplotData.compute_replicate_stats(self.filtered_data, [value])[value]
+        stats = cube.loc[self.metabolite][value]
+        return stats[(stats.index.get_level_values("condition").isin(self.condition)) &
+                     (stats.index.get_level_values("time").isin(self.time))]
 
-            for i in ids:
-                c, t, r = i.split("_")
-                conditions.append(c)
-                times.append(t)
-                replicates.append(r)
+    def get_pivot(self):
+        """
+        Get the values of the plotted metabolite as an ID x isotopologue table in template order. The table is read
+        from the tensor of the IsoplotData object when it was built, otherwise it is pivoted from the filtered data.
 
-            return conditions, times, replicates
+        :return: table indexed by ID with one column per isotopologue
+        :rtype: class: 'pandas.DataFrame'
+        """
 
-        if count == 1:
+        return self.shared(("pivot", self.value), self.compute_pivot)
 
-            conditions, times = [], []
+    def compute_pivot(self):
+        """Read or compute the ID x isotopologue table of the plotted value (see get_pivot)"""
 
-            for i in ids:
-                c, t = i.split("_")
-                conditions.append(c)
-                times.append(t)
+        tensor = self.dataset.tensor if self.dataset is not None else None
+        if tensor is not None and self.value in tensor.values:
+            return tensor.get_matrix(self.metabolite, self.value, self.condition, self.time)
+        pivot = self.filtered_data.pivot_table(index=["condition_order", 'ID'],
+                                               columns='isotopologue',
+                                               values=self.value)
+        pivot.sort_index(level="condition_order", inplace=True)
+        return pivot.droplevel(level="condition_order")
 
-            return conditions, times
+    def get_mean_enrichment(self):
+        """
+        Get the per-sample mean_enrichment of the plotted metabolite for the selected conditions and times. It is read
+        from the mean_enrichment table of the IsoplotData object when available, otherwise computed on the filtered
+        data.
+
+        :return: table indexed by ID in template order, with condition_order, condition, time, number_rep and
+                 mean_enrichment columns
+        :rtype: class: 'pandas.DataFrame'
+        """
 
+        return self.shared("mean_enrichment", self.compute_mean_enrichment)
+
+    def compute_mean_enrichment(self):
+        """Read or compute the per-sample mean_enrichment table (see get_mean_enrichment)"""
+
+        table = self.dataset.mean_enrichment if self.dataset is not None else None
+        if table is None:
+            table = IsoplotData.compute_mean_enrichment(self.filtered_data)
         else:
+            table = table.loc[self.metabolite:self.metabolite]
+            table = table[(table['condition'].isin(self.condition)) & (table['time'].isin(self.time))]
+        return table.set_index("ID")
 
-            raise ValueError('Number of underscores is different from 2 or 3')
+    def get_samples(self):
+        """
+        Get the sample table (condition, time, replicate and natural sort rank of each ID). It is read from the
+        IsoplotData object when available, otherwise computed on the filtered data.
+
+        :return: table indexed by ID
+        :rtype: class: 'pandas.DataFrame'
+        """
+
+        if self.dataset is not None and self.dataset.samples is not None:
+            return self.dataset.samples
+        return IsoplotData.compute_samples(self.filtered_data)
+
+    def natural_order(self, table):
+        """
+        Reorder a table indexed by ID in the natural sort order of the IDs
+
+        :param table: table indexed by ID
+        :type table: class: 'pandas.DataFrame'
+        :return: reordered table
+        :rtype: class: 'pandas.DataFrame'
+        """
+
+        ranks = self.get_samples()["id_rank"].reindex(table.index).to_numpy()
+        return table.iloc[np.argsort(ranks, kind="stable")]
+
+    def get_sample_tooltips(self, ids, repeat=1):
+        """
+        Get the condition, time and replicate labels of sample IDs for the interactive tooltips
+
+        :param ids: sample IDs
+        :type ids: list or class: 'pandas.Index'
+        :param repeat: number of times each label is repeated (one per isotopologue for unstacked plots)
+        :type repeat: int
+        :return: lists containing conditions, times and replicates
+        :rtype: lists
+        """
+
+        samples = self.get_samples().reindex(ids)
+        conditions = np.repeat(samples["condition"].astype(str).to_numpy(), repeat).tolist()
+        times = np.repeat(("T" + samples["time"].astype(str)).to_numpy(), repeat).tolist()
+        replicates = np.repeat(samples["number_rep"].astype(str).to_numpy(), repeat).tolist()
+        return conditions, times, replicates
+
+    @staticmethod
+    def get_condition_time_tooltips(index, repeat=1):
+        """
+        Get the condition and time labels of meaned data for the interactive tooltips
+
+        :param index: (condition, time) index of the meaned data
+        :type index: class: 'pandas.MultiIndex'
+        :param repeat: number of times each label is repeated (one per isotopologue for unstacked plots)
+        :type repeat: int
+        :return: lists containing conditions and times
+        :rtype: lists
+        """
+
+        conditions = np.repeat(index.get_level_values("condition").astype(str).to_numpy(), repeat).tolist()
+        times = np.repeat(index.get_level_values("time").astype(str).to_numpy(), repeat).tolist()
+        return conditions, times
+
+    @staticmethod
+    def condition_time_labels(index):
+        """
+        Build the 'condition_time' labels of meaned data
+
+        :param index: (condition, time) index of the meaned data
+        :type index: class: 'pandas.MultiIndex'
+        :return: labels
+        :rtype: list
+        """
+
+        return (index.get_level_values("condition").astype(str) + "_" +
+                index.get_level_values("time").astype(str)).tolist()
 
 
 class StaticPlot(Plot):
@@ -116,91 +362,79 @@ class StaticPlot(Plot):
     """
 
     def __init__(self, stack, value, data, name, metabolite,
-                 condition, time, fmt, display, rtrn):
+                 condition, time, fmt, display, rtrn, sink=None, intermediates=None):
 
-        super().__init__(stack, value, data, name, metabolite, condition, time, display, rtrn)
+        super().__init__(stack, value, data, name, metabolite, condition, time, display, rtrn, sink, intermediates)
         self.fmt = fmt
         self.static_fig_name = self.metabolite + "_" + self.value + '.' + self.fmt
+        # Figures are registered in pyplot only to be displayed, a returned figure belongs to the caller
+        self.pyplot = display and not rtrn
+
+    def output(self, fig):
+        """Return, save and/or display a figure once it is built, in its figure_style block"""
+
+        if self.rtrn:
+            return fig
+        save_figure(self.sink, fig, self.static_fig_name, self.fmt)
+        if self.display:
+            plt.show()
+        else:
+            release_figure(fig)
 
     def stacked_areaplot(self):
         """Creation of area stackplot (for cinetic data)"""
 
         # Commençons par la préparation de data
-        stackpivot = self.filtered_data.pivot(
-            index='ID', columns='isotopologue', values=self.value)
-        stackpivot = stackpivot.reindex(index=natsorted(stackpivot.index))
+        stackpivot = self.natural_order(self.get_pivot())
         pivotcol = stackpivot[0:].to_numpy()
         stackyval = pivotcol.transpose()
         stackxval = stackpivot.index.to_numpy()
 
         # Passons au plot
-        plt.figure(figsize=[38, 20])
-        labels = list(stackpivot.columns)
-        plt.stackplot(stackxval,
-                      stackyval,
-                      labels=labels,
-                      colors=cc.glasbey_dark[:len(
-                          self.data['isotopologue'].unique())])
-        plt.legend()
-        plt.title("{} CID cinetics".format(self.metabolite))
-        plt.xticks(rotation=45)
-        plt.legend(loc='center left', bbox_to_anchor=(1, 0.5))
-        plt.tight_layout()
-        if self.rtrn:
-            fig = plt.gcf()
-            return fig
-        plt.savefig(self.static_fig_name, bbox_inches='tight', format=self.fmt)
-        if self.display:
-            plt.show()
-        else:
-            plt.close()
+        with figure_style():
+            fig = new_figure([38, 20], self.pyplot)
+            ax = fig.add_subplot()
+            labels = list(stackpivot.columns)
+            ax.stackplot(stackxval,
+                         stackyval,
+                         labels=labels,
+                         colors=cc.glasbey_dark[:len(
+                             self.filtered_data['isotopologue'].unique())])
+            ax.legend()
+            ax.set_title("{} CID cinetics".format(self.metabolite))
+            setp(ax.get_xticklabels(), rotation=45)
+            ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
+            fig.tight_layout()
+            return self.output(fig)
 
     def barplot(self):
         """Creation of barplots"""
 
-        # Nous filtrons et préparons la table pour les donnéees
-        mydata = self.filtered_data
-        mydatapivot = mydata.pivot_table(index=["condition_order", 'ID'],
-                                         columns='isotopologue',
-                                         values=self.value)
-
-        # Ici nous mettons les données dans l'ordre choisi par le template
-        mydatapivot.sort_index(level="condition_order", inplace=True)
-        mydatapivot = mydatapivot.droplevel(level="condition_order")
+        # Nous préparons la table pour les donnéees, déjà dans l'ordre choisi par le template
+        mydatapivot = self.get_pivot()
 
         # Passons au plot
-        sns.set_context("poster")
-        ax = mydatapivot.plot.bar(stacked=self.stack,
-                                  figsize=(30, 15),
-                                  title=self.metabolite,
-                                  color=cc.glasbey_dark[:len(
-                                      self.data['isotopologue'].unique())])
-        ax.set_xlabel('Condition, Time and Replicate')
-        ax.set_ylabel(self.value)
-        ax.set_xticklabels(ax.get_xticklabels(),
-                           rotation=45,
-                           horizontalalignment='right')
-        ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
-        plt.tight_layout()
-        if self.rtrn:
-            fig = ax.get_figure()
-            return fig
-        plt.savefig(self.static_fig_name, bbox_inches='tight', format=self.fmt)
-        if self.display:
-            plt.show()
-        else:
-            plt.close()
+        with figure_style("poster"):
+            fig = new_figure((30, 15), self.pyplot)
+            ax = mydatapivot.plot.bar(stacked=self.stack,
+                                      ax=fig.add_subplot(),
+                                      title=self.metabolite,
+                                      color=cc.glasbey_dark[:len(
+                                          self.filtered_data['isotopologue'].unique())])
+            ax.set_xlabel('Condition, Time and Replicate')
+            ax.set_ylabel(self.value)
+            ax.set_xticklabels(ax.get_xticklabels(),
+                               rotation=45,
+                               horizontalalignment='right')
+            ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
+            fig.tight_layout()
+            return self.output(fig)
 
     def mean_barplot(self):
         """Creation of meaned barplots (on replicates)"""
 
         # Ici nous faisons les moyennes et les SD des données et nous les mettons dans un df
-        df_replicate_mean = self.filtered_data.groupby(
-            ["condition_order", "condition", "time", "isotopologue"])[self.value].mean()
-        df_replicate_std = self.filtered_data.groupby(
-            ["condition_order", "condition", "time", "isotopologue"])[self.value].std()
-        df_full = pd.concat([df_replicate_mean, df_replicate_std], axis=1)
-        df_full.columns = ("mean", "std")
+        df_full = self.get_replicate_stats()[["mean", "std"]]
 
         # Nous formattons le df pour pouvoir plotter
         df_ready = df_full.unstack()
@@ -208,88 +442,50 @@ class StaticPlot(Plot):
         df_ready = df_ready.droplevel(level="condition_order")
 
         # Passons au plot
-        sns.set_context("poster")
-        colors = cc.glasbey_dark[:len(df_ready.columns)]
-        this_ax = df_ready["mean"].plot.bar(stacked=self.stack,
-                                            yerr=df_ready['std'],
-                                            figsize=(30, 15),
-                                            title=self.metabolite,
-                                            color=colors)
-        this_ax.set_xlabel('Condition, Time and Replicate')
-        this_ax.set_ylabel(self.value)
-        this_ax.set_xticklabels(this_ax.get_xticklabels(),
-                                rotation=45,
-                                horizontalalignment='right')
-        this_ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
-        plt.xticks(rotation=45)
-        plt.tight_layout()
-        if self.rtrn:
-            fig = this_ax.get_figure()
-            return fig
-        plt.savefig(self.static_fig_name, bbox_inches='tight', format=self.fmt)
-        if self.display:
-            plt.show()
-        else:
-            plt.close()
+        with figure_style("poster"):
+            fig = new_figure((30, 15), self.pyplot)
+            colors = cc.glasbey_dark[:len(df_ready.columns)]
+            this_ax = df_ready["mean"].plot.bar(stacked=self.stack,
+                                                yerr=df_ready['std'],
+                                                ax=fig.add_subplot(),
+                                                title=self.metabolite,
+                                                color=colors)
+            this_ax.set_xlabel('Condition, Time and Replicate')
+            this_ax.set_ylabel(self.value)
+            this_ax.set_xticklabels(this_ax.get_xticklabels(),
+                                    rotation=45,
+                                    horizontalalignment='right')
+            this_ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
+            setp(this_ax.get_xticklabels(), rotation=45)
+            fig.tight_layout()
+            return self.output(fig)
 
     def mean_enrichment_plot(self):
         """Generate static mean_enrichment plots"""
 
-        # Nous préparons une liste et un df dans lesquels on va ajouter les mean_enrichment
-        list_of_tmpdfs = []
-
-        # Nous retirons les duplicats pour chaque ID individuel
-        for ID in self.filtered_data["ID"].drop_duplicates():
-            tmpdf = self.filtered_data[self.filtered_data["ID"] == ID].drop_duplicates(
-                subset=['mean_enrichment'])
-            list_of_tmpdfs.append(tmpdf)
-
-        # Nous mettons l'ordre de conditions en fonction du template, et nous préparons les datas pour plotter
-        mean_enrichment_df = pd.concat(list_of_tmpdfs, ignore_index=True)
-        mean_enrichment_df = mean_enrichment_df[["ID", "condition_order", "mean_enrichment"]]
-        mean_enrichment_df.sort_values(by="condition_order", inplace=True)
-        mean_enrichment_df.drop(labels="condition_order", axis=1, inplace=True)
-        mean_enrichment_df.set_index("ID", inplace=True)
+        # Nous récupérons les mean_enrichment de chaque échantillon, déjà dans l'ordre du template
+        mean_enrichment_df = self.get_mean_enrichment()[["mean_enrichment"]]
 
         # Nous plottons les data avec la fonction de pandas
-        sns.set_context("poster")
-        ax = mean_enrichment_df.plot.bar(figsize=(30, 15),
-                                         title=self.metabolite,
-                                         color=cc.glasbey_dark[3])
-        ax.set_xlabel('Condition, Time and Replicate')
-        ax.set_ylabel("mean_enrichment")
-        ax.set_xticklabels(ax.get_xticklabels(), rotation=45, horizontalalignment='right')
-        ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
-        plt.tight_layout()
-        if self.rtrn:
-            fig = ax.get_figure()
-            return fig
-        plt.savefig(self.static_fig_name, bbox_inches='tight', format=self.fmt)
-        if self.display:
-            plt.show()
-        else:
-            plt.close()
+        with figure_style("poster"):
+            fig = new_figure((30, 15), self.pyplot)
+            ax = mean_enrichment_df.plot.bar(ax=fig.add_subplot(),
+                                             title=self.metabolite,
+                                             color=cc.glasbey_dark[3])
+            ax.set_xlabel('Condition, Time and Replicate')
+            ax.set_ylabel("mean_enrichment")
+            ax.set_xticklabels(ax.get_xticklabels(), rotation=45, horizontalalignment='right')
+            ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
+            fig.tight_layout()
+            return self.output(fig)
 
     def mean_enrichment_meanplot(self):
         """Generate static mean_enrichment plots with meaned replicates"""
 
-        # Nous préparons une liste et un df dans lesquels on va ajouter les mean_enrichment
-        list_of_tmpdfs = []
-
-        # Nous retirons les duplicats pour chaque ID individuel
-        for ID in self.filtered_data["ID"].drop_duplicates():
-            tmpdf = self.filtered_data[
-                self.filtered_data["ID"] == ID].drop_duplicates(subset=['mean_enrichment'])
-            list_of_tmpdfs.append(tmpdf)
-        mean_enrichment_df = pd.concat(list_of_tmpdfs, ignore_index=True)
-
-        # Ici nous faisons les moyennes et les SD des données et nous les mettons dans un df
-        df_replicate_mean = mean_enrichment_df.groupby(
-            ["condition_order", "condition", "time", "isotopologue"])['mean_enrichment'].mean()
-        df_replicate_std = mean_enrichment_df.groupby(
-            ["condition_order", "condition", "time", "isotopologue"])['mean_enrichment'].std()
-        df_full = pd.concat([df_replicate_mean, df_replicate_std], axis=1)
-        df_full.columns = ("mean", "std")
+        # Le mean_enrichment est répété sur chaque isotopologue, nous gardons donc les statistiques du premier
+        replicate_stats = self.get_replicate_stats('mean_enrichment')
+        isotopologues = replicate_stats.index.get_level_values("isotopologue")
+        df_full = replicate_stats.loc[isotopologues == isotopologues.min(), ["mean", "std"]]
 
         # Nous formattons le df pour pouvoir plotter
         df_ready = df_full.unstack()
@@ -297,67 +493,42 @@ class StaticPlot(Plot):
         df_ready = df_ready.droplevel(level="condition_order")
 
         # Passons au plot
-        sns.set_context("poster")
-        this_ax = df_ready["mean"].plot.bar(yerr=df_ready['std'],
-                                            figsize=(30, 15),
-                                            title=self.metabolite,
-                                            color=cc.glasbey_dark[3])
-        this_ax.set_xlabel('Condition, Time and Replicate')
-        this_ax.set_ylabel('mean_enrichment')
-        this_ax.set_xticklabels(this_ax.get_xticklabels(),
-                                rotation=45,
-                                horizontalalignment='right')
-        this_ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
-        plt.xticks(rotation=45)
-        plt.tight_layout()
-        if self.rtrn:
-            fig = this_ax.get_figure()
-            return fig
-        plt.savefig(self.static_fig_name, bbox_inches='tight', format=self.fmt)
-        if self.display:
-            plt.show()
-        else:
-            plt.close()
+        with figure_style("poster"):
+            fig = new_figure((30, 15), self.pyplot)
+            this_ax = df_ready["mean"].plot.bar(yerr=df_ready['std'],
+                                                ax=fig.add_subplot(),
+                                                title=self.metabolite,
+                                                color=cc.glasbey_dark[3])
+            this_ax.set_xlabel('Condition, Time and Replicate')
+            this_ax.set_ylabel('mean_enrichment')
+            this_ax.set_xticklabels(this_ax.get_xticklabels(),
+                                    rotation=45,
+                                    horizontalalignment='right')
+            this_ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
+            setp(this_ax.get_xticklabels(), rotation=45)
+            fig.tight_layout()
+            return self.output(fig)
 
 
 class InteractivePlot(Plot):
     """Class to generate the different interactive plots"""
 
-    def __init__(self, stack, value, data, name, metabolite, condition, time, display, rtrn):
+    def __init__(self, stack, value, data, name, metabolite, condition, time, display, rtrn, sink=None,
+                 intermediates=None):
 
-        super().__init__(stack, value, data, name, metabolite, condition, time, display, rtrn)
+        super().__init__(stack, value, data, name, metabolite, condition, time, display, rtrn, sink, intermediates)
         self.filename = self.metabolite + "_" + self.value + ".html"
         self.plot_tools = "save, wheel_zoom, reset, hover, pan"
 
     def mean_enrichment_plot(self):
         """Generate interactive mean_enrichment plots"""
 
-        output_file(filename=self.filename, title=self.metabolite)
-
-        # Nous filtrons les données en fonction des paramètres du dashboard
-        tmpdf = self.filtered_data
-
-        # Nous préparons une liste et un df dans lesquels on va ajouter les mean_enrichment
-        list_of_tmpdfs = []
-
-        # Nous retirons les duplicats pour chaque ID individuel
-        for ID in tmpdf["ID"].drop_duplicates():
-            tmpdf2 = tmpdf[tmpdf["ID"] == ID].drop_duplicates(subset=['mean_enrichment'])
-            list_of_tmpdfs.append(tmpdf2)
-
-        # Nous mettons l'ordre de conditions en fonction du template, et nous préparons les datas pour plotter
-        mean_enrichment_df = pd.concat(list_of_tmpdfs, ignore_index=True)
-
-        del list_of_tmpdfs
-
-        mean_enrichment_df = mean_enrichment_df[["ID", "condition_order", "mean_enrichment"]]
-        mean_enrichment_df.sort_values(by="condition_order", inplace=True)
-        mean_enrichment_df.drop(labels="condition_order", axis=1, inplace=True)
-        mean_enrichment_df.set_index("ID", inplace=True)
+        # Nous récupérons les mean_enrichment de chaque échantillon, déjà dans l'ordre du template
+        mean_enrichment_df = self.get_mean_enrichment()[["mean_enrichment"]]
 
         my_x_range = mean_enrichment_df.index.tolist()
         values = mean_enrichment_df["mean_enrichment"].tolist()
-        conditions, times, replicates = Plot.split_ids(my_x_range)
+        conditions, times, replicates = self.get_sample_tooltips(mean_enrichment_df.index)
         source = bk.models.ColumnDataSource(dict(x=my_x_range, y=values,
                                                  conds=conditions,
                                                  times=times,
@@ -388,25 +559,17 @@ class InteractivePlot(Plot):
         myplot.xaxis.major_label_orientation = math.pi / 4
         if self.rtrn:
             return myplot
+        save_html(self.sink, myplot, self.filename, self.metabolite)
         if self.display:
             show(myplot)
-        else:
-            save(myplot)
 
     def mean_enrichment_meanplot(self):
         """Generate interactive mean_enrichment plots with meaned replicates"""
 
-        output_file(filename=self.filename, title=self.metabolite)
-
-        # Nous filtrons les données en fonction des paramètres du dashboard
-        tmpdf = self.filtered_data
-
-        df_replicate_mean = tmpdf.groupby(
-            ["condition_order", "condition", "time", "isotopologue"])[self.value].mean()
-        df_replicate_std = tmpdf.groupby(
-            ["condition_order", "condition", "time", "isotopologue"])[self.value].std()
-        mean_df = df_replicate_mean.to_frame()
-        std_df = df_replicate_std.to_frame()
+        # Nous récupérons les moyennes et SD des réplicats
+        replicate_stats = self.get_replicate_stats()
+        mean_df = replicate_stats[["mean"]]
+        std_df = replicate_stats[["std"]]
 
         # Ici nous mettons les moyennes dans un df et nous trions dans l'ordre demandé dans le template
         mean_df_unstack = mean_df.unstack()
@@ -414,7 +577,8 @@ class InteractivePlot(Plot):
         mean_df_unstack = mean_df_unstack.droplevel(level=0)
         mean_df_unstack.columns = mean_df_unstack.columns.droplevel(level=0)
         mean_df_unstack.columns = mean_df_unstack.columns.astype(str)
-        mean_df_unstack.index = ['{}_{}'.format(i, j) for i, j in mean_df_unstack.index]  # Nous recréons la colonne ID
+        condition_times = mean_df_unstack.index
+        mean_df_unstack.index = Plot.condition_time_labels(condition_times)  # Nous recréons la colonne ID
 
         # Les colonnes contenants toutes les mêmes valeurs, nous pouvons juste prendre la première
         mean_series = mean_df_unstack.iloc[:, 0].copy()
@@ -425,7 +589,7 @@ class InteractivePlot(Plot):
         std_df_unstack = std_df_unstack.droplevel(level=0)
         std_df_unstack.columns = std_df_unstack.columns.droplevel(level=0)
         std_df_unstack.columns = std_df_unstack.columns.astype(str)
-        std_df_unstack.index = ['{}_{}'.format(i, j) for i, j in std_df_unstack.index]
+        std_df_unstack.index = Plot.condition_time_labels(std_df_unstack.index)
 
         # Les colonnes contenants toutes les mêmes valeurs, nous pouvons juste prendre la première
         std_series = std_df_unstack.iloc[:, 0].copy()
@@ -440,7 +604,7 @@ class InteractivePlot(Plot):
         # Nous préparons les datas pour plotter
         my_x_range = mean_series.index.tolist()
         values = mean_series.to_list()
-        conditions, times = Plot.split_ids(my_x_range)
+        conditions, times = Plot.get_condition_time_tooltips(condition_times)
         my_dict = dict(ID=my_x_range, tops=values,
                        conds=conditions, times=times)
         source = bk.models.ColumnDataSource(my_dict)
@@ -483,23 +647,15 @@ class InteractivePlot(Plot):
         myplot.xaxis.major_label_orientation = math.pi / 4
         if self.rtrn:
             return myplot
+        save_html(self.sink, myplot, self.filename, self.metabolite)
         if self.display:
             show(myplot)
-        else:
-            save(myplot)
 
     def stacked_barplot(self):
         """Generate interactive stacked barplots"""
 
-        output_file(filename=self.filename + ".html", title=self.metabolite)
-
-        # Nous filtrons les datas à plotter
-        mydata = self.filtered_data
-        mydatapivot = mydata.pivot_table(index=["condition_order", 'ID'],
-                                         columns='isotopologue',
-                                         values=self.value)
-        mydatapivot.sort_index(level="condition_order", inplace=True)
-        mydatapivot = mydatapivot.droplevel(level="condition_order")
+        # Nous récupérons les datas à plotter dans l'ordre du template
+        mydatapivot = self.get_pivot()
         mydatapivot.columns = mydatapivot.columns.astype(str)
 
         # préparons les différentes couches des barres à stacker
@@ -509,7 +665,7 @@ class InteractivePlot(Plot):
         my_x_range = mydatapivot.index.tolist()
 
         # Nous récupérons les noms pour les tooltips
-        conditions, times, replicates = Plot.split_ids(my_x_range)
+        conditions, times, replicates = self.get_sample_tooltips(mydatapivot.index)
 
         # Nous faisons ici des listes avec les données pour chaque couche (une couche=un isotopologue)
         listoflists = [mydatapivot[val].tolist() for val in stackers]
@@ -554,34 +710,25 @@ class InteractivePlot(Plot):
         if self.rtrn:
             return myplot
 
+        save_html(self.sink, myplot, self.filename + ".html", self.metabolite)
         if self.display:
             show(myplot)
-        else:
-            save(myplot)
 
     def unstacked_barplot(self):
         """Generate interactive unstacked barplots"""
 
-        output_file(filename=self.filename, title=self.metabolite)
-
-        # Nous filtrons les datas à plotter
-        mydata = self.filtered_data
-        mydatapivot = mydata.pivot_table(index=["condition_order", 'ID'],
-                                         columns='isotopologue',
-                                         values=self.value)
-        mydatapivot.sort_index(level="condition_order", inplace=True)
-        mydatapivot = mydatapivot.droplevel(level="condition_order")
+        # Nous récupérons les datas à plotter dans l'ordre du template
+        mydatapivot = self.get_pivot()
 
         # Nous récupérons les colonnes pour faire les couches à stacker
         stackers = mydatapivot.columns.astype(str).tolist()
 
         # Nous faisons des tuples avec index et couche à plotter
         factors = [(i, stack) for i in mydatapivot.index for stack in stackers]
-        condition_time = [i[0] for i in factors]
         isotops = [i[1] for i in factors]
 
         # Nous récupérons les noms pour les tooltips
-        conditions, times, replicates = Plot.split_ids(condition_time)
+        conditions, times, replicates = self.get_sample_tooltips(mydatapivot.index, repeat=len(stackers))
 
         # Nous récupérons les valeurs de chaque couche
         tops = [row[int(stack) + 1]
@@ -626,24 +773,17 @@ class InteractivePlot(Plot):
         myplot.x_range.range_padding = 0.1
         if self.rtrn:
             return myplot
+        save_html(self.sink, myplot, self.filename, self.metabolite)
         if self.display:
             show(myplot)
-        else:
-            save(myplot)
 
     def stacked_meanplot(self):
         """Generate interactive stacked barplots with meaned replicates"""
 
-        output_file(filename=self.filename + ".html", title=self.metabolite)
-
-        # Nous filtrons les datas à plotter et préparons les moyennes et SD
-        tmpdf = self.filtered_data
-        df_replicate_mean = tmpdf.groupby(
-            ["condition_order", "condition", "time", "isotopologue"])[self.value].mean()
-        df_replicate_std = tmpdf.groupby(
-            ["condition_order", "condition", "time", "isotopologue"])[self.value].std()
-        mean_df = df_replicate_mean.to_frame()
-        std_df = df_replicate_std.to_frame()
+        # Nous récupérons les moyennes et SD des datas à plotter
+        replicate_stats = self.get_replicate_stats()
+        mean_df = replicate_stats[["mean"]]
+        std_df = replicate_stats[["std"]]
 
         # Ici nous mettons les moyennes et SD dans des df
         mean_df_unstack = mean_df.unstack()
@@ -651,14 +791,15 @@ class InteractivePlot(Plot):
         mean_df_unstack = mean_df_unstack.droplevel(level=0)
         mean_df_unstack.columns = mean_df_unstack.columns.droplevel(level=0)
         mean_df_unstack.columns = mean_df_unstack.columns.astype(str)
-        mean_df_unstack.index = ['{}_{}'.format(i, j) for i, j in mean_df_unstack.index]
+        condition_times = mean_df_unstack.index
+        mean_df_unstack.index = Plot.condition_time_labels(condition_times)
 
         std_df_unstack = std_df.unstack()
         std_df_unstack.sort_index(level="condition_order", inplace=True)
         std_df_unstack = std_df_unstack.droplevel(level=0)
         std_df_unstack.columns = std_df_unstack.columns.droplevel(level=0)
         std_df_unstack.columns = std_df_unstack.columns.astype(str)
-        std_df_unstack.index = ['{}_{}'.format(i, j) for i, j in std_df_unstack.index]
+        std_df_unstack.index = Plot.condition_time_labels(std_df_unstack.index)
 
         upper_df = mean_df_unstack.add(std_df_unstack, fill_value=0)
         upper_df.columns = upper_df.columns.astype(str)
@@ -675,7 +816,7 @@ class InteractivePlot(Plot):
         meanplotdic.update({'ID': my_x_range})
 
         # Nous récupérons les noms pour les tooltips
-        conditions, times = Plot.split_ids(my_x_range)
+        conditions, times = Plot.get_condition_time_tooltips(condition_times)
 
         meanplotdic.update({'conds': conditions,
                             'times': times})
@@ -744,38 +885,32 @@ class InteractivePlot(Plot):
         myplot.xaxis.major_label_orientation = math.pi / 4
         if self.rtrn:
             return myplot
+        save_html(self.sink, myplot, self.filename + ".html", self.metabolite)
         if self.display:
             show(myplot)
-        else:
-            save(myplot)
 
     def unstacked_meanplot(self):
         """Generate interactive unstacked barplots with meaned replicates"""
 
-        output_file(filename=self.filename, title=self.metabolite)
-
         # Préparation des datas à plotter
-        tmpdf = self.filtered_data
-        df_replicate_mean = tmpdf.groupby(
-            ["condition_order", "condition", "time", "isotopologue"])[self.value].mean()
-        df_replicate_std = tmpdf.groupby(
-            ["condition_order", "condition", "time", "isotopologue"])[self.value].std()
-        mean_df = df_replicate_mean.to_frame()
-        std_df = df_replicate_std.to_frame()
+        replicate_stats = self.get_replicate_stats()
+        mean_df = replicate_stats[["mean"]]
+        std_df = replicate_stats[["std"]]
 
         mean_df_unstack = mean_df.unstack()
         mean_df_unstack.sort_index(level="condition_order", inplace=True)
         mean_df_unstack = mean_df_unstack.droplevel(level=0)
         mean_df_unstack.columns = mean_df_unstack.columns.droplevel(level=0)
         mean_df_unstack.columns = mean_df_unstack.columns.astype(str)
-        mean_df_unstack.index = ['{}_{}'.format(i, j) for i, j in mean_df_unstack.index]
+        condition_times = mean_df_unstack.index
+        mean_df_unstack.index = Plot.condition_time_labels(condition_times)
 
         std_df_unstack = std_df.unstack()
         std_df_unstack.sort_index(level="condition_order", inplace=True)
         std_df_unstack = std_df_unstack.droplevel(level=0)
         std_df_unstack.columns = std_df_unstack.columns.droplevel(level=0)
         std_df_unstack.columns = std_df_unstack.columns.astype(str)
-        std_df_unstack.index = ['{}_{}'.format(i, j) for i, j in std_df_unstack.index]
+        std_df_unstack.index = Plot.condition_time_labels(std_df_unstack.index)
         stackers = mean_df_unstack.columns.tolist()
 
         upper_df = mean_df_unstack.add(std_df_unstack, fill_value=0)
@@ -783,9 +918,8 @@ class InteractivePlot(Plot):
 
         # Même principe que pour les non stackés non moyennés sauf que nous préparons les barres d'erreur aussi
         factors = [(i, stack) for i in mean_df_unstack.index for stack in stackers]
-        condition_time = [i[0] for i in factors]
         isotops = [i[1] for i in factors]
-        conditions, times = Plot.split_ids(condition_time)
+        conditions, times = Plot.get_condition_time_tooltips(condition_times, repeat=len(stackers))
 
         tops = [row[int(stack) + 1]
                 for row in mean_df_unstack.itertuples()
@@ -842,19 +976,15 @@ class InteractivePlot(Plot):
         myplot.x_range.range_padding = 0.1
         if self.rtrn:
             return myplot
+        save_html(self.sink, myplot, self.filename, self.metabolite)
         if self.display:
             show(myplot)
-        else:
-            save(myplot)
 
     def stacked_areaplot(self):
         """Generate interactive stacked areaplots"""
 
-        output_file(filename=self.filename, title=self.metabolite)
-
         # Commençons par la préparation de data
-        stackdf = self.filtered_data
-        stackpivot = stackdf.pivot(index='ID', columns='isotopologue', values=self.value)
+        stackpivot = self.natural_order(self.get_pivot())
         stackpivot.columns = stackpivot.columns.astype(str)
         mysource = bk.models.ColumnDataSource(data=stackpivot)
         mystackers = stackpivot.columns.tolist()
@@ -871,48 +1001,57 @@ class InteractivePlot(Plot):
             height=self.HEIGHT,
             tools=self.plot_tools,
             tooltips=TOOLTIPS,
-            x_range=stackpivot.index.values
+            x_range=stackpivot.index.tolist()
         )
 
         myplot.xaxis.major_label_orientation = math.pi / 4
         myplot.varea_stack(mystackers, x="ID", color=colors, source=mysource)
         if self.rtrn:
             return myplot
+        save_html(self.sink, myplot, self.filename, self.metabolite)
         if self.display:
             show(myplot)
-        else:
-            save(myplot)
 
 
 class Map:
     """
     Class to create maps from Isocor output (MS data from C13 labelling experiments)
 
+    :param data: IsoplotData object containing clean data, or the clean dataframe itself
+    :type data: class: 'isoplot.main.dataprep.IsoplotData' or Pandas Dataframe
     :param annot: Should annotations be apparent on map or not
     :type annot: Bool
+    :param sink: Destination of the created files. Defaults to the working directory at creation
+    :type sink: class: 'isoplot.main.sinks.OutputSink'
     """
 
-    def __init__(self, data, name, annot, fmt, display=False, rtrn=False):
+    def __init__(self, data, name, annot, fmt, display=False, rtrn=False, sink=None):
 
-        self.data = data
+        if isinstance(data, IsoplotData):
+            self.data = data.dfmerge
+            mean_enrichment = data.mean_enrichment
+        else:
+            self.data = data
+            mean_enrichment = None
+        if mean_enrichment is None:
+            mean_enrichment = IsoplotData.compute_mean_enrichment(self.data)
         self.name = name
         self.annot = annot
         self.fmt = fmt
         self.display = display
         self.rtrn = rtrn
+        self.sink = sink if sink is not None else DirectorySink(os.getcwd())
+        # Figures are registered in pyplot only to be displayed, a returned figure belongs to the caller
+        self.pyplot = display and not rtrn
 
-        # Il faut préparer les données pour les maps:
-        self.heatmapdf = self.data[
-            ['metabolite', 'mean_enrichment',
-             'condition', 'time', 'number_rep']]
+        # Il faut préparer les données pour les maps (une ligne par métabolite et par échantillon):
+        self.heatmapdf = mean_enrichment[['mean_enrichment', 'condition', 'time']]
         self.heatmapdf = self.heatmapdf[self.heatmapdf['mean_enrichment'] != 0]
-        self.heatmapdf.drop_duplicates(inplace=True)
-        self.heatmapdf.dropna(inplace=True)
-        self.heatmapdf.set_index('metabolite', inplace=True)
-        self.heatmapdf['Condition_Time'] = self.heatmapdf['condition'].apply(str) + '_T' + self.heatmapdf['time'].apply(
-            str)
+        self.heatmapdf = self.heatmapdf.dropna()
+        self.heatmapdf['Condition_Time'] = self.heatmapdf['condition'].astype(str) + '_T' + \
+                                           self.heatmapdf['time'].astype(str)
         self.heatmapdf = self.heatmapdf.groupby(
-            ['metabolite', 'Condition_Time'])['mean_enrichment'].mean()
+            ['metabolite', 'Condition_Time'], observed=True)['mean_enrichment'].mean()
         self.heatmapdf = self.heatmapdf.unstack(0)
         self.dc_heatmap = self.heatmapdf.describe(include='all')
         self.heatmap_center = self.dc_heatmap.iloc[5, 0].mean()
@@ -924,20 +1063,23 @@ class Map:
         all conditions & times & metabolites
         """
 
-        fig, ax = plt.subplots(figsize=(30, 30))
-        sns.set(font_scale=1)
-        sns.heatmap(self.heatmapdf, vmin=0.02,
-                    robust=True, center=self.heatmap_center,
-                    annot=self.annot, fmt="f", linecolor='black',
-                    linewidths=.2, cmap='Blues', ax=ax)
-        plt.yticks(rotation=0, fontsize=20)
-        plt.xticks(rotation=45, fontsize=20)
-        # bottom, top = ax.get_ylim()
-        if self.rtrn:
-            return fig
-        plt.savefig(self.name + '_' + 'heatmap'+ '.' + self.fmt, bbox_inches='tight', format=self.fmt)
-        if self.display:
-            plt.show()
+        with figure_style():
+            fig = new_figure((30, 30), self.pyplot)
+            ax = fig.add_subplot()
+            sns.set(font_scale=1)
+            sns.heatmap(self.heatmapdf, vmin=0.02,
+                        robust=True, center=self.heatmap_center,
+                        annot=self.annot, fmt="f", linecolor='black',
+                        linewidths=.2, cmap='Blues', ax=ax)
+            setp(ax.get_yticklabels(), rotation=0, fontsize=20)
+            setp(ax.get_xticklabels(), rotation=45, fontsize=20)
+            if self.rtrn:
+                return fig
+            save_figure(self.sink, fig, self.name + '_' + 'heatmap' + '.' + self.fmt, self.fmt)
+            if self.display:
+                plt.show()
+            else:
+                release_figure(fig)
 
     def build_clustermap(self):
         """
@@ -945,20 +1087,25 @@ class Map:
         all conditions & times & metabolites
         """
 
-        sns.set(font_scale=1)
-        cg = sns.clustermap(self.clustermapdf,
-                            cmap="Blues", fmt="f",
-                            linewidths=.2, standard_scale=1,
-                            figsize=(30, 30), linecolor='black',
-                            annot=self.annot)
-        plt.setp(cg.ax_heatmap.yaxis.get_majorticklabels(), rotation=0, fontsize=20)
-        plt.setp(cg.ax_heatmap.xaxis.get_majorticklabels(), rotation=45, fontsize=20)
-        if self.rtrn:
-            fig = plt.gcf()
-            return fig
-        plt.savefig(self.name + '_' + 'clustermap'+ '.' + self.fmt, bbox_inches='tight', format=self.fmt)
-        if self.display:
-            plt.show()
+        with figure_style(font_scale=1):
+            cg = sns.clustermap(self.clustermapdf,
+                                cmap="Blues", fmt="f",
+                                linewidths=.2, standard_scale=1,
+                                figsize=(30, 30), linecolor='black',
+                                annot=self.annot)
+            setp(cg.ax_heatmap.yaxis.get_majorticklabels(), rotation=0, fontsize=20)
+            setp(cg.ax_heatmap.xaxis.get_majorticklabels(), rotation=45, fontsize=20)
+            fig = cg.fig
+            if not self.pyplot:
+                # Seaborn creates the figure through pyplot, it is unregistered so that it is freed with the object
+                plt.close(fig)
+            if self.rtrn:
+                return fig
+            save_figure(self.sink, fig, self.name + '_' + 'clustermap' + '.' + self.fmt, self.fmt)
+            if self.display:
+                plt.show()
+            else:
+                release_figure(fig)
 
     def build_interactive_heatmap(self):
         """
@@ -966,8 +1113,6 @@ class Map:
         all conditions & times & metabolites
         """
 
-        output_file(filename=self.name +'_' + 'heatmap'+ ".html", title=self.name + ".html")
-
         condition_time = list(self.heatmapdf.index.astype(str))
         metabolites = list(self.heatmapdf.columns)
 
@@ -1013,7 +1158,6 @@ class Map:
 
         if self.rtrn:
             return myplot
+        save_html(self.sink, myplot, self.name +'_' + 'heatmap'+ ".html", self.name + ".html")
         if self.display:
             show(myplot)
-        else:
-            save(myplot)
@@ -0,0 +1,223 @@
+"""Module measuring the time and memory used by the stages of a command-line run and by each plot"""
+
+import contextlib
+import cProfile
+import json
+import os
+import pathlib as pl
+import pstats
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory is not measured there
+    resource = None
+
+MB = 1024 ** 2
+
+
+def peak_memory():
+    """
+    Get the peak resident memory of the process
+
+    :return: peak memory in bytes, or None if it cannot be measured
+    :rtype: int
+    """
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux gives kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class Measure:
+    """
+    Context manager measuring the wall time, the CPU time of the current thread and the peak memory of the process
+    while its block runs. The block can also be profiled with cProfile.
+
+    :param stats_path: file in which the cProfile statistics of the block are dumped, None to not profile it
+    :type stats_path: str or class: 'pathlib.Path'
+    """
+
+    def __init__(self, stats_path=None):
+
+        self.stats_path = stats_path
+        self.profiler = None
+        self.record = None
+
+    def __enter__(self):
+
+        if self.stats_path is not None:
+            self.profiler = cProfile.Profile()
+            try:
+                self.profiler.enable()
+            except ValueError:
+                # Only one profiler can run at a time from python 3.12, threads are not profiled concurrently
+                self.profiler = None
+        self.start, self.cpu_start = time.perf_counter(), time.thread_time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+
+        wall, cpu = time.perf_counter() - self.start, time.thread_time() - self.cpu_start
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(str(self.stats_path))
+        self.record = {"wall": wall, "cpu": cpu, "peak_memory": peak_memory()}
+
+
+class RunProfile:
+    """
+    Timings of a run: the data preparation stages, and each plot with the files it wrote. The profile is written in a
+    json file, with a summary giving the plot types, metabolites and formats that take the most time.
+
+    :param stats_dir: directory in which the cProfile statistics of each stage are dumped (stage.pstats), None to not
+                      profile the stages
+    :type stats_dir: str or class: 'pathlib.Path'
+    """
+
+    JSON_FILE = "profile.json"
+    SUMMARY_FILE = "profile_summary.txt"
+
+    def __init__(self, stats_dir=None):
+
+        self.stats_dir = pl.Path(stats_dir) if stats_dir is not None else None
+        if self.stats_dir is not None:
+            self.stats_dir.mkdir(parents=True, exist_ok=True)
+        self.stages = []
+        self.renders = []
+
+    @contextlib.contextmanager
+    def stage(self, name, stats=True):
+        """
+        Measure a stage of the run
+
+        :param name: name of the stage
+        :type name: str
+        :param stats: should the stage be profiled with cProfile when statistics are dumped. Stages that contain
+                      profiled plots must not be, as profilers cannot be nested
+        :type stats: bool
+        """
+
+        stats_path = self.stats_dir / f"{name}.pstats" if self.stats_dir is not None and stats else None
+        measure = Measure(stats_path)
+        try:
+            with measure:
+                yield
+        finally:
+            self.stages.append(dict(stage=name, **measure.record))
+
+    @staticmethod
+    def render_stats_path(stats_dir):
+        """
+        Get a new file in which plots dump their cProfile statistics (merged by merge_render_stats). Each worker
+        dumps its own file.
+
+        :param stats_dir: directory of the statistics
+        :type stats_dir: str or class: 'pathlib.Path'
+        :rtype: str
+        """
+
+        handle, path = tempfile.mkstemp(prefix="render_part_", suffix=".pstats", dir=stats_dir)
+        os.close(handle)
+        return path
+
+    def merge_render_stats(self):
+        """Merge the statistics dumped by the plots, possibly in several processes, into render.pstats"""
+
+        if self.stats_dir is None:
+            return
+        parts = [path for path in sorted(self.stats_dir.glob("render_part_*.pstats")) if path.stat().st_size]
+        if parts:
+            pstats.Stats(*[str(path) for path in parts]).dump_stats(str(self.stats_dir / "render.pstats"))
+        for path in self.stats_dir.glob("render_part_*.pstats"):
+            path.unlink()
+
+    def add_render(self, result):
+        """
+        Add the measures of a rendered plot
+
+        :param result: result of the render task, with its profile
+        :type result: class: 'isoplot.main.render.RenderResult'
+        """
+
+        if result.profile is None:
+            return
+        task = result.task
+        self.renders.append(dict(kind=task.kind, method=task.method, plot_name=task.plot_name,
+                                 metabolite=task.metabolite, value=task.value, **result.profile))
+
+    @staticmethod
+    def group(renders, key):
+        """Sum the wall time, CPU time and number of plots of renders by key, slowest first"""
+
+        groups = {}
+        for render in renders:
+            group = groups.setdefault(key(render), {"plots": 0, "wall": 0.0, "cpu": 0.0})
+            group["plots"] += 1
+            group["wall"] += render["wall"]
+            group["cpu"] += render["cpu"]
+        return sorted(groups.items(), key=lambda item: item[1]["wall"], reverse=True)
+
+    def summary(self, top=10):
+        """
+        Get a human readable summary of the profile
+
+        :param top: number of metabolites and plots listed
+        :type top: int
+        :rtype: str
+        """
+
+        def memory(value):
+            return f"{value / MB:8.1f} MB" if value is not None else "       n/a"
+
+        lines = ["Stages (wall time, CPU time of the main thread, peak memory of the process at the end)"]
+        lines += [f"  {stage['stage']:<30} {stage['wall']:9.3f} s {stage['cpu']:9.3f} s "
+                  f"{memory(stage['peak_memory'])}" for stage in self.stages]
+        if not self.renders:
+            return "\n".join(lines)
+        writes = [write for render in self.renders for write in render["writes"]]
+        lines += ["", f"Plots: {len(self.renders)} rendered, {sum(r['wall'] for r in self.renders):.3f} s in total "
+                      f"({sum(r['cpu'] for r in self.renders):.3f} s CPU), {len(writes)} files of "
+                      f"{sum(w['bytes'] for w in writes) / MB:.1f} MB written in "
+                      f"{sum(w['wall'] for w in writes):.3f} s"]
+        sections = [("By plot type", lambda render: f"{render['kind']} {render['method']}", None),
+                    ("By value", lambda render: str(render["value"]), None),
+                    (f"By metabolite ({top} slowest)", lambda render: str(render["metabolite"]), top)]
+        for title, key, limit in sections:
+            lines += ["", title]
+            lines += [f"  {name:<40} {group['plots']:5d} plots {group['wall']:9.3f} s "
+                      f"(mean {group['wall'] / group['plots']:.3f} s)"
+                      for name, group in self.group(self.renders, key)[:limit]]
+        formats = {}
+        for write in writes:
+            group = formats.setdefault(pl.PurePosixPath(write["file"]).suffix.lstrip(".") or "none",
+                                       {"files": 0, "bytes": 0, "wall": 0.0})
+            group["files"] += 1
+            group["bytes"] += write["bytes"]
+            group["wall"] += write["wall"]
+        lines += ["", "Files by format"]
+        lines += [f"  {name:<40} {group['files']:5d} files {group['bytes'] / MB:9.1f} MB {group['wall']:9.3f} s"
+                  for name, group in sorted(formats.items(), key=lambda item: item[1]["wall"], reverse=True)]
+        lines += ["", "Slowest plots"]
+        for render in sorted(self.renders, key=lambda render: render["wall"], reverse=True)[:top]:
+            name = f"{render['kind']} {render['method']} {render['metabolite']} ({render['value']})"
+            lines.append(f"  {name:<60} {render['wall']:9.3f} s")
+        return "\n".join(lines)
+
+    def write(self, directory):
+        """
+        Write the profile and its summary in a directory
+
+        :param directory: destination directory
+        :type directory: str or class: 'pathlib.Path'
+        """
+
+        directory = pl.Path(directory)
+        with open(directory / RunProfile.JSON_FILE, "w", encoding="utf-8") as f:
+            json.dump({"stages": self.stages, "renders": self.renders}, f, indent=1)
+        (directory / RunProfile.SUMMARY_FILE).write_text(self.summary() + "\n", encoding="utf-8")
@@ -0,0 +1,266 @@
+"""Module reporting the progress of the rendering: events for each plot, counts, throughput and estimated time left"""
+
+import contextlib
+import json
+import logging
+import threading
+import time
+
+from isoplot.main.render import RenderPlan
+
+
+class ProgressTracker:
+    """
+    Progress of the rendering of tasks. Each task emits an event when it starts and when it finishes, and the run when
+    it starts and finishes. Events are dictionaries sent to a callback and optionally appended to a json lines file as
+    soon as they happen, so that a stalled run shows in the file. The tracker can be called from several threads.
+
+    Events have an 'event' field ('run_start', 'task_start', 'task_finish' or 'run_finish'), the time at which they
+    happened ('time', seconds since the epoch) and the seconds elapsed since the start of the run ('elapsed'). Task
+    events give the task, and the counts of plots done, failed, running and remaining. 'task_finish' events also give
+    the render time of the task ('wall'), whether it succeeded ('success'), the throughput in plots per second and the
+    estimated seconds left ('eta').
+
+    The estimate uses the mean render time of each plot type observed so far. Plot types that were not rendered yet
+    use the reference costs of RenderPlan, scaled by the ratio of the observed to the reference times of the plots
+    done. The total is divided by the number of plots rendered at once, measured as the render time of the plots done
+    over the elapsed time.
+
+    :param tasks: tasks to render
+    :type tasks: list of class: 'isoplot.main.render.RenderTask'
+    :param callback: function called with each event
+    :param events_path: json lines file to which the events are appended, None to not write them
+    :type events_path: str or class: 'pathlib.Path'
+    :param jobs: number of render workers
+    :type jobs: int
+    :param skipped: number of plots that are not rendered because they already exist, reported in 'run_start'
+    :type skipped: int
+    """
+
+    def __init__(self, tasks, callback=None, events_path=None, jobs=1, skipped=0):
+
+        self.callback = callback
+        self.events_path = events_path
+        self.jobs = max(jobs, 1)
+        self.skipped = skipped
+        self.total = len(tasks)
+        self.logger = logging.getLogger("isoplot_log.main.progress.ProgressTracker")
+        # Tasks not finished yet by plot type, and (total render time, number of plots) of the plot types rendered
+        self.pending = {}
+        for task in tasks:
+            self.pending[ProgressTracker.plot_type(task)] = self.pending.get(ProgressTracker.plot_type(task), 0) + 1
+        self.durations = {}
+        self.running = set()
+        self.finished = set()
+        self.failed = 0
+        self.start_time = None
+        self._file = None
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def plot_type(task):
+        return task.kind, task.method
+
+    @staticmethod
+    def task_id(task):
+        """Identify a task, also when it was copied to a worker process"""
+
+        return task.kind, task.method, task.plot_name, task.metabolite, task.value
+
+    @staticmethod
+    def describe(task):
+        return {"kind": task.kind, "method": task.method, "plot_name": task.plot_name,
+                "metabolite": None if task.metabolite is None else str(task.metabolite),
+                "value": task.value}
+
+    @property
+    def done(self):
+        return len(self.finished)
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.start_time if self.start_time is not None else 0.0
+
+    def throughput(self):
+        """Get the number of plots rendered per second since the start of the run"""
+
+        return round(self.done / self.elapsed, 3) if self.done and self.elapsed > 0 else None
+
+    def eta(self):
+        """
+        Estimate the time left to render the tasks that are not finished
+
+        :return: seconds left
+        :rtype: float
+        """
+
+        observed = sum(total for total, _ in self.durations.values())
+        reference = sum(RenderPlan.COSTS.get(plot_type, RenderPlan.DEFAULT_COST) * number
+                        for plot_type, (_, number) in self.durations.items())
+        scale = observed / reference if observed and reference else 1.0
+        left = 0.0
+        for plot_type, number in self.pending.items():
+            if plot_type in self.durations:
+                total, rendered = self.durations[plot_type]
+                left += number * total / rendered
+            else:
+                left += number * RenderPlan.COSTS.get(plot_type, RenderPlan.DEFAULT_COST) * scale
+        parallel = min(observed / self.elapsed, self.jobs) if observed and self.elapsed > 0 else self.jobs
+        return left / parallel
+
+    def counts(self):
+        return {"done": self.done, "failed": self.failed, "running": len(self.running),
+                "remaining": self.total - self.done, "total": self.total}
+
+    def emit(self, event, **fields):
+        """
+        Send an event to the callback and to the events file
+
+        :param event: name of the event
+        :type event: str
+        :return: the event
+        :rtype: dict
+        """
+
+        record = {"event": event, "time": round(time.time(), 3), "elapsed": round(self.elapsed, 3), **fields}
+        if self._file is not None:
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+        if self.callback is not None:
+            try:
+                self.callback(record)
+            except Exception:
+                # A failing progress display must not stop the rendering
+                self.logger.exception(f"Progress callback failed on {event} event")
+        return record
+
+    def start(self):
+        """Start the run"""
+
+        with self._lock:
+            if self.events_path is not None:
+                self._file = open(self.events_path, "a", encoding="utf-8")
+            self.start_time = time.perf_counter()
+            self.emit("run_start", total=self.total, skipped=self.skipped, jobs=self.jobs, eta=round(self.eta(), 3))
+
+    def finish(self):
+        """Finish the run, after all the tasks or when it is interrupted"""
+
+        with self._lock:
+            self.emit("run_finish", **self.counts(), throughput=self.throughput())
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.finish()
+
+    def task_started(self, task):
+        """
+        Report that a task started
+
+        :param task: the task
+        :type task: class: 'isoplot.main.render.RenderTask'
+        """
+
+        with self._lock:
+            task_id = ProgressTracker.task_id(task)
+            if task_id in self.finished:
+                return
+            self.running.add(task_id)
+            self.emit("task_start", task=ProgressTracker.describe(task), **self.counts())
+
+    def task_finished(self, task, wall, error=None):
+        """
+        Report that a task finished. A task that was already reported is ignored, as when a worker process dies after
+        some of the tasks of its chunk.
+
+        :param task: the task
+        :type task: class: 'isoplot.main.render.RenderTask'
+        :param wall: render time of the task in seconds, None if it is not known
+        :type wall: float
+        :param error: error of the task if it failed
+        :type error: str
+        """
+
+        with self._lock:
+            task_id = ProgressTracker.task_id(task)
+            if task_id in self.finished:
+                return
+            self.running.discard(task_id)
+            self.finished.add(task_id)
+            plot_type = ProgressTracker.plot_type(task)
+            self.pending[plot_type] -= 1
+            if error is not None:
+                self.failed += 1
+            elif wall is not None:
+                total, number = self.durations.get(plot_type, (0.0, 0))
+                self.durations[plot_type] = (total + wall, number + 1)
+            self.emit("task_finish", task=ProgressTracker.describe(task), wall=None if wall is None else round(wall, 3),
+                      success=error is None, **self.counts(), throughput=self.throughput(), eta=round(self.eta(), 3))
+
+    @contextlib.contextmanager
+    def track(self, task):
+        """
+        Report the start and the end of a task rendered in the block
+
+        :param task: the task
+        :type task: class: 'isoplot.main.render.RenderTask'
+        """
+
+        self.task_started(task)
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as err:
+            self.task_finished(task, time.perf_counter() - start, error=repr(err))
+            raise
+        self.task_finished(task, time.perf_counter() - start)
+
+
+def format_duration(seconds):
+    """Format a duration in seconds as 1h02m, 3m05s or 12s"""
+
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+class ProgressLog:
+    """
+    Callback of a ProgressTracker logging the progress of the run at most every interval seconds, and at its start
+    and end
+
+    :param logger: logger of the progress messages
+    :type logger: class: 'logging.Logger'
+    :param interval: minimum number of seconds between two messages
+    :type interval: float
+    """
+
+    def __init__(self, logger, interval=10):
+
+        self.logger = logger
+        self.interval = interval
+        self.last = None
+
+    def __call__(self, event):
+
+        if event["event"] == "run_start":
+            self.last = event["elapsed"]
+            self.logger.info(f"Rendering {event['total']} plots, estimated time "
+                             f"{format_duration(event['eta'])}")
+        elif event["event"] == "task_finish":
+            if not event["success"] or event["elapsed"] - self.last >= self.interval:
+                self.last = event["elapsed"]
+                self.logger.info(f"Plots: {event['done']}/{event['total']} done ({event['failed']} failed), "
+                                 f"{event['throughput'] or 0:.2f} plots/s, about {format_duration(event['eta'])} left")
+        elif event["event"] == "run_finish":
+            self.logger.info(f"Rendered {event['done']}/{event['total']} plots in {format_duration(event['elapsed'])}"
+                             f" ({event['failed']} failed)")
@@ -0,0 +1,579 @@
+"""Module containing the render tasks of the command-line interface and their execution in a process pool"""
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import contextlib
+import copy
+import hashlib
+import json
+import multiprocessing
+import os
+import pathlib as pl
+import tempfile
+import threading
+import time
+import traceback
+
+import pandas as pd
+
+import isoplot
+from isoplot.main.dataprep import IsoplotData
+from isoplot.main.profiling import Measure, RunProfile
+from isoplot.main.sinks import StagingSink
+
+
+class RenderTask:
+    """
+    One plot to render
+
+    :param kind: family of the plot ('static', 'interactive' or 'map')
+    :type kind: str
+    :param method: name of the plot method to call
+    :type method: str
+    :param plot_name: name of the plot type, used for the output directory or as prefix in the archive
+    :type plot_name: str
+    :param metabolite: metabolite to plot (None for maps)
+    :type metabolite: str
+    :param value: value to plot (None for maps)
+    :type value: str
+    """
+
+    def __init__(self, kind, method, plot_name, metabolite=None, value=None):
+
+        self.kind = kind
+        self.method = method
+        self.plot_name = plot_name
+        self.metabolite = metabolite
+        self.value = value
+
+    def __repr__(self):
+        return f"RenderTask({self.kind}, {self.method}, {self.plot_name}, {self.metabolite}, {self.value})"
+
+
+class RenderResult:
+    """
+    Outcome of a render task
+
+    :param task: the task that was rendered
+    :type task: class: 'isoplot.main.render.RenderTask'
+    :param files: names of the files written by the task, relative to the sink of the renderer
+    :type files: list
+    :param error: formatted traceback if the task failed, None otherwise
+    :type error: str
+    """
+
+    def __init__(self, task, files=None, error=None):
+
+        self.task = task
+        self.files = files
+        self.error = error
+        # Measures of the render when the renderer profiles its tasks (see isoplot.main.profiling.RunProfile)
+        self.profile = None
+
+    @property
+    def fig_name(self):
+        """Name of the main file of the task"""
+
+        return self.files[0] if self.files else None
+
+
+class RenderPlan:
+    """
+    Render tasks compiled from the plot options, in rendering order. The tasks of a metabolite are consecutive, so
+    that the tables they share are computed once and dropped before the next metabolite (see Renderer.get_plot).
+
+    :param tasks: tasks to render
+    :type tasks: list of class: 'isoplot.main.render.RenderTask'
+    """
+
+    # Reference render times in seconds, measured for png output on the test dataset (42 samples). They give an order
+    # of magnitude of the cost of a plan, which grows with the number of samples and isotopologues.
+    COSTS = {("static", "stacked_areaplot"): 1.0, ("static", "barplot"): 1.1, ("static", "mean_barplot"): 0.7,
+             ("static", "mean_enrichment_plot"): 0.75, ("static", "mean_enrichment_meanplot"): 0.55,
+             ("interactive", "stacked_barplot"): 0.3, ("interactive", "unstacked_barplot"): 0.3,
+             ("interactive", "stacked_meanplot"): 0.4, ("interactive", "unstacked_meanplot"): 0.4,
+             ("interactive", "mean_enrichment_plot"): 0.1, ("interactive", "mean_enrichment_meanplot"): 0.15,
+             ("interactive", "stacked_areaplot"): 0.2, ("map", "build_heatmap"): 0.9, ("map", "build_clustermap"): 1.5,
+             ("map", "build_interactive_heatmap"): 0.1}
+    DEFAULT_COST = 0.5
+    # Plots reading the ID x isotopologue table of their metabolite, from the value tensor when it was built
+    PIVOT_PLOTS = {("static", "stacked_areaplot"), ("static", "barplot"), ("interactive", "stacked_barplot"),
+                   ("interactive", "unstacked_barplot"), ("interactive", "stacked_areaplot")}
+
+    def __init__(self, tasks):
+
+        self.tasks = tasks
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def __iter__(self):
+        return iter(self.tasks)
+
+    @staticmethod
+    def task_cost(task):
+        """Get the estimated render time of a task in seconds"""
+
+        return RenderPlan.COSTS.get((task.kind, task.method), RenderPlan.DEFAULT_COST)
+
+    def reads_pivot(self):
+        """Check whether a task of the plan reads the ID x isotopologue table of its metabolite"""
+
+        return any((task.kind, task.method) in RenderPlan.PIVOT_PLOTS for task in self.tasks)
+
+    def count(self):
+        """
+        Count the tasks and sum their estimated cost by plot type and method
+
+        :return: (number of tasks, estimated seconds) by (plot_name, method), in order of first appearance
+        :rtype: dict
+        """
+
+        counts = {}
+        for task in self.tasks:
+            number, cost = counts.get((task.plot_name, task.method), (0, 0))
+            counts[(task.plot_name, task.method)] = (number + 1, cost + RenderPlan.task_cost(task))
+        return counts
+
+    def summary(self, jobs=1):
+        """
+        Describe the plan: tasks and estimated cost by plot type, and total estimated time
+
+        :param jobs: number of render workers
+        :type jobs: int
+        :rtype: str
+        """
+
+        metabolites = {task.metabolite for task in self.tasks if task.metabolite is not None}
+        lines = [f"Render plan: {len(self.tasks)} plots, {len(metabolites)} metabolites"]
+        total = 0
+        for (plot_name, method), (number, cost) in self.count().items():
+            lines.append(f"  {plot_name:<32}{method:<28}{number:>6}{cost:>10.1f} s")
+            total += cost
+        lines.append(f"Estimated render time: {total:.1f} s, about {total / max(jobs, 1):.1f} s with {jobs} job(s)")
+        return "\n".join(lines)
+
+
+class Renderer:
+    """
+    Renders tasks from a prepared dataset. Plot objects are reused between consecutive tasks on the same metabolite
+    and value.
+
+    :param data_object: object containing the prepared data
+    :type data_object: class: 'isoplot.main.dataprep.IsoplotData'
+    :param run_name: name of the run
+    :type run_name: str
+    :param conditions: conditions to plot
+    :type conditions: list
+    :param times: times to plot
+    :type times: list
+    :param fmt: format of the static plots
+    :type fmt: str
+    :param stack: should barplots be stacked
+    :type stack: bool
+    :param annot: should annotations be added on maps
+    :type annot: bool
+    :param sink: destination of the plots. Each plot type writes in a child of the sink named after it
+    :type sink: class: 'isoplot.main.sinks.OutputSink'
+    """
+
+    def __init__(self, data_object, run_name, conditions, times, fmt, stack, annot, sink):
+
+        self.data_object = data_object
+        self.run_name = run_name
+        self.conditions = conditions
+        self.times = times
+        self.fmt = fmt
+        self.stack = stack
+        self.annot = annot
+        self.sink = sink
+        self.shared_dir = None
+        # Set on worker copies that stage their files for the main process
+        self.collect = False
+        # Should each task be measured, and directory in which the cProfile statistics of the tasks are dumped
+        self.profile = False
+        self.stats_dir = None
+        # Reports the start and the end of each task (see isoplot.main.progress.ProgressTracker)
+        self.progress = None
+        self._fingerprints = {}
+        self.reset_cache()
+
+    def __getstate__(self):
+        # Plot objects and intermediate tables are rebuilt by each worker
+        state = self.__dict__.copy()
+        state.update(_plot_key=None, _plot=None, _metabolite=None, _intermediates={}, _fingerprints={})
+        return state
+
+    def reset_cache(self):
+        """Drop the plot object and the intermediate tables of the current metabolite"""
+
+        self._plot_key, self._plot = None, None
+        self._metabolite, self._intermediates = None, {}
+
+    def publish(self, directory):
+        """
+        Publish the prepared data in a directory (see IsoplotData.publish_shared) and get a copy of the renderer
+        for the workers (see for_workers) without the data, that attaches to the published data once in a worker
+        process. Only IsoplotData objects can be published.
+
+        :param directory: existing directory where the data is written
+        :type directory: str or class: 'pathlib.Path'
+        :return: renderer to send to the workers, or None if the data cannot be published
+        :rtype: class: 'isoplot.main.render.Renderer'
+        """
+
+        if not isinstance(self.data_object, IsoplotData):
+            return None
+        self.data_object.publish_shared(directory)
+        renderer = self.for_workers(pl.Path(directory) / "staging")
+        renderer.data_object, renderer.shared_dir = None, str(directory)
+        return renderer
+
+    def attach(self):
+        """Attach to the published data if the renderer was published without it"""
+
+        if self.data_object is None and self.shared_dir is not None:
+            self.data_object = IsoplotData(None)
+            self.data_object.attach_shared(self.shared_dir)
+
+    def for_workers(self, staging_dir):
+        """
+        Get a copy of the renderer to send to worker processes. When the sink cannot be written to from several
+        processes, the copy stages its files in a directory, from which the main process moves them to the sink.
+
+        :param staging_dir: directory in which the files are staged
+        :type staging_dir: str or class: 'pathlib.Path'
+        :rtype: class: 'isoplot.main.render.Renderer'
+        """
+
+        renderer = copy.copy(self)
+        if not self.sink.shared:
+            renderer.sink, renderer.collect = StagingSink(staging_dir, self.sink.separator), True
+        return renderer
+
+    def get_plot(self, task):
+        """
+        Get the plot object of a task, reusing the one of the previous task when possible. The plots of a metabolite
+        share their intermediate tables, which are dropped when a task on another metabolite starts.
+        """
+
+        # The plotting libraries are slow to import, they are only loaded once a plot is rendered
+        from isoplot.main.plots import StaticPlot, InteractivePlot, Map
+
+        key = (task.kind, task.metabolite, task.value)
+        if key != self._plot_key:
+            self._plot = None
+            if task.metabolite != self._metabolite:
+                self._metabolite, self._intermediates = task.metabolite, {}
+            if task.kind == "static":
+                plot = StaticPlot(self.stack, task.value, self.data_object, self.run_name, task.metabolite,
+                                  self.conditions, self.times, self.fmt, display=False, rtrn=False,
+                                  intermediates=self._intermediates)
+            elif task.kind == "interactive":
+                plot = InteractivePlot(self.stack, task.value, self.data_object, self.run_name, task.metabolite,
+                                       self.conditions, self.times, display=False, rtrn=False,
+                                       intermediates=self._intermediates)
+            else:
+                plot = Map(self.data_object, self.run_name, self.annot, self.fmt)
+            self._plot_key, self._plot = key, plot
+        return self._plot
+
+    def data_fingerprint(self, metabolite):
+        """
+        Get a hash of the data plotted by the tasks of a metabolite, or by the maps if metabolite is None (the
+        mean_enrichment table). It does not depend on the other metabolites of the dataset.
+
+        :param metabolite: metabolite of the tasks
+        :type metabolite: str
+        :rtype: str
+        """
+
+        if metabolite not in self._fingerprints:
+            if isinstance(self.data_object, IsoplotData):
+                if metabolite is None:
+                    data = self.data_object.mean_enrichment
+                    data = self.data_object.dfmerge if data is None else data.reset_index()
+                else:
+                    data = self.data_object.get_metabolite_data(metabolite)
+            else:
+                data = self.data_object
+                if metabolite is not None:
+                    data = data[data["metabolite"] == metabolite]
+            hasher = hashlib.sha256(json.dumps([str(column) for column in data.columns]).encode())
+            hasher.update(pd.util.hash_pandas_object(data, index=False).to_numpy().tobytes())
+            self._fingerprints[metabolite] = hasher.hexdigest()
+        return self._fingerprints[metabolite]
+
+    def task_key(self, task):
+        """
+        Get the key of a task: a hash of the version of isoplot, of the task, of the plot settings and of the data it
+        plots. Two tasks with the same key write the same files.
+
+        :param task: the task
+        :type task: class: 'isoplot.main.render.RenderTask'
+        :rtype: str
+        """
+
+        settings = [isoplot.__version__, task.kind, task.method, task.plot_name, task.metabolite, task.value,
+                    self.run_name, [str(condition) for condition in self.conditions],
+                    [str(time) for time in self.times], self.fmt, self.stack, self.annot, self.sink.separator]
+        hasher = hashlib.sha256(json.dumps(settings).encode())
+        hasher.update(self.data_fingerprint(task.metabolite).encode())
+        return hasher.hexdigest()
+
+    def render(self, task):
+        """
+        Render a task in the child of the sink named after its plot type
+
+        :param task: the task to render
+        :type task: class: 'isoplot.main.render.RenderTask'
+        :rtype: class: 'isoplot.main.render.RenderResult'
+        """
+
+        measure = Measure() if self.profile else contextlib.nullcontext()
+        with measure:
+            plot = self.get_plot(task)
+            # Each task records its own files, the renderer can be shared by threads
+            plot.sink = self.sink.child(task.plot_name).recording(timed=self.profile)
+            getattr(plot, task.method)()
+        result = RenderResult(task, plot.sink.written)
+        if self.profile:
+            result.profile = dict(measure.record, writes=plot.sink.write_times)
+        return result
+
+    def render_chunk(self, tasks):
+        """Render tasks one after the other. A failing task is reported in its result and does not stop the others"""
+
+        results = []
+        stats_path = RunProfile.render_stats_path(self.stats_dir) if self.stats_dir is not None else None
+        with Measure(stats_path):
+            for task in tasks:
+                if self.progress is not None:
+                    self.progress.task_started(task)
+                start = time.perf_counter()
+                try:
+                    results.append(self.render(task))
+                except Exception:
+                    results.append(RenderResult(task, error=traceback.format_exc()))
+                    # The plot object and the figures of a failed task may be left in a bad state
+                    self.reset_cache()
+                    import matplotlib.pyplot as plt
+                    plt.close("all")
+                if self.progress is not None:
+                    self.progress.task_finished(task, time.perf_counter() - start, results[-1].error)
+        return results
+
+
+class QueueReporter:
+    """
+    Progress reporter of the worker processes, which sends the start and the end of the tasks to the main process
+    through a queue (see relay_progress)
+
+    :param queue: queue of the process pool
+    :type queue: class: 'multiprocessing.Queue'
+    """
+
+    def __init__(self, queue):
+
+        self.queue = queue
+
+    def task_started(self, task):
+        self.queue.put(("task_started", task, None, None))
+
+    def task_finished(self, task, wall, error=None):
+        self.queue.put(("task_finished", task, wall, error))
+
+
+def relay_progress(queue, progress):
+    """Forward the progress of the worker processes to the reporter of the main process, until None is received"""
+
+    for name, task, wall, error in iter(queue.get, None):
+        if name == "task_started":
+            progress.task_started(task)
+        else:
+            progress.task_finished(task, wall, error)
+
+
+# Renderer of the current worker process, set by the pool initializer
+_worker_renderer = None
+
+
+def init_worker(renderer):
+    """Initializer of the worker processes"""
+
+    global _worker_renderer
+    renderer.attach()
+    _worker_renderer = renderer
+
+
+def render_chunk(tasks, marker=None):
+    """
+    Entry point of the worker processes
+
+    :param tasks: tasks to render
+    :type tasks: list of class: 'isoplot.main.render.RenderTask'
+    :param marker: file that exists while the chunk is rendered, to find the chunks of a worker that died
+    :type marker: str
+    """
+
+    if marker is not None:
+        open(marker, "w").close()
+    results = _worker_renderer.render_chunk(tasks)
+    if marker is not None:
+        os.remove(marker)
+    return results
+
+
+def run_pool(renderer, worker_renderer, chunks, jobs, context, marker_dir, retries=1):
+    """
+    Render chunks in a pool of processes and yield their results in order. When a worker dies, the pool breaks and
+    the chunks that were not finished are submitted to a new pool. The chunks that were being rendered when it broke
+    are rendered again one at a time, in a pool of one worker, so that the chunk killing its worker is found: after
+    retries more deaths, its tasks are reported as failed.
+
+    :param renderer: renderer of the main process
+    :type renderer: class: 'isoplot.main.render.Renderer'
+    :param worker_renderer: renderer given to the workers
+    :type worker_renderer: class: 'isoplot.main.render.Renderer'
+    :param chunks: chunks of tasks
+    :type chunks: list of lists of class: 'isoplot.main.render.RenderTask'
+    :param jobs: number of workers
+    :type jobs: int
+    :param context: multiprocessing context of the workers
+    :param marker_dir: directory of the files marking the chunks being rendered
+    :type marker_dir: class: 'pathlib.Path'
+    :param retries: number of times a chunk that killed its worker alone is rendered again
+    :type retries: int
+    :return: generator of class: 'isoplot.main.render.RenderResult'
+    """
+
+    def fail(index, error):
+        results = [RenderResult(task, error=error) for task in chunks[index]]
+        if renderer.progress is not None:
+            for result in results:
+                renderer.progress.task_finished(result.task, None, result.error)
+        return results
+
+    def ready():
+        # Results are yielded in the order of the chunks, as soon as all the previous ones are done
+        nonlocal position
+        while position in done:
+            for result in done.pop(position):
+                if worker_renderer.collect and result.files:
+                    # Staged files are moved one at a time, so that only one of them is in memory
+                    worker_renderer.sink.transfer(result.files, renderer.sink)
+                yield result
+            position += 1
+
+    marker_dir.mkdir(exist_ok=True)
+    done, position = {}, 0
+    todo, suspects, deaths = list(range(len(chunks))), [], {}
+    while todo or suspects:
+        isolated = not todo
+        batch = suspects[:1] if isolated else todo
+        errors = {}
+        workers = 1 if isolated else min(jobs, len(batch))
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker,
+                                 initargs=(worker_renderer,)) as executor:
+            futures = [executor.submit(render_chunk, chunks[index], str(marker_dir / str(index)))
+                       for index in batch]
+            for index, future in zip(batch, futures):
+                try:
+                    done[index] = future.result()
+                except BrokenProcessPool:
+                    errors[index] = traceback.format_exc()
+                except Exception:
+                    done[index] = fail(index, traceback.format_exc())
+                yield from ready()
+        if isolated:
+            suspects = suspects[1:]
+            for index, error in errors.items():
+                deaths[index] = deaths.get(index, 0) + 1
+                if deaths[index] > retries:
+                    done[index] = fail(index, error)
+                else:
+                    suspects.insert(0, index)
+        else:
+            running = [index for index in errors if (marker_dir / str(index)).exists()]
+            # Without markers, as when a worker dies before its first chunk, all the chunks left are suspects
+            suspects.extend(running or list(errors))
+            todo = [index for index in errors if index not in suspects]
+        for index in suspects:
+            with contextlib.suppress(FileNotFoundError):
+                (marker_dir / str(index)).unlink()
+        yield from ready()
+
+
+def run_tasks(renderer, tasks, jobs=1, chunk_size=None, start_method=None, threads=False, retries=1):
+    """
+    Render tasks, in a pool of processes or threads if more than one job is requested. Results are yielded in the
+    order of the tasks. If a worker process dies, the results of the other chunks are kept, the unfinished chunks are
+    rendered in a new pool and the tasks of the chunk that killed the worker are reported as failed (see run_pool).
+
+    Forked workers share the prepared data with the main process copy-on-write. With the other start methods, the
+    prepared data is published once in a temporary directory ($TMPDIR, which can be set to a memory filesystem such as
+    /dev/shm) and memory-mapped by the workers, instead of being pickled to each of them.
+
+    Threads share the data and the sink of the renderer. Static figures are built and saved one at a time (matplotlib
+    styles are global and read when figures are drawn), the data preparation and the interactive plots run
+    concurrently. Threads need matplotlib 3.6 or later (per-thread font cache).
+
+    The progress reporter of the renderer is told when each task starts and finishes, as it happens in the workers.
+
+    :param renderer: renderer holding the prepared data and the plot settings
+    :type renderer: class: 'isoplot.main.render.Renderer'
+    :param tasks: tasks to render
+    :type tasks: list of class: 'isoplot.main.render.RenderTask'
+    :param jobs: number of workers
+    :type jobs: int
+    :param chunk_size: number of consecutive tasks sent to a worker at once. Defaults to about four chunks per worker
+    :type chunk_size: int
+    :param start_method: multiprocessing start method of the workers. Defaults to the platform default
+    :type start_method: str
+    :param threads: should the workers be threads instead of processes
+    :type threads: bool
+    :param retries: number of times a chunk that killed its worker process is rendered again
+    :type retries: int
+    :return: generator of class: 'isoplot.main.render.RenderResult'
+    """
+
+    if not chunk_size:
+        chunk_size = max(1, len(tasks) // (max(jobs, 1) * 4))
+    chunks = [tasks[i:i + chunk_size] for i in range(0, len(tasks), chunk_size)]
+    if jobs <= 1:
+        for chunk in chunks:
+            yield from renderer.render_chunk(chunk)
+        return
+    if threads:
+        def render_copy(chunk):
+            # Each chunk gets its own copy of the renderer, which caches the plot object of its current task
+            thread_renderer = copy.copy(renderer)
+            thread_renderer.reset_cache()
+            return thread_renderer.render_chunk(chunk)
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = [executor.submit(render_copy, chunk) for chunk in chunks]
+            for future in futures:
+                yield from future.result()
+        return
+    context = multiprocessing.get_context(start_method)
+    with tempfile.TemporaryDirectory(prefix="isoplot-shared-") as shared_dir:
+        worker_renderer = None
+        if context.get_start_method() != "fork":
+            worker_renderer = renderer.publish(shared_dir)
+        if worker_renderer is None:
+            worker_renderer = renderer.for_workers(pl.Path(shared_dir) / "staging")
+        relay = None
+        if renderer.progress is not None:
+            queue = context.Queue()
+            worker_renderer.progress = QueueReporter(queue)
+            relay = threading.Thread(target=relay_progress, args=(queue, renderer.progress), daemon=True)
+            relay.start()
+        try:
+            yield from run_pool(renderer, worker_renderer, chunks, jobs, context, pl.Path(shared_dir) / "running",
+                                retries)
+        finally:
+            if relay is not None:
+                # The workers have exited, all their messages are in the queue before this one
+                queue.put(None)
+                relay.join()
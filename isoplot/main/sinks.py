@@ -0,0 +1,278 @@
+"""Module containing the output sinks, the destinations in which the plots write their files"""
+
+import copy
+import pathlib as pl
+import threading
+import time
+import zipfile
+
+
+class OutputSink:
+    """
+    Destination of the files created by the plots. Files are written by name, and a child sink writes its files
+    under a prefix of its parent (a sub-directory for instance). Sinks never depend on the working directory.
+
+    :param separator: separator between the prefix of a child sink and the names of its files
+    :type separator: str
+    """
+
+    # Can the sink be written to from several processes at once
+    shared = False
+    # List in which the names of the written files are recorded (relative to the root of the sink), None to not record
+    written = None
+    # List in which the duration and size of each write are recorded, None to not time the writes
+    write_times = None
+
+    def __init__(self, separator="/"):
+
+        self.separator = separator
+        self.prefix = ""
+
+    def child(self, name):
+        """
+        Get a sink writing its files under a prefix of this sink
+
+        :param name: name of the child (sub-directory, or prefix in flat archives)
+        :type name: str
+        :rtype: class: 'isoplot.main.sinks.OutputSink'
+        """
+
+        child = copy.copy(self)
+        child.prefix = self.prefix + name + self.separator
+        return child
+
+    def recording(self, timed=False):
+        """
+        Get a copy of the sink recording the names of the files written through it and its children in its written
+        list
+
+        :param timed: should the duration and size of each write also be recorded, in the write_times list
+        :type timed: bool
+        :rtype: class: 'isoplot.main.sinks.OutputSink'
+        """
+
+        sink = copy.copy(self)
+        sink.written = []
+        sink.write_times = [] if timed else None
+        return sink
+
+    def write(self, name, content):
+        """
+        Write a file in the sink
+
+        :param name: name of the file, relative to the sink
+        :type name: str
+        :param content: content of the file. Text is encoded in utf-8
+        :type content: bytes or str
+        """
+
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        start = time.perf_counter()
+        self._write(self.prefix + name, content)
+        if self.write_times is not None:
+            self.write_times.append({"file": self.prefix + name, "wall": time.perf_counter() - start,
+                                     "bytes": len(content)})
+        if self.written is not None:
+            self.written.append(self.prefix + name)
+
+    def _write(self, name, content):
+        raise NotImplementedError
+
+    def close(self):
+        """Finalize the sink once every file is written"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class DirectorySink(OutputSink):
+    """
+    Sink writing files in a directory, child sinks are sub-directories. Directories are created when needed.
+
+    :param root: directory in which the files are written
+    :type root: str or class: 'pathlib.Path'
+    """
+
+    shared = True
+
+    def __init__(self, root):
+
+        super().__init__("/")
+        self.root = pl.Path(root).resolve()
+
+    def path(self, name):
+        """Get the path of a file of the sink"""
+
+        return self.root / (self.prefix + name)
+
+    def _write(self, name, content):
+
+        path = self.root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+
+
+class ZipSink(OutputSink):
+    """
+    Sink writing files in a zip archive. By default the archive is flat: child sinks prefix the names of their files
+    with their name and an underscore. Writes are thread-safe.
+
+    Each file is compressed into the archive as soon as it is written, so nothing is kept in memory. With checkpoint,
+    the central directory is also written after the first file and then every checkpoint_files files or
+    checkpoint_seconds seconds: an interrupted run leaves a valid archive with the files written up to the last
+    checkpoint. Each checkpoint rewrites the whole directory (about 100 bytes per file in the archive), which is why it
+    is not done after every file.
+
+    Files are compressed according to their extension. Text formats (svg, html) shrink several times with deflate,
+    while png and jpeg are already compressed and are stored as they are.
+
+    :param path: path of the archive
+    :type path: str or class: 'pathlib.Path'
+    :param separator: separator between the prefix of a child sink and the names of its files
+    :type separator: str
+    :param checkpoint: should the archive be kept valid while it is written
+    :type checkpoint: bool
+    :param checkpoint_files: maximum number of files written between two checkpoints
+    :type checkpoint_files: int
+    :param checkpoint_seconds: maximum number of seconds between two checkpoints, checked when a file is written
+    :type checkpoint_seconds: float
+    :param compression: compression of the files by extension, as (method, level) tuples. The level is None for the
+                        default level of the method. Extensions not given use DEFAULT_COMPRESSION
+    :type compression: dict
+    """
+
+    METHODS = {"stored": zipfile.ZIP_STORED, "deflated": zipfile.ZIP_DEFLATED, "bzip2": zipfile.ZIP_BZIP2,
+               "lzma": zipfile.ZIP_LZMA}
+    # Valid compression levels of the methods (lzma has no level in zipfile)
+    LEVELS = {"deflated": range(0, 10), "bzip2": range(1, 10)}
+    DEFAULT_COMPRESSION = {"png": (zipfile.ZIP_STORED, None), "jpeg": (zipfile.ZIP_STORED, None),
+                           "svg": (zipfile.ZIP_DEFLATED, 6), "html": (zipfile.ZIP_DEFLATED, 6),
+                           "pdf": (zipfile.ZIP_DEFLATED, 6), "": (zipfile.ZIP_DEFLATED, 6)}
+
+    def __init__(self, path, separator="_", checkpoint=True, compression=None, checkpoint_files=100,
+                 checkpoint_seconds=10):
+
+        super().__init__(separator)
+        self.path = pl.Path(path)
+        self.checkpoint = checkpoint
+        self.checkpoint_files = checkpoint_files
+        self.checkpoint_seconds = checkpoint_seconds
+        self.compression = dict(ZipSink.DEFAULT_COMPRESSION, **(compression or {}))
+        self.archive = zipfile.ZipFile(self.path, mode="w")
+        self.lock = threading.Lock()
+        # Files written since the last checkpoint, and its time (None before the first one)
+        self._unchecked = 0
+        self._checkpoint_time = None
+
+    @staticmethod
+    def parse_compression(specs):
+        """
+        Parse compression settings given as 'extension=method' or 'extension=method:level' strings, for instance
+        'svg=deflated:9' or 'html=lzma'
+
+        :param specs: compression settings
+        :type specs: list of str
+        :return: compression of the files by extension, as (method, level) tuples
+        :rtype: dict
+        """
+
+        compression = {}
+        for spec in specs:
+            extension, _, setting = spec.partition("=")
+            method, _, level = setting.partition(":")
+            if not extension or method not in ZipSink.METHODS:
+                raise ValueError(f"Invalid compression '{spec}'. Expected extension=method[:level] with method in "
+                                 f"{', '.join(ZipSink.METHODS)}")
+            if level and (not level.isdigit() or int(level) not in ZipSink.LEVELS.get(method, [])):
+                raise ValueError(f"Invalid compression level in '{spec}'")
+            compression[extension.lstrip(".").lower()] = (ZipSink.METHODS[method], int(level) if level else None)
+        return compression
+
+    def get_compression(self, name):
+        """Get the (method, level) compression of a file from its extension"""
+
+        extension = pl.PurePosixPath(name).suffix.lstrip(".").lower()
+        return self.compression.get(extension, self.compression[""])
+
+    def _write(self, name, content):
+
+        method, level = self.get_compression(name)
+        with self.lock:
+            self.archive.writestr(name, content, compress_type=method, compresslevel=level)
+            self._unchecked += 1
+            if self.checkpoint and (self._checkpoint_time is None or self._unchecked >= self.checkpoint_files or
+                                    time.monotonic() - self._checkpoint_time >= self.checkpoint_seconds):
+                self.write_directory()
+                self._unchecked, self._checkpoint_time = 0, time.monotonic()
+
+    def write_directory(self):
+        """Write the central directory at the end of the archive. The next file is written over it"""
+
+        archive = self.archive
+        if all(hasattr(archive, attribute) for attribute in ("fp", "start_dir", "_write_end_record")):
+            # ZipFile only writes its directory when it is closed, this is what close() does without closing the file
+            archive.fp.seek(archive.start_dir)
+            archive._write_end_record()
+        else:
+            # Without these internals (other python versions), the archive is closed and reopened to append to it
+            archive.close()
+            self.archive = zipfile.ZipFile(self.path, mode="a")
+
+    def close(self):
+
+        with self.lock:
+            self.archive.close()
+
+
+class MemorySink(OutputSink):
+    """
+    Sink keeping files in memory, in the files dictionary (name: content)
+
+    :param separator: separator between the prefix of a child sink and the names of its files
+    :type separator: str
+    """
+
+    def __init__(self, separator="/"):
+
+        super().__init__(separator)
+        self.files = {}
+
+    def _write(self, name, content):
+
+        self.files[name] = content
+
+
+class StagingSink(DirectorySink):
+    """
+    Directory sink in which worker processes stage their files when the final sink cannot be shared between
+    processes. The main process then moves them to the final sink one at a time (see transfer).
+
+    :param root: directory in which the files are staged
+    :type root: str or class: 'pathlib.Path'
+    :param separator: separator of the final sink, so that staged files have their final names
+    :type separator: str
+    """
+
+    def __init__(self, root, separator="/"):
+
+        super().__init__(root)
+        self.separator = separator
+
+    def transfer(self, names, sink):
+        """
+        Move staged files to another sink
+
+        :param names: names of the staged files
+        :type names: list
+        :param sink: final sink of the files
+        :type sink: class: 'isoplot.main.sinks.OutputSink'
+        """
+
+        for name in names:
+            path = self.root / name
+            sink.write(name, path.read_bytes())
+            path.unlink()
@@ -0,0 +1,124 @@
+"""Module checking whether a newer version of isoplot is available"""
+
+import json
+import logging
+import os
+import pathlib as pl
+import re
+import threading
+import time
+import urllib.request
+
+import isoplot
+
+# Seconds during which the result of a check is reused
+DEFAULT_TTL = 24 * 3600
+# Seconds to wait for the package index, the check is given up after
+TIMEOUT = 3
+INDEX_URL = "https://pypi.org/pypi/{name}/json"
+
+logger = logging.getLogger("isoplot_log.main.version")
+
+
+def parse_version(version):
+    """Get a comparable tuple from a x.y.z version number. Pre-release suffixes are ignored"""
+
+    match = re.match(r"\d+(\.\d+)*", version)
+    return tuple(int(part) for part in match.group().split(".")) if match else ()
+
+
+def fetch_latest_version(name):
+    """
+    Get the latest version of a package from the package index
+
+    :param name: name of the package
+    :type name: str
+    :return: latest version number
+    :rtype: str
+    """
+
+    with urllib.request.urlopen(INDEX_URL.format(name=name), timeout=TIMEOUT) as response:
+        return json.load(response)["info"]["version"]
+
+
+def read_cache(path, ttl):
+    """Get the cached result of the last check, or None if there is none or if it has expired"""
+
+    try:
+        with open(path, encoding="utf-8") as f:
+            cached = json.load(f)
+        if 0 <= time.time() - cached["checked"] < ttl:
+            return cached
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+
+def write_cache(path, latest):
+    """Store the result of a check. latest is None when the package index could not be reached"""
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump({"checked": time.time(), "latest": latest}, f)
+    os.replace(temp_path, path)
+
+
+def notify(latest):
+    """Tell the user when the installed version is older than the latest one"""
+
+    if latest is not None and parse_version(isoplot.__version__) < parse_version(latest):
+        print("Your version of Isoplot is outdated. Please run 'pip install isoplot' to get the latest "
+              "version.")
+
+
+def update_cache(name, path):
+    """Query the package index and cache the result. Failures, offline nodes for instance, are cached as well"""
+
+    try:
+        latest = fetch_latest_version(name)
+    except Exception as err:
+        logger.debug(f"Could not check the latest version of {name}: {err}")
+        latest = None
+    try:
+        write_cache(path, latest)
+    except OSError as err:
+        logger.debug(f"Could not cache the version check: {err}")
+    notify(latest)
+
+
+def check_version(name, cache_dir=None, ttl=DEFAULT_TTL, background=True):
+    """
+    Check if the installed version is outdated. The result of the check is cached for ttl seconds, and the package
+    index is only queried when the cache has expired, in a background thread so that the start-up is not delayed. If
+    the thread has not finished when the program ends, the result is reported by the next run. When the index cannot be
+    reached, the check is skipped until the cache expires again. Set $ISOPLOT_NO_VERSION_CHECK to disable the check.
+
+    :param name: name of the package
+    :type name: str
+    :param cache_dir: directory of the cache. Defaults to $ISOPLOT_CACHE_DIR, or ~/.cache/isoplot
+    :type cache_dir: str or class: 'pathlib.Path'
+    :param ttl: seconds during which the result of a check is reused
+    :type ttl: float
+    :param background: should the package index be queried in a background thread
+    :type background: bool
+    :return: the thread querying the package index, or None if it was not started
+    :rtype: class: 'threading.Thread'
+    """
+
+    if os.environ.get("ISOPLOT_NO_VERSION_CHECK"):
+        return None
+    if cache_dir is None:
+        cache_dir = os.environ.get("ISOPLOT_CACHE_DIR", pl.Path.home() / ".cache" / "isoplot")
+    path = pl.Path(cache_dir) / f"{name}_version_check.json"
+    cached = read_cache(path, ttl)
+    if cached is not None:
+        notify(cached["latest"])
+        return None
+    if not background:
+        update_cache(name, path)
+        return None
+    # Daemon thread: a short run does not wait for the package index before exiting
+    thread = threading.Thread(target=update_cache, args=(name, path), name="isoplot-version-check", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,61 @@
+""" Module for testing the synthetic datasets, the benchmark suite and the memory soak test"""
+
+from benchmarks.run import BenchmarkSuite, compare
+from benchmarks.soak import SoakTest
+from benchmarks.synthetic import generate_dataset, write_dataset
+from isoplot.main.dataprep import IsoplotData
+
+
+class TestBenchmarks:
+
+    def test_synthetic_dataset(self, tmp_path):
+
+        data, template = generate_dataset(metabolites=5, conditions=2, times=3, replicates=2, isotopologues=4)
+        assert len(template) == 12
+        assert sorted(data.groupby("metabolite")["isotopologue"].nunique()) == [2, 2, 3, 3, 4]
+        fractions = data.groupby(["sample", "metabolite"])["isotopologue_fraction"].sum()
+        assert fractions.round(9).eq(1).all()
+
+        data_path, template_path = write_dataset(tmp_path, metabolites=5, conditions=2, times=3, replicates=2)
+        data_object = IsoplotData(str(data_path))
+        data_object.get_data()
+        data_object.get_template(template_path)
+        data_object.merge_data()
+        data_object.prepare_data(export=None)
+        assert len(data_object.dfmerge) == len(data_object.data)
+        assert data_object.dfmerge["ID"].nunique() == 12
+
+    def test_suite(self, tmp_path):
+
+        suite = BenchmarkSuite({"metabolites": 3, "conditions": 2, "times": 2, "replicates": 2}, repeat=1,
+                               plot_metabolites=1, only=["load_*", "prepare_data", "static.barplot", "map.*"])
+        suite.run(tmp_path)
+        results = suite.to_json()["results"]
+
+        assert set(results) == {"load_isocor_data", "load_template", "prepare_data", "static.barplot",
+                                "map.construction", "map.build_heatmap", "map.build_clustermap",
+                                "map.build_interactive_heatmap"}
+        assert all(len(results[name]["times"]) == 1 for name in ["load_isocor_data", "static.barplot"])
+
+    def test_compare(self):
+
+        baseline = {"results": {"fast": {"median": 0.001}, "slow": {"median": 1.0}, "stable": {"median": 1.0},
+                                "failed": {"error": "ValueError"}}}
+        current = {"results": {"fast": {"median": 0.003}, "slow": {"median": 1.5}, "stable": {"median": 1.1},
+                               "failed": {"median": 1.0}, "new": {"median": 1.0}}}
+        ratios, regressions = compare(current, baseline, threshold=1.25, min_delta=0.005)
+
+        assert set(ratios) == {"fast", "slow", "stable"}
+        # fast is 3 times slower but by less than min_delta
+        assert regressions == ["slow"]
+
+    def test_soak(self, tmp_path):
+
+        soak = SoakTest({"metabolites": 3, "conditions": 2, "times": 2, "replicates": 2}, plots=4, warmup=1, traced=2,
+                        only=["data.IsoplotData", "static.barplot", "interactive.stacked_barplot"])
+        soak.run(tmp_path)
+
+        assert list(soak.results) == ["data.IsoplotData", "static.barplot", "interactive.stacked_barplot"]
+        assert all(result["plots"] == 4 and result["traced_growth"] is not None for result in soak.results.values())
+        assert soak.check(max_growth=float("inf"), max_traced_growth=float("inf")) == []
+        assert soak.check(max_growth=float("inf"), max_traced_growth=-1) == list(soak.results)
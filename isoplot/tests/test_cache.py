@@ -0,0 +1,68 @@
+""" Module for testing the prepared data cache"""
+
+from pathlib import Path
+
+import numpy as np
+import pytest
+from pandas.testing import assert_frame_equal
+
+from isoplot.main.cache import DataCache
+from isoplot.main.dataprep import IsoplotData
+
+DATA_PATH = Path("./isoplot/tests/test_data/160419_T_Daubon_MC_principale_res.csv").resolve()
+TEMPLATE_PATH = Path("./isoplot/tests/test_data/modified_for_testing.xlsx").resolve()
+
+
+@pytest.fixture(scope='function')
+def prepared_data():
+    data_object = IsoplotData(DATA_PATH)
+    data_object.get_data()
+    data_object.get_template(TEMPLATE_PATH)
+    data_object.merge_data()
+    data_object.prepare_data(False, build_tensor=True)
+    return data_object
+
+
+class TestDataCache:
+
+    def test_key(self, tmp_path):
+
+        cache = DataCache(tmp_path)
+        key = cache.make_key([DATA_PATH, TEMPLATE_PATH], {"compact": False})
+
+        assert key == cache.make_key([DATA_PATH, TEMPLATE_PATH], {"compact": False})
+        assert key != cache.make_key([DATA_PATH, TEMPLATE_PATH], {"compact": True})
+        assert key != cache.make_key([TEMPLATE_PATH, DATA_PATH], {"compact": False})
+        # The same bytes split differently between the data and the template
+        for name, content in [("a1", b"ab"), ("b1", b"c"), ("a2", b"a"), ("b2", b"bc")]:
+            (tmp_path / name).write_bytes(content)
+        assert cache.make_key([tmp_path / "a1", tmp_path / "b1"], {}) != \
+            cache.make_key([tmp_path / "a2", tmp_path / "b2"], {})
+
+    def test_store_and_load(self, tmp_path, prepared_data):
+
+        pytest.importorskip("pyarrow")
+        cache = DataCache(tmp_path)
+        key = cache.make_key([DATA_PATH, TEMPLATE_PATH], {})
+        assert not cache.load(key, IsoplotData(DATA_PATH))
+
+        cache.store(key, prepared_data)
+        loaded = IsoplotData(DATA_PATH)
+        assert cache.load(key, loaded)
+
+        assert_frame_equal(loaded.dfmerge, prepared_data.dfmerge.reset_index(drop=True))
+        assert_frame_equal(loaded.replicate_stats, prepared_data.replicate_stats)
+        assert_frame_equal(loaded.mean_enrichment.reset_index(drop=True),
+                           prepared_data.mean_enrichment.reset_index(drop=True))
+        assert np.array_equal(loaded.tensor.array, prepared_data.tensor.array, equal_nan=True)
+        assert loaded.tensor.ids.index.equals(prepared_data.tensor.ids.index)
+
+    def test_eviction(self, tmp_path, prepared_data):
+
+        pytest.importorskip("pyarrow")
+        cache = DataCache(tmp_path, max_size=1)
+        cache.store("first", prepared_data)
+        cache.store("second", prepared_data)
+
+        assert not (tmp_path / "first").exists()
+        assert (tmp_path / "second").exists()
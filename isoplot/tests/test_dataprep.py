@@ -1,11 +1,17 @@
 """ Module for deploying pytest tests"""
 
+import logging
 from pathlib import Path
 
 import pytest
-from pandas.api.types import is_numeric_dtype, is_string_dtype
+from pandas.testing import assert_frame_equal
+from pandas.api.types import is_integer_dtype, is_numeric_dtype, is_string_dtype
+from natsort import natsorted
+import numpy as np
+import pandas as pd
 from numpy import int64
 
+from isoplot.logger import configure_logging, stop_logging
 from isoplot.main.dataprep import IsoplotData
 
 
@@ -117,3 +123,252 @@ class TestDataprep:
 
         for ids in data_object.dfmerge["ID"]:
             assert len(ids.split("_")) == 3
+
+    def test_partition_index(self, data_object):
+
+        data_object.get_data()
+        data_object.get_template(Path("./isoplot/tests/test_data/modified_for_testing.xlsx").resolve())
+        data_object.merge_data()
+        data_object.prepare_data(False)
+
+        assert set(data_object.partitions.keys()) == set(data_object.dfmerge["metabolite"].unique())
+        for metabolite in data_object.dfmerge["metabolite"].unique():
+            metabolite_data = data_object.get_metabolite_data(metabolite)
+            expected = data_object.dfmerge[data_object.dfmerge["metabolite"] == metabolite]
+            assert metabolite_data.index.equals(expected.index)
+        with pytest.raises(KeyError):
+            data_object.get_metabolite_data("not_a_metabolite")
+
+    def test_replicate_stats(self, data_object):
+
+        data_object.get_data()
+        data_object.get_template(Path("./isoplot/tests/test_data/modified_for_testing.xlsx").resolve())
+        data_object.merge_data()
+        data_object.prepare_data(False)
+
+        metabolite = data_object.dfmerge["metabolite"].iloc[0]
+        metabolite_data = data_object.dfmerge[data_object.dfmerge["metabolite"] == metabolite]
+        grouped = metabolite_data.groupby(IsoplotData.REPLICATE_KEYS)["isotopologue_fraction"]
+        stats = data_object.replicate_stats.loc[metabolite]["isotopologue_fraction"]
+
+        assert list(stats.columns) == ["mean", "std", "n"]
+        assert stats["mean"].equals(grouped.mean().rename("mean"))
+        assert stats["std"].equals(grouped.std().rename("std"))
+        assert stats["n"].equals(grouped.count().rename("n"))
+
+    def test_tensor(self, data_object):
+
+        data_object.get_data()
+        data_object.get_template(Path("./isoplot/tests/test_data/modified_for_testing.xlsx").resolve())
+        data_object.merge_data()
+        data_object.prepare_data(False, build_tensor=True)
+
+        dfmerge = data_object.dfmerge
+        assert data_object.tensor.array.shape == (dfmerge["metabolite"].nunique(), dfmerge["ID"].nunique(),
+                                                  dfmerge["isotopologue"].nunique(), len(IsoplotData.PLOT_VALUES))
+
+        metabolite = dfmerge["metabolite"].iloc[0]
+        conditions = list(dfmerge["condition"].unique())[:2]
+        times = list(dfmerge["time"].unique())
+        filtered = dfmerge[(dfmerge["metabolite"] == metabolite) & dfmerge["condition"].isin(conditions)]
+        expected = filtered.pivot_table(index=["condition_order", "ID"], columns="isotopologue",
+                                        values="corrected_area").droplevel("condition_order")
+        matrix = data_object.tensor.get_matrix(metabolite, "corrected_area", conditions, times)
+        assert matrix.index.equals(expected.index)
+        assert matrix.columns.equals(expected.columns)
+        assert (matrix.to_numpy() == expected.to_numpy()).all()
+
+    def test_mean_enrichment_table(self, data_object):
+
+        data_object.get_data()
+        data_object.get_template(Path("./isoplot/tests/test_data/modified_for_testing.xlsx").resolve())
+        data_object.merge_data()
+        data_object.prepare_data(False)
+
+        dfmerge = data_object.dfmerge
+        table = data_object.mean_enrichment
+        assert len(table) == len(dfmerge[["metabolite", "ID"]].drop_duplicates())
+        assert not table.reset_index().duplicated(subset=["metabolite", "ID"]).any()
+        for (metabolite, sample_id), value in table.set_index("ID", append=True)["mean_enrichment"].items():
+            rows = dfmerge[(dfmerge["metabolite"] == metabolite) & (dfmerge["ID"] == sample_id)]
+            assert (rows["mean_enrichment"] == value).all()
+
+    def test_sample_table(self, data_object):
+
+        data_object.get_data()
+        data_object.get_template(Path("./isoplot/tests/test_data/modified_for_testing.xlsx").resolve())
+        data_object.merge_data()
+        data_object.prepare_data(False)
+
+        samples = data_object.samples
+        assert set(samples.index) == set(data_object.dfmerge["ID"])
+        assert samples["condition_order"].is_monotonic_increasing
+        assert sorted(samples["id_rank"]) == list(range(len(samples)))
+        assert list(samples.sort_values("id_rank").index) == natsorted(samples.index)
+        for sample_id, row in samples.iterrows():
+            assert sample_id == f"{row['condition']}_T{row['time']}_{row['number_rep']}"
+        assert is_integer_dtype(samples["id_rank"])
+
+    def test_compact_mode(self, data_object):
+
+        data_object.get_data()
+        data_object.get_template(Path("./isoplot/tests/test_data/modified_for_testing.xlsx").resolve())
+        data_object.merge_data()
+        data_object.prepare_data(False)
+
+        compact_object = IsoplotData(data_object.datapath, compact=True)
+        compact_object.get_data()
+        compact_object.get_template(Path("./isoplot/tests/test_data/modified_for_testing.xlsx").resolve())
+        compact_object.merge_data()
+        compact_object.prepare_data(False)
+
+        for col in IsoplotData.CATEGORICAL_COLUMNS:
+            assert compact_object.dfmerge[col].dtype == "category"
+        for col in IsoplotData.INTEGER_COLUMNS:
+            assert compact_object.dfmerge[col].dtype.itemsize < 8
+        assert compact_object.dfmerge.memory_usage(deep=True).sum() < \
+               data_object.dfmerge.memory_usage(deep=True).sum()
+        assert set(compact_object.partitions.keys()) == set(data_object.partitions.keys())
+        assert len(compact_object.replicate_stats) == len(data_object.replicate_stats)
+        assert compact_object.replicate_stats.index.tolist() == data_object.replicate_stats.index.tolist()
+        assert np.array_equal(compact_object.replicate_stats.to_numpy(), data_object.replicate_stats.to_numpy(),
+                              equal_nan=True)
+
+    @pytest.mark.parametrize("engine", ["c", "python"])
+    def test_load_isocor_data_delimiters(self, engine):
+
+        csv_data = IsoplotData.load_isocor_data(
+            Path("./isoplot/tests/test_data/160419_T_Daubon_MC_principale_res.csv").resolve(), engine=engine)
+        tsv_data = IsoplotData.load_isocor_data(
+            Path("./isoplot/tests/test_data/160419_T_Daubon_MC_principale_res.tsv").resolve(), engine=engine)
+
+        assert list(csv_data.columns) == list(IsoplotData.ISOCOR_DTYPES)
+        assert_frame_equal(csv_data, tsv_data)
+
+    def test_load_isocor_data_engine(self, monkeypatch):
+
+        read_csv, engines = pd.read_csv, []
+
+        def spy(*args, **kwargs):
+            engines.append(kwargs["engine"])
+            return read_csv(*args, **kwargs)
+
+        monkeypatch.setattr(pd, "read_csv", spy)
+        # The pyarrow engine is not available before pandas 1.4
+        monkeypatch.setattr(pd, "__version__", "1.3.5")
+        data = IsoplotData.load_isocor_data(
+            Path("./isoplot/tests/test_data/160419_T_Daubon_MC_principale_res.csv").resolve())
+
+        assert engines == ["c"]
+        assert list(data.columns) == list(IsoplotData.ISOCOR_DTYPES)
+
+    def test_all_columns(self, data_object):
+
+        data_object.get_data()
+        assert list(data_object.data.columns) == ["sample", "metabolite", "derivative", "isotopologue", "area",
+                                                  "corrected_area", "isotopologue_fraction", "residuum",
+                                                  "mean_enrichment"]
+
+        used_object = IsoplotData(data_object.datapath, all_columns=False)
+        used_object.get_data()
+        assert list(used_object.data.columns) == list(IsoplotData.ISOCOR_DTYPES)
+
+    def test_load_isocor_data_bad_header(self, tmp_path):
+
+        bad_file = tmp_path / "bad.tsv"
+        bad_file.write_text("sample\tmetabolite\tarea\nA\tB\t1\n")
+        with pytest.raises(ValueError, match="isotopologue"):
+            IsoplotData.load_isocor_data(bad_file)
+
+    @pytest.mark.parametrize("extension", [".parquet", ".feather"])
+    def test_columnar_data(self, tmp_path, extension):
+
+        pytest.importorskip("pyarrow")
+        source = Path("./isoplot/tests/test_data/160419_T_Daubon_MC_principale_res.csv").resolve()
+        destination = tmp_path / f"data{extension}"
+        IsoplotData.convert_isocor_data(source, destination)
+
+        assert_frame_equal(IsoplotData.load_isocor_data(destination), IsoplotData.load_isocor_data(source))
+
+        IsoplotData.load_isocor_data(source).drop(columns="isotopologue").to_parquet(tmp_path / "bad.parquet")
+        with pytest.raises(ValueError, match="isotopologue"):
+            IsoplotData.load_isocor_data(tmp_path / "bad.parquet")
+
+    def test_multiple_files(self, tmp_path):
+
+        source = Path("./isoplot/tests/test_data/160419_T_Daubon_MC_principale_res.csv").resolve()
+        data = IsoplotData.load_isocor_data(source)
+        samples = natsorted(data["sample"].unique())
+        half = len(samples) // 2
+        data[data["sample"].isin(samples[:half])].to_csv(tmp_path / "part_1.csv", index=False)
+        data[data["sample"].isin(samples[half:])].to_csv(tmp_path / "part_2.tsv", sep="\t", index=False)
+
+        assert IsoplotData.resolve_datapaths(tmp_path / "part_*") == [str(tmp_path / "part_1.csv"),
+                                                                       str(tmp_path / "part_2.tsv")]
+        with pytest.raises(ValueError, match="No data file"):
+            IsoplotData.resolve_datapaths(tmp_path / "missing_*")
+
+        multi_object = IsoplotData([tmp_path / "part_1.csv", tmp_path / "part_2.tsv"], max_workers=2)
+        multi_object.get_data()
+        assert set(multi_object.data["sample"]) == set(samples)
+        keys = ["sample", "metabolite", "isotopologue"]
+        assert_frame_equal(multi_object.data.sort_values(keys).reset_index(drop=True),
+                           data.sort_values(keys).reset_index(drop=True))
+
+    def test_concat_data_categories(self):
+
+        frames = [pd.DataFrame({"sample": pd.Categorical(["a", "b"]), "area": [1.0, 2.0]}),
+                  pd.DataFrame({"sample": pd.Categorical(["c"]), "area": [3.0]})]
+        data = IsoplotData.concat_data(frames)
+        assert isinstance(data["sample"].dtype, pd.CategoricalDtype)
+        assert data["sample"].tolist() == ["a", "b", "c"]
+
+        with pytest.raises(ValueError, match="same columns"):
+            IsoplotData.concat_data([frames[0], frames[1].rename(columns={"area": "other"})])
+
+    def test_publish_shared(self, data_object, tmp_path):
+
+        data_object.get_data()
+        data_object.get_template(Path("./isoplot/tests/test_data/modified_for_testing.xlsx").resolve())
+        data_object.merge_data()
+        data_object.prepare_data(False, build_tensor=True)
+        data_object.publish_shared(tmp_path)
+        shared_object = IsoplotData(None)
+        shared_object.attach_shared(tmp_path)
+
+        for name in ["dfmerge", "samples", "mean_enrichment", "replicate_stats"]:
+            assert_frame_equal(getattr(shared_object, name), getattr(data_object, name), check_dtype=False,
+                               check_categorical=False)
+        assert not shared_object.dfmerge["area"].to_numpy().flags.writeable
+        assert shared_object.partitions.keys() == data_object.partitions.keys()
+        assert_frame_equal(shared_object.get_metabolite_data("Cit"), data_object.get_metabolite_data("Cit"),
+                           check_dtype=False, check_categorical=False)
+        assert np.array_equal(shared_object.tensor.array, data_object.tensor.array, equal_nan=True)
+
+    def test_logger_handler(self, data_object, tmp_path):
+
+        base_logger = logging.getLogger("isoplot_log")
+        handlers = list(base_logger.handlers)
+        IsoplotData(None, verbose=True)
+        IsoplotData(None)
+        configure_logging()
+
+        assert base_logger.handlers == handlers and len(handlers) == 1
+        assert data_object.isoplot_logger.handlers == []
+        # An object that is not verbose keeps the debug level of an earlier one
+        assert handlers[0].level == logging.DEBUG
+
+        # Records are written once, also through the queue
+        log_file = tmp_path / "run_info.txt"
+        try:
+            configure_logging(log_file=log_file)
+            data_object.isoplot_logger.info("direct")
+            configure_logging(log_file=log_file, use_queue=True)
+            configure_logging(verbose=True)
+            data_object.isoplot_logger.debug("queued")
+            assert len(base_logger.handlers) == 1
+        finally:
+            stop_logging()
+            configure_logging(verbose=False, log_file=False)
+        assert [line.split(" - ")[-1] for line in log_file.read_text().splitlines()] == ["direct", "queued"]
+        assert base_logger.handlers == handlers
@@ -0,0 +1,410 @@
+""" Module for testing the rendering of plots by the command-line interface"""
+
+from pathlib import Path
+import json
+import multiprocessing
+import os
+import time
+import zipfile
+
+import matplotlib.pyplot as plt
+import pytest
+
+from isoplot.main.dataprep import IsoplotData
+from isoplot.main.manifest import RenderManifest
+from isoplot.main.plots import StaticPlot, Map
+from isoplot.main.profiling import RunProfile
+from isoplot.main.progress import ProgressTracker
+from isoplot.main.render import RenderTask, Renderer, run_tasks
+from isoplot.main.sinks import DirectorySink, MemorySink, StagingSink, ZipSink
+from isoplot.ui.isoplotcli import IsoplotCli
+
+DATA_PATH = Path("./isoplot/tests/test_data/160419_T_Daubon_MC_principale_res.csv").resolve()
+TEMPLATE_PATH = Path("./isoplot/tests/test_data/modified_for_testing.xlsx").resolve()
+
+
+@pytest.fixture(scope='module')
+def prepared_data():
+    data_object = IsoplotData(DATA_PATH)
+    data_object.get_data()
+    data_object.get_template(TEMPLATE_PATH)
+    data_object.merge_data()
+    data_object.prepare_data(False)
+    return data_object
+
+
+@pytest.fixture(scope='module')
+def renderer_args(prepared_data):
+    return (prepared_data, "test", list(prepared_data.dfmerge["condition"].unique()),
+            list(prepared_data.dfmerge["time"].unique()), "png", True, False)
+
+
+@pytest.fixture(scope='function')
+def tasks():
+    return [RenderTask("static", "barplot", "Static_barplots", "Cit", "isotopologue_fraction"),
+            RenderTask("static", "mean_barplot", "Static_barplots_SD", "Cit", "isotopologue_fraction"),
+            RenderTask("interactive", "stacked_barplot", "Interactive_barplots", "Mal", "corrected_area"),
+            RenderTask("static", "barplot", "Static_barplots", "Mal", "isotopologue_fraction")]
+
+
+class TestRender:
+
+    def test_build_render_tasks(self):
+
+        cli = IsoplotCli()
+        cli.args = cli.parser.parse_args(["data.csv", "run", "png", "--value", "isotopologue_fraction",
+                                          "mean_enrichment", "-bp", "-IM", "-hm"])
+        tasks = cli.build_render_tasks(["Cit", "Mal"])
+
+        assert [(task.method, task.metabolite, task.value) for task in tasks] == [
+            ("barplot", "Cit", "isotopologue_fraction"),
+            ("stacked_meanplot", "Cit", "isotopologue_fraction"),
+            ("mean_enrichment_plot", "Cit", "mean_enrichment"),
+            ("mean_enrichment_meanplot", "Cit", "mean_enrichment"),
+            ("barplot", "Mal", "isotopologue_fraction"),
+            ("stacked_meanplot", "Mal", "isotopologue_fraction"),
+            ("mean_enrichment_plot", "Mal", "mean_enrichment"),
+            ("mean_enrichment_meanplot", "Mal", "mean_enrichment"),
+            ("build_heatmap", None, None)]
+
+    def test_render_plan(self, renderer_args):
+
+        cli = IsoplotCli()
+        cli.args = cli.parser.parse_args(["data.csv", "run", "png", "--value", "isotopologue_fraction", "-bp", "-IB",
+                                          "-hm", "--dry-run"])
+        plan = cli.build_render_plan(["Cit", "Mal"])
+        assert cli.args.dry_run and len(plan) == 5
+        assert plan.count() == {("Static_barplots", "barplot"): (2, 2.2),
+                                ("Interactive_barplots", "stacked_barplot"): (2, 0.6),
+                                ("static_heatmap", "build_heatmap"): (1, 0.9)}
+        summary = plan.summary(jobs=2)
+        assert summary.startswith("Render plan: 5 plots, 2 metabolites")
+        assert summary.endswith("Estimated render time: 3.7 s, about 1.9 s with 2 job(s)")
+
+    def test_use_tensor(self):
+
+        cli = IsoplotCli()
+        cli.args = cli.parser.parse_args(["data.csv", "run", "png", "--value", "corrected_area", "-bp", "-IB"])
+        assert not cli.use_tensor()
+        cli.args = cli.parser.parse_args(["data.csv", "run", "png", "--value", "corrected_area", "-bp", "-IB",
+                                          "--tensor"])
+        assert cli.use_tensor()
+        # The mean plots and the maps do not read the ID x isotopologue tables
+        cli.args = cli.parser.parse_args(["data.csv", "run", "png", "--value", "corrected_area", "-mb", "-hm",
+                                          "--tensor"])
+        assert not cli.use_tensor()
+
+    def test_shared_intermediates(self, renderer_args, tasks):
+
+        renderer = Renderer(*renderer_args, MemorySink())
+        static = renderer.get_plot(RenderTask("static", "barplot", "Static_barplots", "Cit", "corrected_area"))
+        # Plots got from the renderer have no sink until they are rendered
+        static.sink = MemorySink()
+        static.barplot()
+        interactive = renderer.get_plot(RenderTask("interactive", "stacked_barplot", "Interactive_barplots", "Cit",
+                                                   "corrected_area"))
+        interactive.sink = MemorySink()
+        # The pivot of the static plot is reused by the interactive plot
+        assert interactive.intermediates is static.intermediates
+        assert ("pivot", "corrected_area") in interactive.intermediates
+        interactive.stacked_barplot()
+        assert static.get_pivot().columns.tolist() == list(range(len(static.get_pivot().columns)))
+        # The intermediates are dropped with the next metabolite
+        assert renderer.get_plot(tasks[-1]).intermediates is not static.intermediates
+
+    @pytest.mark.parametrize("start_method", [method for method in ["fork", "spawn"]
+                                              if method in multiprocessing.get_all_start_methods()])
+    def test_parallel_render_matches_serial(self, renderer_args, tasks, start_method):
+
+        serial_sink, parallel_sink = MemorySink(), MemorySink()
+        serial = list(run_tasks(Renderer(*renderer_args, serial_sink), tasks))
+        parallel = list(run_tasks(Renderer(*renderer_args, parallel_sink), tasks, jobs=2, chunk_size=1,
+                                  start_method=start_method))
+
+        assert [result.fig_name for result in serial] == [
+            "Static_barplots/Cit_isotopologue_fraction.png", "Static_barplots_SD/Cit_isotopologue_fraction.png",
+            "Interactive_barplots/Mal_corrected_area.html.html", "Static_barplots/Mal_isotopologue_fraction.png"]
+        assert [result.fig_name for result in parallel] == [result.fig_name for result in serial]
+        assert all(result.error is None for result in serial + parallel)
+        assert list(parallel_sink.files) == list(serial_sink.files)
+        for name, content in serial_sink.files.items():
+            if name.endswith("png"):
+                assert parallel_sink.files[name] == content
+
+    def test_thread_render_matches_serial(self, renderer_args, tasks):
+
+        serial_sink, thread_sink = MemorySink(), MemorySink()
+        list(run_tasks(Renderer(*renderer_args, serial_sink), tasks))
+        figures = plt.get_fignums()
+        results = list(run_tasks(Renderer(*renderer_args, thread_sink), tasks * 2, jobs=3, chunk_size=1,
+                                 threads=True))
+
+        assert all(result.error is None for result in results)
+        assert thread_sink.files.keys() == serial_sink.files.keys()
+        for name, content in serial_sink.files.items():
+            if name.endswith("png"):
+                assert thread_sink.files[name] == content
+        # Static figures are not registered in pyplot
+        assert plt.get_fignums() == figures == []
+
+    def test_thread_render_mixed_styles(self, renderer_args):
+
+        # Areaplots use the default style, barplots the poster context and heatmaps set the seaborn theme
+        tasks = []
+        for metabolite in ["Cit", "Mal", "Fum"]:
+            tasks += [RenderTask("static", "stacked_areaplot", "Static_areaplots", metabolite, "isotopologue_fraction"),
+                      RenderTask("map", "build_heatmap", "static_heatmap"),
+                      RenderTask("static", "barplot", "Static_barplots", metabolite, "isotopologue_fraction")]
+        serial_sink, thread_sink = MemorySink(), MemorySink()
+        list(run_tasks(Renderer(*renderer_args, serial_sink), tasks))
+        results = list(run_tasks(Renderer(*renderer_args, thread_sink), tasks * 2, jobs=4, chunk_size=1,
+                                 threads=True))
+
+        assert all(result.error is None for result in results)
+        assert thread_sink.files.keys() == serial_sink.files.keys()
+        for name, content in serial_sink.files.items():
+            assert thread_sink.files[name] == content, name
+
+    def test_released_figures(self, prepared_data, renderer_args):
+
+        sink = MemorySink()
+        plot = StaticPlot(True, "isotopologue_fraction", prepared_data, "test", "Cit", *renderer_args[2:4], "png",
+                          display=False, rtrn=False, sink=sink)
+        plot.barplot()
+        heatmap = Map(prepared_data, "test", False, "png", sink=sink)
+        heatmap.build_heatmap()
+        # A returned figure belongs to the caller, even when plots are displayed
+        fig = StaticPlot(True, "isotopologue_fraction", prepared_data, "test", "Cit", *renderer_args[2:4], "png",
+                         display=True, rtrn=True).barplot()
+
+        assert len(sink.files) == 2
+        assert fig.axes
+        assert plt.get_fignums() == []
+
+    def test_profile(self, renderer_args, tasks, tmp_path):
+
+        profile = RunProfile(tmp_path / "profile_stats")
+        with profile.stage("sleep"):
+            time.sleep(0.01)
+        renderer = Renderer(*renderer_args, MemorySink())
+        renderer.profile, renderer.stats_dir = True, profile.stats_dir
+        for result in run_tasks(renderer, tasks):
+            profile.add_render(result)
+        profile.merge_render_stats()
+        profile.write(tmp_path)
+
+        assert profile.stages[0]["stage"] == "sleep" and profile.stages[0]["wall"] >= 0.01
+        assert [render["method"] for render in profile.renders] == [task.method for task in tasks]
+        assert profile.renders[0]["writes"][0]["file"] == "Static_barplots/Cit_isotopologue_fraction.png"
+        assert profile.renders[0]["writes"][0]["bytes"] == len(renderer.sink.files[
+            "Static_barplots/Cit_isotopologue_fraction.png"])
+        assert sorted(path.name for path in profile.stats_dir.iterdir()) == ["render.pstats", "sleep.pstats"]
+        assert json.loads((tmp_path / RunProfile.JSON_FILE).read_text())["renders"] == profile.renders
+        assert "static barplot" in (tmp_path / RunProfile.SUMMARY_FILE).read_text()
+
+    @pytest.mark.parametrize("jobs, threads", [(1, False), (2, False), (2, True)])
+    def test_progress(self, renderer_args, tasks, tmp_path, jobs, threads):
+
+        tasks.insert(1, RenderTask("static", "barplot", "Static_barplots", "Unknown", "isotopologue_fraction"))
+        events = []
+        renderer = Renderer(*renderer_args, MemorySink())
+        renderer.progress = ProgressTracker(tasks, events.append, tmp_path / "progress.jsonl", jobs)
+        with renderer.progress:
+            results = list(run_tasks(renderer, tasks, jobs=jobs, chunk_size=1, threads=threads))
+
+        assert [json.loads(line) for line in (tmp_path / "progress.jsonl").read_text().splitlines()] == events
+        assert [event["event"] for event in events].count("task_start") == 5
+        finished = [event for event in events if event["event"] == "task_finish"]
+        assert sorted(event["task"]["metabolite"] for event in finished) == ["Cit", "Cit", "Mal", "Mal", "Unknown"]
+        assert [event["success"] for event in finished if event["task"]["metabolite"] == "Unknown"] == [False]
+        assert [event["done"] for event in finished] == [1, 2, 3, 4, 5]
+        assert finished[-1]["eta"] == 0 and finished[-1]["throughput"] > 0
+        assert events[0]["event"] == "run_start" and events[0]["total"] == 5 and events[0]["eta"] > 0
+        assert events[-1]["event"] == "run_finish" and events[-1]["done"] == 5 and events[-1]["failed"] == 1
+        assert [result.error is None for result in results] == [True, False, True, True, True]
+
+    def test_progress_eta(self):
+
+        tasks = [RenderTask("static", "barplot", "Static_barplots", metabolite, "isotopologue_fraction")
+                 for metabolite in ["Cit", "Mal", "Fum"]] + [RenderTask("map", "build_heatmap", "static_heatmap")]
+        tracker = ProgressTracker(tasks, jobs=2)
+        tracker.start()
+        # Before any plot, the reference costs are shared by the jobs
+        assert tracker.eta() == pytest.approx((3 * 1.1 + 0.9) / 2)
+        tracker.task_finished(tasks[0], 2.2)
+        tracker.task_finished(tasks[0], 2.2)
+        # Barplots take twice their reference time, so should the heatmap
+        assert tracker.counts()["done"] == 1
+        assert tracker.eta() == pytest.approx((2 * 2.2 + 1.8) / min(2.2 / tracker.elapsed, 2))
+        tracker.finish()
+
+    def test_failing_task(self, renderer_args, tasks, tmp_path):
+
+        tasks.insert(1, RenderTask("static", "barplot", "Static_barplots", "Unknown", "isotopologue_fraction"))
+        renderer = Renderer(*renderer_args, DirectorySink(tmp_path))
+        cwd = os.getcwd()
+        results = list(run_tasks(renderer, tasks, jobs=2, chunk_size=2))
+
+        assert os.getcwd() == cwd
+
+        assert [result.error is None for result in results] == [True, False, True, True, True]
+        assert (tmp_path / "Static_barplots" / "Cit_isotopologue_fraction.png").is_file()
+        assert (tmp_path / "Static_barplots_SD" / "Cit_isotopologue_fraction.png").is_file()
+        assert (tmp_path / "Interactive_barplots" / "Mal_corrected_area.html.html").is_file()
+
+    @pytest.mark.skipif("fork" not in multiprocessing.get_all_start_methods(), reason="needs the fork start method")
+    def test_dead_worker(self, renderer_args, tasks, monkeypatch):
+
+        render = Renderer.render
+
+        def render_or_die(self, task):
+            if task.metabolite == "Fum":
+                os._exit(1)
+            return render(self, task)
+
+        # The forked workers inherit the patched method
+        monkeypatch.setattr(Renderer, "render", render_or_die)
+        tasks.insert(2, RenderTask("static", "barplot", "Static_barplots", "Fum", "isotopologue_fraction"))
+        tasks.append(RenderTask("static", "mean_barplot", "Static_barplots_SD", "Mal", "isotopologue_fraction"))
+        sink = MemorySink()
+        tracker = ProgressTracker(tasks, jobs=3)
+        renderer = Renderer(*renderer_args, sink)
+        renderer.progress = tracker
+        with tracker:
+            results = list(run_tasks(renderer, tasks, jobs=3, chunk_size=1, start_method="fork"))
+
+        assert [repr(result.task) for result in results] == [repr(task) for task in tasks]
+        assert [result.error is None for result in results] == [True, True, False, True, True, True]
+        assert "BrokenProcessPool" in results[2].error
+        assert sorted(sink.files) == ["Interactive_barplots/Mal_corrected_area.html.html",
+                                      "Static_barplots/Cit_isotopologue_fraction.png",
+                                      "Static_barplots/Mal_isotopologue_fraction.png",
+                                      "Static_barplots_SD/Cit_isotopologue_fraction.png",
+                                      "Static_barplots_SD/Mal_isotopologue_fraction.png"]
+        assert tracker.counts() == {"done": 6, "failed": 1, "running": 0, "remaining": 0, "total": 6}
+
+    def test_zip_export(self, prepared_data, renderer_args, tmp_path):
+
+        cli = IsoplotCli()
+        cli.args = cli.parser.parse_args([str(DATA_PATH), "test", "png", "--value", "isotopologue_fraction", "-bp",
+                                          "-g", "-z", str(tmp_path / "plots.zip"), "-j", "2"])
+        cli.conditions, cli.times = renderer_args[2], renderer_args[3]
+        cli.plot_figs(["Cit", "Mal"], prepared_data, build_zip=True)
+
+        with zipfile.ZipFile(tmp_path / "plots.zip") as zf:
+            assert zf.namelist() == ["Static_barplots_Cit_isotopologue_fraction.png",
+                                     "Static_barplots_Mal_isotopologue_fraction.png"]
+
+    def test_task_key(self, prepared_data, renderer_args):
+
+        data = prepared_data.dfmerge.copy()
+        tasks = [RenderTask("static", "barplot", "Static_barplots", metabolite, "isotopologue_fraction")
+                 for metabolite in ["Cit", "Mal"]]
+        keys = [Renderer(data, *renderer_args[1:], MemorySink()).task_key(task) for task in tasks]
+        assert keys == [Renderer(*renderer_args, MemorySink()).task_key(task) for task in tasks]
+        data.loc[data["metabolite"] == "Mal", "isotopologue_fraction"] += 0.1
+        renderer = Renderer(data, *renderer_args[1:], MemorySink())
+        assert [renderer.task_key(task) == key for task, key in zip(tasks, keys)] == [True, False]
+        renderer.fmt = "svg"
+        assert renderer.task_key(tasks[0]) != keys[0]
+
+    def test_reuse_and_resume(self, prepared_data, renderer_args, tmp_path):
+
+        def plot_figs(run_home, metabolites, *args):
+            cli = IsoplotCli(run_home=run_home)
+            cli.args = cli.parser.parse_args([str(DATA_PATH), "test", "png", "--value", "isotopologue_fraction",
+                                              "-bp", *args])
+            cli.conditions, cli.times = renderer_args[2], renderer_args[3]
+            run_home.mkdir(exist_ok=True)
+            cli.plot_figs(metabolites, prepared_data)
+            return RenderManifest(run_home)
+
+        first = plot_figs(tmp_path / "first", ["Cit", "Mal"])
+        assert sorted(files for files in first.entries.values()) == [["Static_barplots/Cit_isotopologue_fraction.png"],
+                                                                    ["Static_barplots/Mal_isotopologue_fraction.png"]]
+
+        second = plot_figs(tmp_path / "second", ["Cit", "Mal", "Fum"], "--reuse", str(tmp_path / "first"))
+        assert len(second.entries) == 3
+        for metabolite in ["Cit", "Mal"]:
+            name = f"Static_barplots/{metabolite}_isotopologue_fraction.png"
+            assert os.path.samefile(tmp_path / "first" / name, tmp_path / "second" / name)
+
+        # A killed run leaves missing files and possibly an incomplete line in the manifest
+        (tmp_path / "second" / "Static_barplots" / "Fum_isotopologue_fraction.png").unlink()
+        with open(second.path, "a") as f:
+            f.write('{"key": "')
+        mtime = (tmp_path / "second" / "Static_barplots" / "Cit_isotopologue_fraction.png").stat().st_mtime_ns
+        resumed = plot_figs(tmp_path / "second", ["Cit", "Mal", "Fum"])
+        assert (tmp_path / "second" / "Static_barplots" / "Fum_isotopologue_fraction.png").is_file()
+        assert (tmp_path / "second" / "Static_barplots" / "Cit_isotopologue_fraction.png").stat().st_mtime_ns == mtime
+        assert resumed.entries == second.entries == RenderManifest(tmp_path / "second").entries
+
+    def test_sinks(self, tmp_path):
+
+        with DirectorySink(tmp_path) as sink:
+            sink.child("plots").child("maps").write("map.html", "<html></html>")
+            sink.write("data.bin", b"\x00")
+        assert (tmp_path / "plots" / "maps" / "map.html").read_text() == "<html></html>"
+        assert sink.child("plots").path("a.png") == tmp_path.resolve() / "plots" / "a.png"
+
+        with ZipSink(tmp_path / "plots.zip") as sink:
+            sink.child("Static_barplots").write("Cit.png", b"png")
+            # The archive is valid before it is closed
+            with zipfile.ZipFile(tmp_path / "plots.zip") as zf:
+                assert zf.read("Static_barplots_Cit.png") == b"png"
+            sink.child("Static_barplots").write("Mal.png", b"png")
+        with zipfile.ZipFile(tmp_path / "plots.zip") as zf:
+            assert zf.namelist() == ["Static_barplots_Cit.png", "Static_barplots_Mal.png"]
+            assert zf.testzip() is None
+
+        # The directory is written after the first file, then every checkpoint_files files
+        with ZipSink(tmp_path / "plots.zip", checkpoint_files=2, checkpoint_seconds=float("inf")) as sink:
+            checkpoints = []
+            write_directory = sink.write_directory
+            sink.write_directory = lambda: checkpoints.append(len(sink.archive.filelist)) or write_directory()
+            for i in range(6):
+                sink.write(f"{i}.png", b"png")
+        assert checkpoints == [1, 3, 5]
+        with zipfile.ZipFile(tmp_path / "plots.zip") as zf:
+            assert len(zf.namelist()) == 6 and zf.testzip() is None
+
+        with ZipSink(tmp_path / "plots.zip", compression=ZipSink.parse_compression(["svg=bzip2:9"])) as sink:
+            for name in ["Cit.png", "Cit.svg", "Cit.html.html"]:
+                sink.write(name, "<svg></svg>" * 100)
+        with zipfile.ZipFile(tmp_path / "plots.zip") as zf:
+            assert [info.compress_type for info in zf.infolist()] == [zipfile.ZIP_STORED, zipfile.ZIP_BZIP2,
+                                                                     zipfile.ZIP_DEFLATED]
+            assert zf.read("Cit.svg") == b"<svg></svg>" * 100
+        assert ZipSink.parse_compression(["SVG=deflated:0", ".html=lzma"]) == {"svg": (zipfile.ZIP_DEFLATED, 0),
+                                                                               "html": (zipfile.ZIP_LZMA, None)}
+        for spec in ["svg", "svg=gzip", "svg=deflated:10", "svg=lzma:5", "=stored"]:
+            with pytest.raises(ValueError):
+                ZipSink.parse_compression([spec])
+
+        staging = StagingSink(tmp_path / "staging", "_").recording()
+        staging.child("Static_barplots").write("Cit.png", b"png")
+        names = staging.written
+        assert names == ["Static_barplots_Cit.png"]
+        sink = MemorySink()
+        staging.transfer(names, sink)
+        assert sink.files == {"Static_barplots_Cit.png": b"png"}
+        assert list((tmp_path / "staging").iterdir()) == []
+
+        sink = MemorySink()
+        sink.child("Static_barplots").write("Cit.png", b"png")
+        assert sink.files == {"Static_barplots/Cit.png": b"png"}
+
+    def test_publish(self, renderer_args, tmp_path):
+
+        renderer = Renderer(*renderer_args, ZipSink(tmp_path / "plots.zip"))
+        worker_renderer = renderer.publish(tmp_path)
+        assert renderer.data_object is renderer_args[0]
+        assert worker_renderer.data_object is None
+
+        worker_renderer.attach()
+        assert worker_renderer.data_object.get_metabolite_data("Cit")["area"].tolist() == \
+            renderer.data_object.get_metabolite_data("Cit")["area"].tolist()
+        assert isinstance(worker_renderer.sink, StagingSink)
+        assert worker_renderer.sink.root == (tmp_path / "staging").resolve()
+        assert Renderer(renderer_args[0].dfmerge, *renderer_args[1:], renderer.sink).publish(tmp_path) is None
+        renderer.sink.close()
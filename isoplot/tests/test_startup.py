@@ -0,0 +1,68 @@
+"""Tests of the start-up cost of the command-line interface"""
+
+import json
+import os
+from pathlib import Path
+import subprocess
+import sys
+
+import pytest
+
+# Seconds allowed to import the CLI entry point, it can be raised on slow machines
+IMPORT_BUDGET = float(os.environ.get("ISOPLOT_IMPORT_BUDGET", 2.0))
+# Dependencies only needed to render plots or to run the notebook
+HEAVY_MODULES = ["matplotlib", "seaborn", "bokeh", "colorcet", "ipywidgets", "isoplot.main.plots"]
+
+
+@pytest.fixture(scope="class")
+def data_dir():
+    return Path(__file__).parent / "test_data"
+
+
+def run_python(code, cwd=None):
+    """Run code in a new interpreter and return what it prints as json"""
+
+    result = subprocess.run([sys.executable, "-c", code], cwd=cwd, capture_output=True, text=True,
+                            env=dict(os.environ, PYTHONPATH=str(Path(__file__).parents[2])))
+    assert result.returncode == 0, result.stderr
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+class TestStartup:
+
+    def test_cli_imports(self):
+
+        loaded = run_python(
+            "import json, sys\n"
+            "import isoplot.main.cli_process\n"
+            f"print(json.dumps([m for m in {HEAVY_MODULES} if m in sys.modules]))"
+        )
+        assert loaded == []
+
+    def test_import_budget(self):
+
+        code = (
+            "import json, time\n"
+            "start = time.perf_counter()\n"
+            "import isoplot.main.cli_process\n"
+            "print(json.dumps(time.perf_counter() - start))"
+        )
+        # The first import compiles the modules, the budget applies to the next ones
+        run_python(code)
+        duration = min(run_python(code) for _ in range(2))
+        assert duration < IMPORT_BUDGET, f"Importing the CLI took {duration:.2f} s (budget {IMPORT_BUDGET} s)"
+
+    def test_dry_run_imports(self, data_dir, tmp_path):
+
+        args = [str(data_dir / "160419_T_Daubon_MC_principale_res.csv"), "test", "png", "--value",
+                "isotopologue_fraction", "-tp", str(data_dir / "modified_for_testing.xlsx"), "-bp", "-IB", "--dry-run"]
+        loaded = run_python(
+            "import json, sys\n"
+            "from isoplot.main import cli_process\n"
+            "cli_process.check_version = lambda name: None\n"
+            f"sys.argv = ['isoplot'] + {args}\n"
+            "cli_process.main()\n"
+            f"print(json.dumps([m for m in {HEAVY_MODULES} if m in sys.modules]))",
+            cwd=tmp_path
+        )
+        assert loaded == []
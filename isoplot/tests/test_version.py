@@ -0,0 +1,69 @@
+""" Module for testing the version check"""
+
+import json
+
+import pytest
+
+import isoplot
+from isoplot.main import version
+
+
+@pytest.fixture(scope='function')
+def index(monkeypatch):
+    """Replace the package index by a counter of the queries. Set index['latest'] to None to simulate an offline node"""
+
+    index = {"latest": "99.0.0", "queries": 0}
+
+    def fetch_latest_version(name):
+        index["queries"] += 1
+        if index["latest"] is None:
+            raise OSError("Network is unreachable")
+        return index["latest"]
+
+    monkeypatch.delenv("ISOPLOT_NO_VERSION_CHECK", raising=False)
+    monkeypatch.setattr(version, "fetch_latest_version", fetch_latest_version)
+    return index
+
+
+class TestVersionCheck:
+
+    def test_parse_version(self):
+
+        assert version.parse_version("1.3.1") < version.parse_version("1.10.0")
+        assert version.parse_version("2.0.0rc1") == (2, 0, 0)
+
+    def test_background_check(self, tmp_path, index, capsys):
+
+        thread = version.check_version("isoplot", tmp_path)
+        thread.join()
+        assert index["queries"] == 1
+        assert "outdated" in capsys.readouterr().out
+        assert json.loads((tmp_path / "isoplot_version_check.json").read_text())["latest"] == "99.0.0"
+        # The cached result is used until it expires
+        assert version.check_version("isoplot", tmp_path) is None
+        assert index["queries"] == 1
+        assert "outdated" in capsys.readouterr().out
+        version.check_version("isoplot", tmp_path, ttl=0, background=False)
+        assert index["queries"] == 2
+
+    def test_up_to_date(self, tmp_path, index, capsys):
+
+        index["latest"] = isoplot.__version__
+        version.check_version("isoplot", tmp_path, background=False)
+        assert capsys.readouterr().out == ""
+
+    def test_offline(self, tmp_path, index, capsys):
+
+        index["latest"] = None
+        version.check_version("isoplot", tmp_path, background=False)
+        # The failure is cached, the index is not queried again before the cache expires
+        assert version.check_version("isoplot", tmp_path) is None
+        assert index["queries"] == 1
+        assert capsys.readouterr().out == ""
+
+    def test_disabled(self, tmp_path, index, monkeypatch):
+
+        monkeypatch.setenv("ISOPLOT_NO_VERSION_CHECK", "1")
+        assert version.check_version("isoplot", tmp_path) is None
+        assert index["queries"] == 0
+        assert not (tmp_path / "isoplot_version_check.json").exists()
@@ -1,14 +1,17 @@
 import io
 import datetime
 import os
-import subprocess
-import sys
 
+from IPython.display import display as show_widget
 import ipywidgets as widgets
 import pandas as pd
 
 from isoplot.main.dataprep import IsoplotData
 from isoplot.main.plots import StaticPlot, InteractivePlot, Map
+from isoplot.main.progress import ProgressTracker, format_duration
+from isoplot.main.render import RenderTask
+from isoplot.main.sinks import DirectorySink
+from isoplot.main.version import check_version
 
 
 class ValueHolder:
@@ -18,13 +21,44 @@ class ValueHolder:
 vh = ValueHolder()
 
 
-# Check if current version is outdated
-def check_version(name):
-    reqs = subprocess.check_output([sys.executable, '-m', 'pip', 'list', '--outdated'])
-    outdated_packages = [r.decode().split('==')[0] for r in reqs.split()]
-    if name in outdated_packages:
-        print("Your version of Isoplot is outdated. Please run 'pip install isoplot' to get the latest"
-              "version.")
+# Destination des plots d'un appel: un dossier daté dans le dossier de travail
+def make_run_sink(name):
+    now = datetime.datetime.now()
+    date_time = now.strftime("%d%m%Y_%H%M%S")  # Récupération date et heure
+    directory = os.path.join(os.getcwd(), name + " " + date_time)
+    os.mkdir(directory)  # Créons le dir
+    return DirectorySink(directory)
+
+
+# Barre de progression des plots d'un appel, mise à jour par les événements de ProgressTracker
+class NotebookProgress:
+
+    def __init__(self):
+        self.bar = widgets.IntProgress(min=0, max=1, description='Plots:')
+        self.label = widgets.Label()
+        self.box = widgets.HBox([self.bar, self.label])
+
+    def __call__(self, event):
+        if event["event"] == "run_start":
+            self.bar.max, self.bar.value, self.bar.bar_style = max(event["total"], 1), 0, ''
+            show_widget(self.box)
+        self.bar.value = event.get("done", 0)
+        if event["event"] == "task_start":
+            self.label.value = f"{event['done']}/{event['total']} - {event['task']['metabolite']}"
+        elif event["event"] == "task_finish":
+            self.label.value = f"{event['done']}/{event['total']} - about {format_duration(event['eta'])} left"
+        elif event["event"] == "run_finish":
+            self.bar.bar_style = 'danger' if event["failed"] else 'success'
+            self.label.value = f"{event['done']}/{event['total']} in {format_duration(event['elapsed'])}"
+
+
+# Appelle une méthode de plot pour chaque tâche en rapportant la progression au callback
+def run_plots(tasks, make_plotter, progress):
+    tracker = ProgressTracker(tasks, progress)
+    with tracker:
+        for task in tasks:
+            with tracker.track(task):
+                getattr(make_plotter(task), task.method)()
 
 
 # Instanciation des widgets
@@ -106,120 +140,105 @@ datamerge_btn.on_click(dataprep_eventhandler)
 
 
 # Fonction permettant le filtrage des données à plotter et appelant les fonctions de plotting
-def indiplot(stack, value, data, name, metabolites, conditions, times, fmt, display, stackplot=False):
-    # Préparons le directory où seront enregistrés les html avec les plots
-    now = datetime.datetime.now()
-    date_time = now.strftime("%d%m%Y_%H%M%S")  # Récupération date et heure
-    mydir = os.getcwd()
-    os.mkdir(name + " " + date_time)  # Créons le dir
-    os.chdir(name + " " + date_time)  # Rentrons dans le dir
-
-    for metabolite in metabolites:
-
-        plotter = StaticPlot(stack, value, data, name, metabolite, conditions, times, fmt,
-                             display=display, rtrn=False)
-
-        if value != 'mean_enrichment':
-            if stackplot == True:
-                plotter.stacked_areaplot()
-            else:
-                plotter.barplot()
-        elif value == 'mean_enrichment':
-            plotter.mean_enrichment_plot()
-
-    os.chdir(mydir)  # Revenir au dir initial
+def indiplot(stack, value, data, name, metabolites, conditions, times, fmt, display, stackplot=False, sink=None,
+             progress=None):
+    # Préparons la destination où seront enregistrés les plots
+    if sink is None:
+        sink = make_run_sink(name)
+
+    if value != 'mean_enrichment':
+        if stackplot == True:
+            method = 'stacked_areaplot'
+        else:
+            method = 'barplot'
+    elif value == 'mean_enrichment':
+        method = 'mean_enrichment_plot'
+
+    run_plots([RenderTask('static', method, method, metabolite, value) for metabolite in metabolites],
+              lambda task: StaticPlot(stack, value, data, name, task.metabolite, conditions, times, fmt,
+                                      display=display, rtrn=False, sink=sink),
+              progress)
 
 
 # Fonction permettant le filtrage des données à plotter et appelant les fonctions de plotting
-def meanplot(stack, value, data, name, metabolites, conditions, times, fmt, display):
-    now = datetime.datetime.now()
-    date_time = now.strftime("%d%m%Y_%H%M%S")  # Récupération date et heure
-    mydir = os.getcwd()
-    os.mkdir(name + " " + date_time)  # Créons le dir
-    os.chdir(name + " " + date_time)  # Rentrons dans le dir
+def meanplot(stack, value, data, name, metabolites, conditions, times, fmt, display, sink=None, progress=None):
+    # Préparons la destination où seront enregistrés les plots
+    if sink is None:
+        sink = make_run_sink(name)
 
-    for metabolite in metabolites:
+    if value != 'mean_enrichment':
+        method = 'mean_barplot'
+    elif value == 'mean_enrichment':
+        method = 'mean_enrichment_meanplot'
 
-        plotter = StaticPlot(stack, value, data, name, metabolite, conditions, times, fmt,
-                             display=display, rtrn=False)
-
-        if value != 'mean_enrichment':
-            plotter.mean_barplot()
-        elif value == 'mean_enrichment':
-            plotter.mean_enrichment_meanplot()
-
-    os.chdir(mydir)  # Revenir au dir initial
+    run_plots([RenderTask('static', method, method, metabolite, value) for metabolite in metabolites],
+              lambda task: StaticPlot(stack, value, data, name, task.metabolite, conditions, times, fmt,
+                                      display=display, rtrn=False, sink=sink),
+              progress)
 
 
 # Création d'une fonction pour gérer les appels aux fonctions de plotting en individuel
-def indibokplot(stack, value, data, name, metabolites, conditions, times, display, stackplot=False):
-    # Préparons le directory où seront enregistrés les html avec les plots
-    now = datetime.datetime.now()
-    date_time = now.strftime("%d%m%Y_%H%M%S")  # Récupération date et heure
-    mydir = os.getcwd()
-    os.mkdir(name + " " + date_time)  # Créons le dir
-    os.chdir(name + " " + date_time)  # Rentrons dans le dir
-
-    for metabolite in metabolites:
+def indibokplot(stack, value, data, name, metabolites, conditions, times, display, stackplot=False, sink=None,
+                progress=None):
+    # Préparons la destination où seront enregistrés les plots
+    if sink is None:
+        sink = make_run_sink(name)
 
-        if name == '':
-            name = metabolite
+    # Le cas du mean enrichment est différent car les valeurs sont en double à la sortie d'Isocor
+    if value != 'mean_enrichment':
 
-        plotter = InteractivePlot(stack, value, data, name, metabolite, conditions, times,
-                                  display=display, rtrn=False)
+        if stackplot == True:
+            method = 'stacked_areaplot'
 
-        # Le cas du mean enrichment est différent car les valeurs sont en double à la sortie d'Isocor
-        if value != 'mean_enrichment':
+        elif stack == False:
+            method = 'unstacked_barplot'
 
-            if stackplot == True:
-                plotter.stacked_areaplot()
+        elif stack == True:
+            method = 'stacked_barplot'
 
-            elif stack == False:
-                plotter.unstacked_barplot()
+    elif value == 'mean_enrichment':
+        method = 'mean_enrichment_plot'
 
-            elif stack == True:
-                plotter.stacked_barplot()
+    # Sans nom, chaque plot porte celui du premier métabolite
+    if name == '' and metabolites:
+        name = metabolites[0]
 
-        elif value == 'mean_enrichment':
-            plotter.mean_enrichment_plot()
-
-    os.chdir(mydir)  # Revenir au dir initial
+    run_plots([RenderTask('interactive', method, method, metabolite, value) for metabolite in metabolites],
+              lambda task: InteractivePlot(stack, value, data, name, task.metabolite, conditions, times,
+                                           display=display, rtrn=False, sink=sink),
+              progress)
 
 
 # Création d'une fonction pour gérer les appels aux fonctions de plotting en individuel
-def meanbokplot(stack, value, data, name, metabolites, conditions, times, display):
-    # Préparons le directory où seront enregistrés les html avec les plots
-    now = datetime.datetime.now()
-    date_time = now.strftime("%d%m%Y_%H%M%S")  # Récupération date et heure
-    mydir = os.getcwd()
-    os.mkdir(name + " " + date_time)  # Créons le dir
-    os.chdir(name + " " + date_time)  # Rentrons dans le dir
-
-    for metabolite in metabolites:
-
-        if name == '':
-            name = metabolite
+def meanbokplot(stack, value, data, name, metabolites, conditions, times, display, sink=None, progress=None):
+    # Préparons la destination où seront enregistrés les plots
+    if sink is None:
+        sink = make_run_sink(name)
 
-        plotter = InteractivePlot(stack, value, data, name, metabolite, conditions, times,
-                                  display=display, rtrn=False)
+    if value != 'mean_enrichment':  # Le cas du mean enrichment est différent car les valeurs sont en double à la sortie d'Isocor
 
-        if value != 'mean_enrichment':  # Le cas du mean enrichment est différent car les valeurs sont en double à la sortie d'Isocor
+        if stack == False:
+            method = 'unstacked_meanplot'
 
-            if stack == False:
-                plotter.unstacked_meanplot()
+        elif stack == True:
+            method = 'stacked_meanplot'
 
-            elif stack == True:
-                plotter.stacked_meanplot()
+    elif value == 'mean_enrichment':
+        method = 'mean_enrichment_meanplot'
 
-        elif value == 'mean_enrichment':
-            plotter.mean_enrichment_meanplot()
+    # Sans nom, chaque plot porte celui du premier métabolite
+    if name == '' and metabolites:
+        name = metabolites[0]
 
-    os.chdir(mydir)  # Revenir au dir initial
+    run_plots([RenderTask('interactive', method, method, metabolite, value) for metabolite in metabolites],
+              lambda task: InteractivePlot(stack, value, data, name, task.metabolite, conditions, times,
+                                           display=display, rtrn=False, sink=sink),
+              progress)
 
 
 # Fontion pour choisir le map à générer:
-def build_map(data, name, map_select, annot, fmt, display):
-    mapper = Map(data, name, annot, fmt, display=display)
+def build_map(data, name, map_select, annot, fmt, display, sink=None):
+    mapper = Map(data, name, annot, fmt, display=display, sink=sink)
 
     if map_select == "Static heatmap":
         mapper.build_heatmap()
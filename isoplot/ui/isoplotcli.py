@@ -3,14 +3,14 @@ generate the desired plots"""
 import logging
 import os
 import argparse
-import zipfile
-import io
 
-from bokeh.resources import CDN
-from bokeh.embed import file_html
-
-from isoplot.main.plots import StaticPlot, InteractivePlot, Map
-import isoplot.logger
+from isoplot.logger import configure_logging
+from isoplot.main.dataprep import IsoplotData
+from isoplot.main.manifest import RenderManifest
+from isoplot.main.progress import ProgressLog, ProgressTracker
+from isoplot.main.render import RenderPlan, RenderTask, Renderer, run_tasks
+from isoplot.main.sinks import DirectorySink, ZipSink
+from isoplot.main.version import parse_version
 
 mod_logger = logging.getLogger("isoplot_log.ui.isoplotcli")
 
@@ -25,7 +25,9 @@ def parse_args():
 
     parser = argparse.ArgumentParser("Isoplot2: Plotting isotopic labelling MS data")
 
-    parser.add_argument('input_path', help="Path to datafile")
+    parser.add_argument('input_path', nargs='+',
+                        help="Path to datafile (tsv, csv, parquet or feather). Several files or glob patterns can be "
+                             "given, they are read concurrently and plotted together")
     parser.add_argument("run_name", help="Name of the current run")
     parser.add_argument("format", help="Format of generated file")
     values = ['corrected_area', 'isotopologue_fraction', 'mean_enrichment']
@@ -66,13 +68,78 @@ def parse_args():
                         help='Turns logger to debug mode')
     parser.add_argument('-a', '--annot', action='store_true',
                         help='Add option if annotations should be added on maps')
+    parser.add_argument('-cp', '--compact', action='store_true',
+                        help='Store prepared data in a compact memory layout (categorical and small integer columns)')
+    parser.add_argument('--float32', action='store_true',
+                        help='In compact mode, store values as 32 bit floats')
+    parser.add_argument('--tensor', action='store_true',
+                        help='Precompute the values of all the metabolites in a dense array read by the barplots and '
+                             'areaplots, instead of pivoting the data of each plot. Faster to render, but the array '
+                             'can be larger than the prepared data')
+    parser.add_argument('--cache', action='store_true',
+                        help='Reuse prepared data from previous runs on the same data, template and options')
+    parser.add_argument('--cache_dir', type=str,
+                        help='Directory of the prepared data cache (default: $ISOPLOT_CACHE_DIR or ~/.cache/isoplot)')
+    parser.add_argument('--cache_size', type=int, default=2048,
+                        help='Maximum size of the prepared data cache in MB (default: 2048)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of processes used to render the plots (default: 1)')
+    parser.add_argument('--threads', action='store_true',
+                        help='Render the plots with threads instead of processes (the data is not copied, but static '
+                             'figures are built and saved one at a time). Needs matplotlib 3.6 or later')
+    parser.add_argument('--chunk_size', type=int,
+                        help='Number of plots sent to a rendering process at once (default: about four chunks per '
+                             'process)')
+    parser.add_argument('--dry_run', '--dry-run', action='store_true',
+                        help='Print the plots that would be rendered and their estimated cost, without rendering')
+    parser.add_argument('--reuse', type=str, metavar='RUN_DIR',
+                        help='Copy the plots of a previous run directory whose data and settings did not change, '
+                             'instead of rendering them again')
+    parser.add_argument('--resume', type=str, metavar='RUN_DIR',
+                        help='Continue an interrupted run in its directory, rendering only the missing plots')
+    parser.add_argument('--profile', action='store_true',
+                        help='Measure the time and memory of each stage and plot, written to profile.json and '
+                             'profile_summary.txt in the run directory')
+    parser.add_argument('--profile_stats', action='store_true',
+                        help='Also dump the cProfile statistics of each stage in the profile_stats directory of the '
+                             'run, to be read with pstats or snakeviz (implies --profile)')
+    parser.add_argument('--progress', type=str, metavar='FILE',
+                        help='Append the progress of the rendering to FILE as json lines: start and end of each plot, '
+                             'plots done and remaining, throughput and estimated time left')
+    parser.add_argument('--progress_interval', type=float, default=10,
+                        help='Minimum number of seconds between two progress messages in the log (default: 10)')
     parser.add_argument('-z', '--zip', type=str,
                         help="Add option & path to export plots in zip file")
+    parser.add_argument('--zip_compression', action='append', default=[], metavar='EXT=METHOD[:LEVEL]',
+                        help="Compression of the files of an extension in the zip file, with METHOD in stored, "
+                             "deflated, bzip2 or lzma (for instance svg=deflated:9). This option can be given multiple "
+                             "times. By default png and jpeg are stored and other formats are deflated")
+    parser.add_argument('--zip_checkpoint', type=float, default=10, metavar='SECONDS',
+                        help="Rewrite the directory of the zip file at most every SECONDS seconds (and every 100 "
+                             "files) so that an interrupted run leaves a valid archive. 0 to only write it at the end "
+                             "(default: 10)")
     parser.add_argument('-g', '--galaxy', action='store_true',
                         help='Option for galaxy integration. Not useful for local usage')
     return parser
 
 
+def parse_convert_args():
+    """
+    Parse arguments of the data conversion command.
+
+    :return: Argument Parser object
+    :rtype: class: argparse.ArgumentParser
+    """
+
+    parser = argparse.ArgumentParser("Isoplot2: Convert Isocor output to a columnar file for faster loading")
+
+    parser.add_argument('input_path', help="Path to Isocor datafile (tsv or csv)")
+    parser.add_argument('output_path',
+                        help="Path to the converted file. Its extension gives the format (.parquet/.pq or "
+                             ".feather/.arrow)")
+    return parser
+
+
 class IsoplotCli:
 
     def __init__(self, home=None, run_home=None, static_plot=None, int_plot=None, maps=None, args=None):
@@ -89,19 +156,6 @@ class IsoplotCli:
         self.times = []
         self.logger = logging.getLogger("isoplot_log.ui.isoplotcli.IsoplotCli")
 
-    def dir_init(self, plot_type):
-        """Initialize directory for plot"""
-        wd = self.run_home / plot_type
-        if os.path.exists(wd):
-            os.chdir(wd)
-        else:
-            wd.mkdir()
-            os.chdir(wd)
-
-    def go_home(self):
-        """Exit after work is done"""
-        os.chdir(self.home)
-
     @staticmethod
     def get_cli_input(arg, param, data_object):
         """
@@ -143,36 +197,76 @@ class IsoplotCli:
                     is_error = False
         return desire
 
-    def zip_export(self, figures, zip_file_name):
+    def build_render_plan(self, metabolite_list):
         """
-        Function to save figures in figure list to zip file (taken from
-        https://stackoverflow.com/questions/55616877/save-multiple-objects-to-zip-directly-from-memory-in-python)
+        Compile the arguments that were parsed into the plan of the plots to render
 
-        :param figures: storage of figures and their respective file names in tuples: (name, fig)
-        :type figures: list of tuples
-        :param zip_file_name: name of the exported zip file
-        :type zip_file_name: str
+        :param metabolite_list: metabolites to be plotted
+        :type metabolite_list: list of str
+        :rtype: class: 'isoplot.main.render.RenderPlan'
         """
 
-        self.logger.info(f"Creating archive: {zip_file_name}")
-        with zipfile.ZipFile(zip_file_name, mode="w") as zf:
-            for fig_name, fig in figures:
-                if fig_name.endswith("svg"):
-                    buf = io.BytesIO()
-                    fig.savefig(buf, format="svg")
-                elif fig_name.endswith("html"):
-                    html = file_html(fig, CDN, fig_name)
-                    buf = io.StringIO(html)
-                else:
-                    buf = io.BytesIO()
-                    fig.savefig(buf)
-                self.logger.info(f"Writing image {fig_name} in the archive")
-                zf.writestr(fig_name, buf.getvalue())
+        return RenderPlan(self.build_render_tasks(metabolite_list))
+
+    def use_tensor(self):
+        """
+        Check whether the value tensor should be built: it was requested and a planned plot reads it
+
+        :rtype: bool
+        """
+
+        # The plotted methods do not depend on the metabolite
+        return self.args.tensor and self.build_render_plan([None]).reads_pivot()
+
+    def build_render_tasks(self, metabolite_list):
+        """
+        Build the list of plots to render from the arguments that were parsed
+
+        :param metabolite_list: metabolites to be plotted
+        :type metabolite_list: list of str
+        :return: tasks in the order in which the plots are created
+        :rtype: list of class: 'isoplot.main.render.RenderTask'
+        """
+
+        tasks = []
+        for metabolite in metabolite_list:
+            for value in self.args.value:
+                is_me = value == "mean_enrichment"
+                plots = [
+                    # STATIC PLOTS
+                    (self.args.stacked_areaplot, "static", "stacked_areaplot", "Static_Areaplots"),
+                    (self.args.barplot and not is_me, "static", "barplot", "Static_barplots"),
+                    (self.args.meaned_barplot and not is_me, "static", "mean_barplot", "Static_barplots_SD"),
+                    (self.args.barplot and is_me, "static", "mean_enrichment_plot", "Static_barplots"),
+                    (self.args.meaned_barplot and is_me, "static", "mean_enrichment_meanplot", "Static_barplots_SD"),
+                    # INTERACTIVE PLOTS
+                    (self.args.interactive_barplot and not is_me, "interactive", "stacked_barplot",
+                     "Interactive_barplots"),
+                    (self.args.interactive_barplot and not self.args.stack, "interactive", "unstacked_barplot",
+                     "Interactive_unstacked_barplots"),
+                    (self.args.interactive_meanplot and not is_me, "interactive", "stacked_meanplot",
+                     "Interactive_barplots_SD"),
+                    (self.args.interactive_meanplot and not self.args.stack, "interactive", "unstacked_meanplot",
+                     "Interactive_barplots_SD"),
+                    (self.args.interactive_barplot and is_me, "interactive", "mean_enrichment_plot",
+                     "Interactive_barplots"),
+                    (self.args.interactive_meanplot and is_me, "interactive", "mean_enrichment_meanplot",
+                     "Interactive_barplots_SD"),
+                    (self.args.interactive_areaplot, "interactive", "stacked_areaplot", "Interactive_stackplots"),
+                ]
+                tasks += [RenderTask(kind, method, plot_name, metabolite, value)
+                          for flag, kind, method, plot_name in plots if flag]
+        # MAPS
+        maps = [(self.args.static_heatmap, "build_heatmap", "static_heatmap"),
+                (self.args.static_clustermap, "build_clustermap", "static_clustermap"),
+                (self.args.interactive_heatmap, "build_interactive_heatmap", "interactive_heatmap")]
+        tasks += [RenderTask("map", method, plot_name) for flag, method, plot_name in maps if flag]
+        return tasks
 
-    def plot_figs(self, metabolite_list, data_object, build_zip=False):
+    def plot_figs(self, metabolite_list, data_object, build_zip=False, profile=None, progress=None):
         """
         Function to control which plot methods are called depending on the
-        arguments that were parsed
+        arguments that were parsed. With more than one job, the plots are rendered by a pool of processes.
 
         :param metabolite_list: metabolites to be plotted
         :type metabolite_list: list of str
@@ -180,186 +274,87 @@ class IsoplotCli:
         :type data_object: class: 'isoplot.main.dataprep.IsoplotData'
         :param build_zip: should figures be returned and exported in zip
         :type build_zip: bool
+        :param profile: profile in which each plot is measured, None to not measure them
+        :type profile: class: 'isoplot.main.profiling.RunProfile'
+        :param progress: function called with each progress event (see isoplot.main.progress.ProgressTracker). The
+                         progress is logged when None
         """
 
+        plan = self.build_render_plan(metabolite_list)
         if build_zip:
-            figures = []
-
-        for metabolite in metabolite_list:
-            for value in self.args.value:
-                self.static_plot = StaticPlot(self.args.stack, value, data_object.dfmerge,
-                                              self.args.run_name, metabolite, self.conditions, self.times,
-                                              self.args.format, display=False, rtrn=build_zip)
-
-                self.int_plot = InteractivePlot(self.args.stack, value, data_object.dfmerge,
-                                                self.args.run_name, metabolite, self.conditions, self.times,
-                                                display=False, rtrn=build_zip)
-
-                # STATIC PLOTS
-                if self.args.stacked_areaplot:
-                    plot_name = "Static_Areaplots"
-                    if build_zip:
-                        fig = self.static_plot.stacked_areaplot()
-                        fname = plot_name + "_" + self.static_plot.static_fig_name
-                        figures.append((fname, fig))
-                    else:
-                        self.dir_init(plot_name)
-                        self.static_plot.stacked_areaplot()
-                if self.args.barplot and not (value == "mean_enrichment"):
-                    plot_name = "Static_barplots"
-                    if build_zip:
-                        fig = self.static_plot.barplot()
-                        fname = plot_name + "_" + self.static_plot.static_fig_name
-                        figures.append((fname, fig))
-                    else:
-                        self.dir_init(plot_name)
-                        self.static_plot.barplot()
-                if self.args.meaned_barplot and not (value == "mean_enrichment"):
-                    plot_name = "Static_barplots_SD"
-                    if build_zip:
-                        fig = self.static_plot.mean_barplot()
-                        fname = plot_name + "_" + self.static_plot.static_fig_name
-                        figures.append((fname, fig))
-                    else:
-                        self.dir_init(plot_name)
-                        self.static_plot.mean_barplot()
-                if self.args.barplot and (value == "mean_enrichment"):
-                    plot_name = "Static_barplots"
-                    if build_zip:
-                        fig = self.static_plot.mean_enrichment_plot()
-                        fname = plot_name + "_" + self.static_plot.static_fig_name
-                        figures.append((fname, fig))
-                    else:
-                        self.dir_init(plot_name)
-                        self.static_plot.mean_enrichment_plot()
-                if self.args.meaned_barplot and (value == "mean_enrichment"):
-                    plot_name = "Static_barplots_SD"
-                    if build_zip:
-                        fig = self.static_plot.mean_enrichment_meanplot()
-                        fname = plot_name + "_" + self.static_plot.static_fig_name
-                        figures.append((fname, fig))
-                    else:
-                        self.dir_init(plot_name)
-                        self.static_plot.mean_enrichment_meanplot()
-                # INTERACTIVE PLOTS
-                if self.args.interactive_barplot and not (value == "mean_enrichment"):
-                    plot_name = "Interactive_barplots"
-                    if build_zip:
-                        fig = self.int_plot.stacked_barplot()
-                        fname = plot_name + "_" + self.int_plot.filename
-                        figures.append((fname, fig))
-                    else:
-                        self.dir_init(plot_name)
-                        self.int_plot.stacked_barplot()
-                if self.args.interactive_barplot and not self.args.stack:
-                    plot_name = "Interactive_unstacked_barplots"
-                    if build_zip:
-                        fig = self.int_plot.unstacked_barplot()
-                        fname = plot_name + "_" + self.int_plot.filename
-                        figures.append((fname, fig))
-                    else:
-                        self.dir_init(plot_name)
-                        self.int_plot.unstacked_barplot()
-                if self.args.interactive_meanplot and not (value == "mean_enrichment"):
-                    plot_name = "Interactive_barplots_SD"
-                    if build_zip:
-                        fig = self.int_plot.stacked_meanplot()
-                        fname = plot_name + "_" + self.int_plot.filename
-                        figures.append((fname, fig))
-                    else:
-                        self.dir_init(plot_name)
-                        self.int_plot.stacked_meanplot()
-                if self.args.interactive_meanplot and not self.args.stack:
-                    plot_name = "Interactive_barplots_SD"
-                    if build_zip:
-                        fig = self.int_plot.unstacked_meanplot()
-                        fname = plot_name + "_" + self.int_plot.filename
-                        figures.append((fname, fig))
-                    else:
-                        self.dir_init(plot_name)
-                        self.int_plot.unstacked_meanplot()
-                if self.args.interactive_barplot and (value == "mean_enrichment"):
-                    plot_name = "Interactive_barplots"
-                    if build_zip:
-                        fig = self.int_plot.mean_enrichment_plot()
-                        fname = plot_name + "_" + self.int_plot.filename
-                        figures.append((fname, fig))
-                    else:
-                        self.dir_init(plot_name)
-                        self.int_plot.mean_enrichment_plot()
-                if self.args.interactive_meanplot and (value == "mean_enrichment"):
-                    plot_name = "Interactive_barplots_SD"
-                    if build_zip:
-                        fig = self.int_plot.mean_enrichment_meanplot()
-                        fname = plot_name + "_" + self.int_plot.filename
-                        figures.append((fname, fig))
-                    else:
-                        self.dir_init(plot_name)
-                        self.int_plot.mean_enrichment_meanplot()
-                if self.args.interactive_areaplot:
-                    plot_name = "Interactive_stackplots"
-                    if build_zip:
-                        fig = self.int_plot.stacked_areaplot()
-                        fname = plot_name + "_" + self.int_plot.filename
-                        figures.append((fname, fig))
-                    else:
-                        self.dir_init(plot_name)
-                        self.int_plot.stacked_areaplot()
-        # MAPS
-        self.maps = Map(data_object.dfmerge, self.args.run_name, self.args.annot, self.args.format, rtrn=build_zip)
-        if self.args.static_heatmap:
-            plot_name = "static_heatmap"
-            if build_zip:
-                fig = self.maps.build_heatmap()
-                fname = plot_name + f".{self.maps.fmt}"
-                figures.append((fname, fig))
-            else:
-                self.dir_init(plot_name)
-                self.maps.build_heatmap()
-        if self.args.static_clustermap:
-            plot_name = "static_clustermap"
-            if build_zip:
-                fig = self.maps.build_clustermap()
-                fname = plot_name + f".{self.maps.fmt}"
-                figures.append((fname, fig))
-            else:
-                self.dir_init(plot_name)
-                self.maps.build_clustermap()
-        if self.args.interactive_heatmap:
-            self.maps.fmt = "html"
-            plot_name = "interactive_heatmap"
-            if build_zip:
-                fig = self.maps.build_interactive_heatmap()
-                fname = plot_name + f".{self.maps.fmt}"
-                figures.append((fname, fig))
-            else:
-                self.dir_init(plot_name)
-                self.maps.build_interactive_heatmap()
-        if build_zip:
-            self.zip_export(figures, self.args.zip)
-        if not self.args.galaxy:
-            self.go_home()
+            self.logger.info(f"Creating archive: {self.args.zip}")
+            sink = ZipSink(self.args.zip, compression=ZipSink.parse_compression(self.args.zip_compression),
+                           checkpoint=self.args.zip_checkpoint > 0, checkpoint_seconds=self.args.zip_checkpoint)
+        else:
+            sink = DirectorySink(self.run_home if self.run_home is not None else os.getcwd())
+        renderer = Renderer(data_object, self.args.run_name, self.conditions, self.times, self.args.format,
+                            self.args.stack, self.args.annot, sink)
+        if profile is not None:
+            renderer.profile, renderer.stats_dir = True, profile.stats_dir
+        # Plots already in the manifest of the run directory (resumed run) or of the reused run are not rendered again
+        manifest = RenderManifest(sink.root) if isinstance(sink, DirectorySink) else None
+        previous = RenderManifest(self.args.reuse) if self.args.reuse else None
+        pending, keys = [], []
+        done, reused = 0, 0
+        for task in plan:
+            key = renderer.task_key(task) if manifest is not None else None
+            if manifest is not None and manifest.lookup(key):
+                done += 1
+                continue
+            files = previous.lookup(key) if previous is not None else None
+            if files:
+                previous.copy_files(files, sink)
+                manifest.record(key, task, files)
+                reused += 1
+                continue
+            pending.append(task)
+            keys.append(key)
+        if done:
+            self.logger.info(f"{done} plots were already rendered in {sink.root}")
+        if reused:
+            self.logger.info(f"{reused} plots were copied from {self.args.reuse}")
+        self.logger.debug(f"Rendering {len(pending)} plots with {self.args.jobs} "
+                          f"{'thread(s)' if self.args.threads else 'job(s)'}")
+        failed = 0
+        if progress is None:
+            progress = ProgressLog(self.logger, self.args.progress_interval)
+        renderer.progress = ProgressTracker(pending, progress, self.args.progress, self.args.jobs, done + reused)
+        with renderer.progress, sink:
+            results = run_tasks(renderer, pending, self.args.jobs, self.args.chunk_size, threads=self.args.threads)
+            for key, result in zip(keys, results):
+                if result.error is not None:
+                    failed += 1
+                    self.logger.error(f"Plot {result.task.method} of {result.task.metabolite} "
+                                      f"({result.task.value}) could not be created:\n{result.error}")
+                else:
+                    self.logger.debug(f"Created {result.fig_name}")
+                    if manifest is not None:
+                        manifest.record(key, result.task, result.files)
+                    if profile is not None:
+                        profile.add_render(result)
+        if profile is not None:
+            profile.merge_render_stats()
+        if failed:
+            raise RuntimeError(f"{failed} of {len(plan)} plots could not be created")
 
     def initialize_cli(self):
         """Launch argument parsing and perform checks"""
 
         self.args = self.parser.parse_args()
-        handle = logging.StreamHandler()
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        handle.setFormatter(formatter)
-        if self.args.verbose:
-            handle.setLevel(logging.DEBUG)
-        else:
-            handle.setLevel(logging.INFO)
-        self.logger.addHandler(handle)
+        configure_logging(verbose=self.args.verbose)
 
         # Check for typos and input errors
         valid_formats = ['png', 'svg', 'pdf', 'jpeg', 'html']
         forbidden_characters = ["*", ".", '"', "/", "\\", "[", "]", ":", ";", "|", ","]
 
-        if not os.path.exists(self.args.input_path):
-            raise RuntimeError(f"Input path does not lead to valid file. "
-                               f"Please check path: {self.args.input_path}")
+        try:
+            self.args.input_path = IsoplotData.resolve_datapaths(self.args.input_path)
+        except ValueError as err:
+            raise RuntimeError(f"Input path does not lead to valid file. Error: {err}")
+        for path in self.args.input_path:
+            if not os.path.exists(path):
+                raise RuntimeError(f"Input path does not lead to valid file. "
+                                   f"Please check path: {path}")
 
         if self.args.format not in valid_formats:
             raise RuntimeError("Format must be png, svg, pdf, jpeg or html")
@@ -369,6 +364,38 @@ class IsoplotCli:
                 raise RuntimeError(f"Invalid character in run name. "
                                    f"Forbidden characters are: {forbidden_characters}")
 
+        if self.args.jobs < 1:
+            raise RuntimeError("Number of jobs must be at least 1")
+
+        if self.args.threads:
+            import matplotlib
+            if parse_version(matplotlib.__version__) < (3, 6):
+                raise RuntimeError(f"Rendering with threads needs matplotlib 3.6 or later "
+                                   f"(installed: {matplotlib.__version__})")
+
+        if self.args.progress and os.path.isdir(self.args.progress):
+            raise RuntimeError(f"Progress file is a directory. Please check path: {self.args.progress}")
+
+        for run_dir in [self.args.reuse, self.args.resume]:
+            if run_dir and not os.path.isdir(run_dir):
+                raise RuntimeError(f"Run directory does not exist. Please check path: {run_dir}")
+        if self.args.zip and (self.args.reuse or self.args.resume):
+            raise RuntimeError("Previous runs can only be reused or resumed when plots are written in a directory")
+
+        try:
+            ZipSink.parse_compression(self.args.zip_compression)
+        except ValueError as err:
+            raise RuntimeError(err)
+
         if self.args.template_path and not os.path.exists(self.args.template_path):
             raise RuntimeError(f"Template path does not lead to valid file. "
                                f"Please check path: {self.args.template_path}")
+
+        # Input files are given by their absolute path so that they do not depend on the working directory
+        self.args.input_path = [os.path.abspath(path) for path in self.args.input_path]
+        if self.args.template_path:
+            self.args.template_path = os.path.abspath(self.args.template_path)
+        if self.args.reuse:
+            self.args.reuse = os.path.abspath(self.args.reuse)
+        if self.args.profile_stats:
+            self.args.profile = True
@@ -21,13 +21,13 @@ setup(
                 "License :: OSI Approved :: GNU General Public License v3 (GPLv3)",
                 "Natural Language :: French",
                 "Operating System :: OS Independent",
-                "Programming Language :: Python :: 3.6",
                 "Programming Language :: Python :: 3.7",
                 "Programming Language :: Python :: 3.8",
                 "Programming Language :: Python :: 3.9",
                 "Topic :: Scientific/Engineering :: Bio-Informatics"],
     long_description = open_readme_file(),
-	packages = find_packages(),
+	packages = find_packages(exclude=["benchmarks", "benchmarks.*"]),
+    python_requires = ">=3.7",
     install_requires = [
         "numpy>=1.19.1",
         "pandas>=1.1.1",
@@ -41,6 +41,7 @@ setup(
         "xlrd>=1.2.0"
     ],
     extras_require={  # Optional
+        'arrow': ['pyarrow'],
         'dev': ['Sphinx',
                 "sphinx-argparse",
                 "autodoc",
@@ -53,6 +54,7 @@ setup(
 	entry_points = {
         'console_scripts': [
             'isoplot = isoplot.main.cli_process:main',
+            'isoplot-convert = isoplot.main.cli_process:convert',
         ]},
     url = "https://github.com/LoloPopoPy/Isoplot",
     author = "Loïc Le Grégam",